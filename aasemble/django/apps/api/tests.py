@@ -15,8 +15,8 @@ from rest_framework.test import APITestCase
 
 from six.moves.urllib.parse import urlparse
 
-from aasemble.django.apps.buildsvc.models import PackageSource, Repository
-from aasemble.django.apps.mirrorsvc.models import Mirror, Snapshot
+from aasemble.django.apps.buildsvc.models import PackageSource, PublishedPackage, Repository
+from aasemble.django.apps.mirrorsvc.models import Mirror, Snapshot, SnapshotPackage
 
 
 def authenticate(client, username=None, token=None):
@@ -36,9 +36,17 @@ class APIv1Tests(APITestCase):
     repository_includes_builds_link = False
     mirrorset_includes_sources_list = False
     mirror_includes_sources_list = False
+    mirror_includes_storage_stats = False
+    mirror_has_refresh_interval = False
+    mirror_has_filters = False
+    mirror_has_on_demand = False
+    snapshot_has_state = False
     repository_should_be_embedded_in_source = False
     repository_has_build_sources_list = False
     repository_has_series_name = False
+    repository_has_retention_policy = False
+    repository_has_packages = False
+    repository_has_snapshots = False
 
     def __init__(self, *args, **kwargs):
         super(APIv1Tests, self).__init__(*args, **kwargs)
@@ -139,6 +147,16 @@ class APIv1Tests(APITestCase):
         if self.repository_has_series_name:
             expected_result['series_name'] = 'aasemble'
 
+        if self.repository_has_retention_policy:
+            expected_result['keep_versions'] = 0
+            expected_result['keep_logs_days'] = 0
+
+        if self.repository_has_packages:
+            expected_result['packages'] = response.data['self'] + 'packages/'
+
+        if self.repository_has_snapshots:
+            expected_result['snapshots'] = response.data['self'] + 'snapshots/'
+
         self.assertEquals(response.data, expected_result)
         response = self.client.get(response.data['self'])
         self.assertEquals(response.data, expected_result)
@@ -215,6 +233,16 @@ class APIv1Tests(APITestCase):
         if self.repository_has_series_name:
             expected_result['series_name'] = 'aasemble'
 
+        if self.repository_has_retention_policy:
+            expected_result['keep_versions'] = 0
+            expected_result['keep_logs_days'] = 0
+
+        if self.repository_has_packages:
+            expected_result['packages'] = response.data['self'] + 'packages/'
+
+        if self.repository_has_snapshots:
+            expected_result['snapshots'] = response.data['self'] + 'snapshots/'
+
         self.assertEquals(response.data, expected_result)
         response = self.client.get(response.data['self'])
         self.assertEquals(response.data, expected_result, 'Changes were not persisted')
@@ -694,6 +722,16 @@ class APIv1Tests(APITestCase):
             url = 'http://127.0.0.1:8000/mirrors/{0}/example.com/'.format(uuid)
             data['sources_list'] = ('deb {0} trusty main\n'
                                     'deb-src {0} trusty main\n').format(url)
+        if self.mirror_has_refresh_interval:
+            data['refresh_interval'] = None
+        if self.mirror_includes_storage_stats:
+            data['bytes_downloaded'] = 0
+            data['bytes_saved'] = 0
+            data['bytes_shared'] = 0
+        if self.mirror_has_filters:
+            data['architectures'] = []
+        if self.mirror_has_on_demand:
+            data['on_demand'] = False
         self.assertEquals(data, response.data)
         return response.data
 
@@ -1241,6 +1279,9 @@ class APIv2Tests(APIv1Tests):
         self.assertEquals(response.status_code, 201)
         data['self'] = response.data['self']
         data['timestamp'] = response.data['timestamp']
+        if self.snapshot_has_state:
+            data['state'] = 'Pending'
+            data['progress'] = 0
         self.assertEquals(data, response.data)
         return response.data
 
@@ -1252,6 +1293,9 @@ class APIv2Tests(APIv1Tests):
         data['self'] = response.data['self']
         data['timestamp'] = response.data['timestamp']
         data['mirrorset'] = response.data['mirrorset']
+        if self.snapshot_has_state:
+            data['state'] = 'Pending'
+            data['progress'] = 0
         self.assertEquals(data, response.data)
         return response.data
 
@@ -1321,9 +1365,110 @@ class APIv3Tests(APIv2Tests):
     view_prefix = 'v3'
     mirrorset_includes_sources_list = True
     mirror_includes_sources_list = True
+    mirror_includes_storage_stats = True
+    mirror_has_refresh_interval = True
+    mirror_has_filters = True
+    mirror_has_on_demand = True
+    snapshot_has_state = True
     repository_should_be_embedded_in_source = True
     repository_has_build_sources_list = True
     repository_has_series_name = True
+    repository_has_retention_policy = True
+    repository_has_packages = True
+    repository_has_snapshots = True
+
+    def test_create_mirror_with_architectures(self):
+        data = {'url': 'http://example.com/',
+                'series': ['trusty'],
+                'components': ['main'],
+                'architectures': ['amd64', 'src']}
+        authenticate(self.client, 'eric')
+        response = self.client.post(self.mirror_list_url, data, format='json')
+        self.assertEquals(response.status_code, 201)
+        self.assertEquals(response.data['architectures'], ['amd64', 'src'])
+        uuid = response.data['self'].split('/')[-2]
+        url = 'http://127.0.0.1:8000/mirrors/{0}/example.com/'.format(uuid)
+        self.assertEquals(response.data['sources_list'], ('deb [arch=amd64] {0} trusty main\n'
+                                                          'deb-src {0} trusty main\n').format(url))
+
+    def test_create_snapshot_of_on_demand_mirror_fails(self):
+        data = {'url': 'http://example.com/',
+                'series': ['trusty'],
+                'components': ['main'],
+                'on_demand': True}
+        authenticate(self.client, 'eric')
+        response = self.client.post(self.mirror_list_url, data, format='json')
+        self.assertEquals(response.status_code, 201)
+        response = self.client.post(self.mirrorset_list_url, {'mirrors': [response.data['self']]}, format='json')
+        self.assertEquals(response.status_code, 201)
+        response = self.client.post(self.snapshot_list_url, {'mirrorset': response.data['self']}, format='json')
+        self.assertEquals(response.status_code, 400)
+        self.assertIn('mirrorset', response.data)
+
+    def create_snapshots_with_packages(self):
+        old, new = Snapshot.objects.get(id=1), Snapshot.objects.get(id=4)
+        Snapshot.objects.filter(id__in=[old.id, new.id]).update(state=Snapshot.READY, packages_recorded=True)
+        for snapshot, packages in ((old, [('foo', '1.0'), ('bar', '1.0'), ('baz', '2.0'), ('same', '1.0')]),
+                                   (new, [('foo', '1.0+1'), ('baz', '1.0'), ('qux', '1.0'), ('same', '1.0')])):
+            SnapshotPackage.objects.bulk_create([SnapshotPackage(snapshot=snapshot, suite='trusty', component='main',
+                                                                 package=package, version=version, architecture='amd64')
+                                                 for package, version in packages])
+        return old, new
+
+    def test_snapshot_diff(self):
+        old, new = self.create_snapshots_with_packages()
+        authenticate(self.client, 'eric')
+
+        response = self.client.get('%s%s/diff/?from=%s' % (self.snapshot_list_url, new.uuid, old.uuid))
+
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response.data['count'], 4)
+        self.assertEquals([(c['package'], c['change'], c['old_version'], c['new_version']) for c in response.data['results']],
+                          [('bar', 'removed', '1.0', None),
+                           ('baz', 'downgraded', '2.0', '1.0'),
+                           ('foo', 'upgraded', '1.0', '1.0+1'),
+                           ('qux', 'added', None, '1.0')])
+
+    def test_snapshot_diff_is_cacheable(self):
+        old, new = self.create_snapshots_with_packages()
+        authenticate(self.client, 'eric')
+        url = '%s%s/diff/?from=%s' % (self.snapshot_list_url, new.uuid, old.uuid)
+
+        response = self.client.get(url)
+        self.assertEquals(response.status_code, 200)
+        self.assertIn('max-age=86400', response['Cache-Control'])
+
+        self.assertEquals(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        self.assertNotEquals(self.client.get(url + '&page=2', HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+    def test_snapshot_diff_needs_ready_snapshots(self):
+        old, new = self.create_snapshots_with_packages()
+        Snapshot.objects.filter(id=old.id).update(state=Snapshot.IN_PROGRESS)
+        authenticate(self.client, 'eric')
+
+        response = self.client.get('%s%s/diff/?from=%s' % (self.snapshot_list_url, new.uuid, old.uuid))
+
+        self.assertEquals(response.status_code, 400)
+
+    def test_snapshot_diff_unknown_snapshot(self):
+        old, new = self.create_snapshots_with_packages()
+        authenticate(self.client, 'eric')
+
+        response = self.client.get('%s%s/diff/?from=%s' % (self.snapshot_list_url, new.uuid, 'not-a-snapshot'))
+
+        self.assertEquals(response.status_code, 400)
+        self.assertEquals(response.data, {'from': 'Unknown snapshot.'})
+
+    @mock.patch('aasemble.django.apps.mirrorsvc.tasks.record_snapshot_packages')
+    def test_snapshot_diff_records_packages_of_older_snapshots(self, record_snapshot_packages):
+        old, new = self.create_snapshots_with_packages()
+        Snapshot.objects.filter(id=old.id).update(packages_recorded=False)
+        authenticate(self.client, 'eric')
+
+        response = self.client.get('%s%s/diff/?from=%s' % (self.snapshot_list_url, new.uuid, old.uuid))
+
+        self.assertEquals(response.status_code, 400)
+        record_snapshot_packages.delay.assert_called_once_with(old.id)
 
     def test_build_log_serves_temporary_log_when_not_finished(self):
         authenticate(self.client, 'eric')
@@ -1352,6 +1497,92 @@ class APIv3Tests(APIv2Tests):
         response = self.client.get('%s%s/log/' % (self.build_list_url, '1dcc86aa-c925-49b0-9f1e-ffe6839150b7'))
         self.assertEquals(response.url, 'http://127.0.0.1:8000/apt/eric/eric/buildlogs/eric_project0/eric_project0_1.1+0.log')
 
+    def test_build_manifest(self):
+        url = '%s%s/manifest/' % (self.build_list_url, '1dcc86aa-c925-49b0-9f1e-ffe6839150b7')
+        response = self.client.get(url)
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response.data['build']['version'], '1.1+0')
+        self.assertIn('deb [trusted=yes] http://127.0.0.1:8000/apt/eric/eric aasemble main', response.data['sources_list'])
+        self.assertIn('apt_keys', response.data)
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEquals(response.status_code, 304)
+
+    def test_packages(self):
+        PublishedPackage.objects.create(series_id=9, architecture='amd64', name='foo', version='1.0',
+                                        source_name='foo', filename='pool/main/f/foo/foo_1.0_amd64.deb',
+                                        size=3, sha256='abc', control='Package: foo\n',
+                                        files='pool/main/f/foo/foo_1.0_amd64.deb', build_record_id=1)
+        PublishedPackage.objects.create(series_id=9, architecture='source', name='foo', version='1.0',
+                                        source_name='foo', filename='pool/main/f/foo/foo_1.0.dsc',
+                                        size=3, sha256='def', control='Package: foo\n',
+                                        files='pool/main/f/foo/foo_1.0.dsc')
+
+        authenticate(self.client, 'eric')
+        response = self.client.get(self.base_url + 'packages/', {'name': 'foo', 'architecture': 'amd64', 'series': 'aasemble'})
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response.data['count'], 1)
+        package = response.data['results'][0]
+        self.assertEquals(package['version'], '1.0')
+        self.assertEquals(package['sha256'], 'abc')
+        self.assertTrue(package['repository'].endswith('/repositories/f3cc7909-104f-4dee-8fb5-e0ac5a38592f/'))
+        self.assertTrue(package['build'].endswith('/builds/1dcc86aa-c925-49b0-9f1e-ffe6839150b7/'))
+
+        response = self.client.get(package['repository'] + 'packages/')
+        self.assertEquals(response.data['count'], 2)
+
+        response = self.client.get(package['self'])
+        self.assertEquals(response.data['filename'], 'pool/main/f/foo/foo_1.0_amd64.deb')
+
+        authenticate(self.client, 'brandon')
+        response = self.client.get(self.base_url + 'packages/')
+        self.assertEquals(response.data['count'], 0)
+
+    @mock.patch('aasemble.django.apps.buildsvc.tasks.snapshot_repository')
+    def test_repository_snapshot(self, snapshot_repository):
+        authenticate(self.client, 'eric')
+        repo_url = 'http://testserver%srepositories/f3cc7909-104f-4dee-8fb5-e0ac5a38592f/' % (self.base_url,)
+        response = self.client.post(self.base_url + 'repository_snapshots/', {'repository': repo_url}, format='json')
+        self.assertEquals(response.status_code, 201)
+        self.assertEquals(response.data['repository'], repo_url)
+        self.assertFalse(response.data['ready'])
+        self.assertTrue(response.data['url'].startswith('%s/eric/eric5/snapshots/' % (settings.BUILDSVC_REPOS_BASE_URL,)))
+        self.assertEquals(snapshot_repository.apply_async.call_count, 1)
+
+        snapshot = response.data
+        response = self.client.get(repo_url + 'snapshots/')
+        self.assertEquals([s['self'] for s in response.data['results']], [snapshot['self']])
+
+        response = self.client.patch(snapshot['self'], {'ready': True}, format='json')
+        self.assertEquals(response.status_code, 405)
+
+        authenticate(self.client, 'brandon')
+        response = self.client.get(snapshot['self'])
+        self.assertEquals(response.status_code, 404)
+
+    @mock.patch('aasemble.django.apps.buildsvc.tasks.promote')
+    def test_promote(self, promote):
+        package = PublishedPackage.objects.create(series_id=9, architecture='amd64', name='foo', version='1.0',
+                                                  source_name='foo', filename='pool/main/f/foo/foo_1.0_amd64.deb',
+                                                  size=3, sha256='abc', control='Package: foo\n',
+                                                  files='pool/main/f/foo/foo_1.0_amd64.deb')
+        repo_url = '%srepositories/1ca73b01-4822-4e94-8c23-46f5b7e1dc14/' % (self.base_url,)
+
+        authenticate(self.client, 'eric')
+        response = self.client.post(repo_url + 'promote/', {'packages': [str(package.uuid)]}, format='json')
+        self.assertEquals(response.status_code, 202)
+        promote.delay.assert_called_with(11, 'aasemble', [package.id])
+
+        response = self.client.post(repo_url + 'promote/', {'packages': ['not-a-package']}, format='json')
+        self.assertEquals(response.status_code, 400)
+
+        response = self.client.post(repo_url + 'promote/', {'packages': [str(package.uuid)], 'series': 'nonexistant'}, format='json')
+        self.assertEquals(response.status_code, 400)
+
+        authenticate(self.client, 'brandon')
+        response = self.client.post(repo_url + 'promote/', {'packages': [str(package.uuid)]}, format='json')
+        self.assertEquals(response.status_code, 404)
+
     def test_build_duration(self):
         authenticate(self.client, 'eric')
         response = self.client.get(self.build_list_url)
@@ -8,17 +8,28 @@ class aaSembleAPIv1Serializers(object):
     view_prefix = 'v1'
     default_lookup_field = 'pk'
     snapshots_have_tags = False
+    snapshots_have_state = False
+    snapshots_have_diff = False
     builds_nest_source = False
     include_build_duration = False
     include_key_data_link = False
     include_builds_link = False
     include_sources_list_in_mirrorset = False
     include_sources_list_in_mirrors = False
+    include_storage_stats_in_mirrors = False
+    mirrors_have_refresh_interval = False
+    mirrors_have_filters = False
+    mirrors_have_on_demand = False
     sources_nest_repository = False
     repo_has_build_sources_list = False
     repo_has_series_name = False
     source_includes_last_built_version = False
     build_includes_counter = False
+    build_has_manifest = False
+    repo_has_retention_policy = False
+    repo_has_packages = False
+    repo_has_snapshots = False
+    repo_has_promote = False
 
     def __init__(self):
         self.MirrorSerializer = self.MirrorSerializerFactory()
@@ -29,6 +40,8 @@ class aaSembleAPIv1Serializers(object):
         self.SeriesSerializer = self.SeriesSerializerFactory()
         self.BuildRecordSerializer = self.BuildRecordSerializerFactory()
         self.ExternalDependencySerializer = self.ExternalDependencySerializerFactory()
+        self.PublishedPackageSerializer = self.PublishedPackageSerializerFactory()
+        self.RepositorySnapshotSerializer = self.RepositorySnapshotSerializerFactory()
 
     class SimpleListField(serializers.ListField):
         child = serializers.CharField()
@@ -39,6 +52,8 @@ class aaSembleAPIv1Serializers(object):
         def to_representation(self, data):
             if isinstance(data, list):
                 return data
+            if not data:
+                return []
             return data.split(' ')
 
     class TagsSerializer(serializers.ListField):
@@ -89,16 +104,38 @@ class aaSembleAPIv1Serializers(object):
             refresh_in_progress = serializers.BooleanField(read_only=True)
             if selff.include_sources_list_in_mirrors:
                 sources_list = serializers.CharField(read_only=True)
+            if selff.mirrors_have_refresh_interval:
+                refresh_interval = serializers.IntegerField(required=False, allow_null=True, min_value=1)
+            if selff.include_storage_stats_in_mirrors:
+                bytes_downloaded = serializers.IntegerField(read_only=True)
+                bytes_saved = serializers.IntegerField(read_only=True)
+                bytes_shared = serializers.IntegerField(read_only=True)
+            if selff.mirrors_have_filters:
+                architectures = serializers.SlugRelatedField(many=True, required=False, slug_field='apt_mirror_prefix',
+                                                             queryset=mirrorsvc_models.Architecture.objects.all())
+            if selff.mirrors_have_on_demand:
+                on_demand = serializers.BooleanField(default=False)
 
             def create(self, validated_data):
-                return mirrorsvc_models.Mirror.objects.create(visible_to_v1_api=(selff.view_prefix == 'v1'),
-                                                              **validated_data)
+                architectures = validated_data.pop('architectures', [])
+                mirror = mirrorsvc_models.Mirror.objects.create(visible_to_v1_api=(selff.view_prefix == 'v1'),
+                                                                **validated_data)
+                mirror.architectures.set(architectures)
+                return mirror
 
             class Meta:
                 model = mirrorsvc_models.Mirror
                 fields = ('self', 'url', 'series', 'components', 'public', 'refresh_in_progress')
                 if selff.include_sources_list_in_mirrors:
                     fields += ('sources_list',)
+                if selff.mirrors_have_refresh_interval:
+                    fields += ('refresh_interval',)
+                if selff.include_storage_stats_in_mirrors:
+                    fields += ('bytes_downloaded', 'bytes_saved', 'bytes_shared')
+                if selff.mirrors_have_filters:
+                    fields += ('architectures',)
+                if selff.mirrors_have_on_demand:
+                    fields += ('on_demand',)
 
         return MirrorSerializer
 
@@ -124,6 +161,8 @@ class aaSembleAPIv1Serializers(object):
 
             if selff.snapshots_have_tags:
                 tags = selff.TagsSerializer(required=False)
+            if selff.snapshots_have_state:
+                state = serializers.CharField(source='get_state_display', read_only=True)
 
             def create(self, validated_data):
                 tags_data = validated_data.pop('tags', [])
@@ -132,6 +171,11 @@ class aaSembleAPIv1Serializers(object):
                     mirrorsvc_models.Tags.objects.create(snapshot=snapshot, **tag_data)
                 return snapshot
 
+            def validate_mirrorset(self, value):
+                if self.instance is None and not value.can_be_snapshotted():
+                    raise serializers.ValidationError('Mirror sets with mirrors fetched on demand cannot be snapshotted.')
+                return value
+
             def update(self, instance, validated_data):
                 tags_data = validated_data.pop('tags', [])
                 mirrorsvc_models.Tags.objects.filter(snapshot=instance).delete()
@@ -144,6 +188,9 @@ class aaSembleAPIv1Serializers(object):
                 fields = ('self', 'timestamp', 'mirrorset')
                 if selff.snapshots_have_tags:
                     fields += ('tags',)
+                if selff.snapshots_have_state:
+                    fields += ('state', 'progress')
+                    read_only_fields = ('progress',)
 
         return SnapshotSerializer
 
@@ -255,6 +302,12 @@ class aaSembleAPIv1Serializers(object):
             if selff.repo_has_series_name:
                 series_name = serializers.CharField(read_only=True, source='first_series.name')
 
+            if selff.repo_has_snapshots:
+                snapshots = serializers.HyperlinkedIdentityField(view_name='{0}_repositorysnapshots-list'.format(selff.view_prefix), lookup_url_kwarg='repository_{0}'.format(selff.default_lookup_field), read_only=True, lookup_field=selff.default_lookup_field)
+
+            if selff.repo_has_packages:
+                packages = serializers.HyperlinkedIdentityField(view_name='{0}_repositorypackage-list'.format(selff.view_prefix), lookup_url_kwarg='repository_{0}'.format(selff.default_lookup_field), read_only=True, lookup_field=selff.default_lookup_field)
+
             class Meta:
                 model = buildsvc_models.Repository
                 fields = ('self', 'user', 'name', 'key_id', 'sources', 'binary_source_list', 'source_source_list', 'external_dependencies')
@@ -270,4 +323,40 @@ class aaSembleAPIv1Serializers(object):
                 if selff.repo_has_series_name:
                     fields += ('series_name',)
 
+                if selff.repo_has_retention_policy:
+                    fields += ('keep_versions', 'keep_logs_days')
+
+                if selff.repo_has_packages:
+                    fields += ('packages',)
+
+                if selff.repo_has_snapshots:
+                    fields += ('snapshots',)
+
         return RepositorySerializer
+
+    def RepositorySnapshotSerializerFactory(selff):
+        class RepositorySnapshotSerializer(serializers.HyperlinkedModelSerializer):
+            self = serializers.HyperlinkedRelatedField(view_name='{0}_repositorysnapshot-detail'.format(selff.view_prefix), read_only=True, source='*', lookup_field=selff.default_lookup_field)
+            repository = selff.RepositoryField(view_name='{0}_repository-detail'.format(selff.view_prefix), queryset=buildsvc_models.Repository.objects.all(), lookup_field=selff.default_lookup_field)
+            url = serializers.CharField(read_only=True, source='base_url')
+
+            class Meta:
+                model = buildsvc_models.RepositorySnapshot
+                fields = ('self', 'repository', 'timestamp', 'ready', 'url')
+                read_only_fields = ('timestamp', 'ready')
+
+        return RepositorySnapshotSerializer
+
+    def PublishedPackageSerializerFactory(selff):
+        class PublishedPackageSerializer(serializers.HyperlinkedModelSerializer):
+            self = serializers.HyperlinkedRelatedField(view_name='{0}_package-detail'.format(selff.view_prefix), read_only=True, source='*', lookup_field=selff.default_lookup_field)
+            repository = serializers.HyperlinkedRelatedField(view_name='{0}_repository-detail'.format(selff.view_prefix), read_only=True, source='series.repository', lookup_field=selff.default_lookup_field)
+            series = serializers.CharField(read_only=True, source='series.name')
+            build = serializers.HyperlinkedRelatedField(view_name='{0}_buildrecord-detail'.format(selff.view_prefix), read_only=True, source='build_record', lookup_field=selff.default_lookup_field)
+
+            class Meta:
+                model = buildsvc_models.PublishedPackage
+                fields = ('self', 'repository', 'series', 'component', 'architecture', 'name', 'version',
+                          'source_name', 'filename', 'size', 'sha256', 'build', 'published')
+
+        return PublishedPackageSerializer
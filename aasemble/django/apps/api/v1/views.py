@@ -1,3 +1,5 @@
+import hashlib
+import json
 import socket
 
 from allauth.socialaccount.providers.github.views import GitHubOAuth2Adapter
@@ -5,14 +7,17 @@ from allauth.socialaccount.providers.oauth2.client import OAuth2Client
 
 from django.conf import settings
 from django.conf.urls import include, url
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.core.serializers.json import DjangoJSONEncoder
 import django.db.utils
 from django.http import HttpResponse, HttpResponsePermanentRedirect
+from django.utils.cache import patch_cache_control
 
 import requests
 
 from rest_auth.registration.views import SocialLoginView
 
-from rest_framework import viewsets
+from rest_framework import status, viewsets
 from rest_framework.decorators import detail_route
 from rest_framework.exceptions import ValidationError
 from rest_framework.permissions import AllowAny, DjangoObjectPermissions
@@ -22,6 +27,7 @@ from rest_framework_nested import routers
 
 from aasemble.django.apps.buildsvc import models as buildsvc_models
 from aasemble.django.apps.mirrorsvc import models as mirrorsvc_models
+from aasemble.django.apps.mirrorsvc import tasks as mirrorsvc_tasks
 from aasemble.django.exceptions import DuplicateResourceException
 
 from . import serializers as serializers_
@@ -76,6 +82,8 @@ class aaSembleV1Views(object):
         self.PackageSourceViewSet = self.PackageSourceViewSetFactory()
         self.ExternalDependencyViewSet = self.ExternalDependencyViewSetFactory()
         self.BuildViewSet = self.BuildViewSetFactory()
+        self.PublishedPackageViewSet = self.PublishedPackageViewSetFactory()
+        self.RepositorySnapshotViewSet = self.RepositorySnapshotViewSetFactory()
         self.urls = self.build_urls()
 
     def MirrorViewSetFactory(selff):
@@ -165,6 +173,40 @@ class aaSembleV1Views(object):
                     raise ValidationError({'detail': 'Method "PATCH" not allowed.'})
                 serializer.save(owner=self.request.user)
 
+            if selff.serializers.snapshots_have_diff:
+                @detail_route()
+                def diff(self, request, **kwargs):
+                    snapshot = self.get_object()
+
+                    # The other snapshot is given by its URL or its ID
+                    other_id = request.query_params.get('from', None)
+                    if not other_id:
+                        raise ValidationError({'from': 'No snapshot given.'})
+                    try:
+                        other = self.get_queryset().get(**{selff.default_lookup_field: other_id.rstrip('/').split('/')[-1]})
+                    except (mirrorsvc_models.Snapshot.DoesNotExist, ValueError, DjangoValidationError):
+                        raise ValidationError({'from': 'Unknown snapshot.'})
+
+                    if not snapshot.state == other.state == mirrorsvc_models.Snapshot.READY:
+                        raise ValidationError({'detail': 'Snapshots can only be compared once they are ready.'})
+
+                    unrecorded = [s for s in (snapshot, other) if not s.packages_recorded]
+                    if unrecorded:
+                        # Taken before snapshots recorded their packages
+                        for s in unrecorded:
+                            mirrorsvc_tasks.record_snapshot_packages.delay(s.id)
+                        raise ValidationError({'detail': 'The packages of the snapshots are being recorded. Try again shortly.'})
+
+                    # Snapshots never change, and so neither do their diffs
+                    etag = '"%s"' % (hashlib.sha1(('%s %s %s' % (snapshot.uuid, other.uuid, request.get_full_path())).encode('utf-8')).hexdigest(),)
+                    if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+                        response = Response(status=status.HTTP_304_NOT_MODIFIED)
+                    else:
+                        response = self.get_paginated_response(self.paginate_queryset(snapshot.diff(other)))
+                    response['ETag'] = etag
+                    patch_cache_control(response, private=True, max_age=24 * 60 * 60)
+                    return response
+
         return SnapshotViewSet
 
     def RepositoryViewSetFactory(selff):
@@ -207,6 +249,32 @@ class aaSembleV1Views(object):
 
                     return resp
 
+            if selff.serializers.repo_has_promote:
+                @detail_route(methods=['post'])
+                def promote(self, request, **kwargs):
+                    repository = self.get_object()
+
+                    series_name = request.data.get('series', repository.first_series().name)
+                    if not repository.series.filter(name=series_name).exists():
+                        raise ValidationError({'series': 'Unknown series: %s' % (series_name,)})
+
+                    # Packages are given by their URL or their ID
+                    package_ids = [str(p).rstrip('/').split('/')[-1] for p in request.data.get('packages', [])]
+                    if not package_ids:
+                        raise ValidationError({'packages': 'No packages given.'})
+
+                    visible = buildsvc_models.PublishedPackage.objects.filter(series__repository__in=buildsvc_models.Repository.lookup_by_user(request.user))
+                    try:
+                        packages = visible.filter(**{'{0}__in'.format(selff.default_lookup_field): package_ids})
+                        packages = list(packages.values_list('id', flat=True))
+                    except (ValueError, DjangoValidationError):
+                        packages = []
+                    if len(packages) != len(set(package_ids)):
+                        raise ValidationError({'packages': 'Unknown packages given.'})
+
+                    repository.promote(series_name, packages)
+                    return Response({'status': 'promotion scheduled'}, status=status.HTTP_202_ACCEPTED)
+
         return RepositoryViewSet
 
     def SeriesViewSetFactory(selff):
@@ -319,8 +387,72 @@ class aaSembleV1Views(object):
                         resp.rendered_content = 'REDIRECT:%s' % (url,)
                         return resp
 
+            if selff.serializers.build_has_manifest:
+                @detail_route(permission_classes=[AllowAny])
+                def manifest(self, request, **kwargs):
+                    br = self.get_object()
+                    manifest = br.source.series.build_environment()
+                    manifest['build'] = self.get_serializer(br).data
+
+                    etag = '"%s"' % (hashlib.sha1(json.dumps(manifest, sort_keys=True, cls=DjangoJSONEncoder).encode('utf-8')).hexdigest(),)
+                    if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+                        resp = Response(status=status.HTTP_304_NOT_MODIFIED)
+                    else:
+                        resp = Response(manifest)
+                    resp['ETag'] = etag
+                    return resp
+
         return BuildViewSet
 
+    def PublishedPackageViewSetFactory(selff):
+        class PublishedPackageViewSet(aaSembleV1ReadOnlyViewSet):
+            """
+            API endpoint that allows published packages to be queried
+            """
+            lookup_field = selff.default_lookup_field
+            lookup_value_regex = selff.default_lookup_value_regex
+            queryset = buildsvc_models.PublishedPackage.objects.all().select_related('series__repository', 'build_record').order_by('name', 'architecture', 'id')
+            serializer_class = selff.serializers.PublishedPackageSerializer
+            filter_fields = ('name', 'version', 'architecture', 'component', 'source_name')
+
+            def get_queryset(self):
+                qs = self.queryset.filter(series__repository__in=buildsvc_models.Repository.lookup_by_user(self.request.user))
+                if 'repository_{0}'.format(selff.default_lookup_field) in self.kwargs:
+                    qs = qs.filter(**selff.get_qs_filter(self.kwargs, 'series__repository', 'repository'))
+
+                for field in self.filter_fields:
+                    value = self.request.query_params.get(field, None)
+                    if value is not None:
+                        qs = qs.filter(**{field: value})
+
+                series = self.request.query_params.get('series', None)
+                if series is not None:
+                    qs = qs.filter(series__name=series)
+
+                return qs
+
+        return PublishedPackageViewSet
+
+    def RepositorySnapshotViewSetFactory(selff):
+        class RepositorySnapshotViewSet(aaSembleV1ViewSet):
+            """
+            API endpoint that allows repository snapshots to be created, viewed or deleted
+            """
+            lookup_field = selff.default_lookup_field
+            lookup_value_regex = selff.default_lookup_value_regex
+            queryset = buildsvc_models.RepositorySnapshot.objects.all().select_related('repository__user')
+            serializer_class = selff.serializers.RepositorySnapshotSerializer
+            # Snapshots are immutable
+            http_method_names = ['get', 'post', 'delete', 'head', 'options']
+
+            def get_queryset(self):
+                qs = self.queryset.filter(repository__in=buildsvc_models.Repository.lookup_by_user(self.request.user))
+                if 'repository_{0}'.format(selff.default_lookup_field) in self.kwargs:
+                    qs = qs.filter(**selff.get_qs_filter(self.kwargs, 'repository', 'repository'))
+                return qs
+
+        return RepositorySnapshotViewSet
+
     def build_urls(self):
         router = routers.DefaultRouter()
         router.register(r'repositories', self.RepositoryViewSet, base_name='{0}_repository'.format(self.view_prefix))
@@ -330,6 +462,10 @@ class aaSembleV1Views(object):
         router.register(r'mirrors', self.MirrorViewSet, base_name='{0}_mirror'.format(self.view_prefix))
         router.register(r'mirror_sets', self.MirrorSetViewSet, base_name='{0}_mirrorset'.format(self.view_prefix))
         router.register(r'snapshots', self.SnapshotViewSet, base_name='{0}_snapshot'.format(self.view_prefix))
+        if self.serializers.repo_has_snapshots:
+            router.register(r'repository_snapshots', self.RepositorySnapshotViewSet, base_name='{0}_repositorysnapshot'.format(self.view_prefix))
+        if self.serializers.repo_has_packages:
+            router.register(r'packages', self.PublishedPackageViewSet, base_name='{0}_package'.format(self.view_prefix))
 
         source_router = routers.NestedSimpleRouter(router, r'sources', lookup='source')
         source_router.register(r'builds', self.BuildViewSet, base_name='{0}_build'.format(self.view_prefix))
@@ -338,6 +474,10 @@ class aaSembleV1Views(object):
         repository_router.register(r'sources', self.PackageSourceViewSet, base_name='{0}_packagesource'.format(self.view_prefix))
         repository_router.register(r'external_dependencies', self.ExternalDependencyViewSet, base_name='{0}_externaldependency'.format(self.view_prefix))
         repository_router.register(r'builds', self.BuildViewSet, base_name='{0}_build'.format(self.view_prefix))
+        if self.serializers.repo_has_snapshots:
+            repository_router.register(r'snapshots', self.RepositorySnapshotViewSet, base_name='{0}_repositorysnapshots'.format(self.view_prefix))
+        if self.serializers.repo_has_packages:
+            repository_router.register(r'packages', self.PublishedPackageViewSet, base_name='{0}_repositorypackage'.format(self.view_prefix))
 
         urls = [url(r'^', include(router.urls)),
                 url(r'^', include(repository_router.urls)),
@@ -9,8 +9,19 @@ class aaSembleAPIv3Serializers(v2_serializers.aaSembleAPIv2Serializers):
     include_builds_link = True
     include_sources_list_in_mirrorset = True
     include_sources_list_in_mirrors = True
+    include_storage_stats_in_mirrors = True
+    mirrors_have_refresh_interval = True
+    mirrors_have_filters = True
+    mirrors_have_on_demand = True
+    snapshots_have_state = True
+    snapshots_have_diff = True
     sources_nest_repository = True
     repo_has_build_sources_list = True
     repo_has_series_name = True
     source_includes_last_built_version = True
     build_includes_counter = True
+    build_has_manifest = True
+    repo_has_retention_policy = True
+    repo_has_packages = True
+    repo_has_snapshots = True
+    repo_has_promote = True
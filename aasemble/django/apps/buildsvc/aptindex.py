@@ -0,0 +1,229 @@
+"""Helpers for generating apt repository indices
+
+Nothing in here knows about Django. The AptIndexDriver in repodrivers
+feeds these from the database."""
+import bz2
+import email.utils
+import gzip
+import hashlib
+import io
+import os
+import os.path
+from multiprocessing.pool import ThreadPool
+
+from debian import deb822
+
+from aasemble.utils.exceptions import ChecksumMismatch
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+CHECKSUM_FIELDS = (('MD5Sum', 'md5'), ('SHA1', 'sha1'), ('SHA256', 'sha256'))
+
+# Fields of a .changes file listing checksums: (field, key in
+# checksum_file()'s result, key in each entry of the field)
+CHANGES_CHECKSUM_FIELDS = (('Files', 'md5', 'md5sum'),
+                           ('Checksums-Sha1', 'sha1', 'sha1'),
+                           ('Checksums-Sha256', 'sha256', 'sha256'))
+
+# How many generations of each index to keep available through by-hash
+BY_HASH_GENERATIONS = 3
+
+
+def checksum_data(data):
+    return {'md5': hashlib.md5(data).hexdigest(),
+            'sha1': hashlib.sha1(data).hexdigest(),
+            'sha256': hashlib.sha256(data).hexdigest(),
+            'size': len(data)}
+
+
+def checksum_file(path, bufsize=1024 * 1024):
+    """md5, sha1, sha256 and size of path, computed in a single pass"""
+    md5, sha1, sha256 = hashlib.md5(), hashlib.sha1(), hashlib.sha256()
+    size = 0
+    with open(path, 'rb') as fp:
+        while True:
+            buf = fp.read(bufsize)
+            if not buf:
+                break
+            md5.update(buf)
+            sha1.update(buf)
+            sha256.update(buf)
+            size += len(buf)
+    return {'md5': md5.hexdigest(),
+            'sha1': sha1.hexdigest(),
+            'sha256': sha256.hexdigest(),
+            'size': size}
+
+
+def expected_checksums(changes):
+    """Map the name of each file listed in changes (a deb822.Changes) to
+    the checksums it lists for it"""
+    expected = {}
+    for field, key, entry_key in CHANGES_CHECKSUM_FIELDS:
+        for f in changes.get(field, []):
+            checksums = expected.setdefault(f['name'], {'size': int(f['size'])})
+            checksums[key] = f[entry_key]
+    return expected
+
+
+def verify_changes(changes_file, parallel=4):
+    """Check the files listed in changes_file against its checksums
+
+    Each file is read once, and several files are checked in parallel.
+    Raises ChecksumMismatch as soon as any of them does not match. Returns a
+    dict mapping the name of each file to its checksums."""
+    srcdir = os.path.dirname(changes_file)
+    with open(changes_file, 'r') as fp:
+        expected = expected_checksums(deb822.Changes(fp))
+
+    def verify(name):
+        path = os.path.join(srcdir, name)
+        if not os.path.exists(path):
+            raise ChecksumMismatch(path, None)
+        actual = checksum_file(path)
+        for key, value in sorted(expected[name].items()):
+            if actual[key] != value:
+                raise ChecksumMismatch(path, key, value, actual[key])
+        return name, actual
+
+    if not expected:
+        return {}
+
+    pool = ThreadPool(min(parallel, len(expected)))
+    try:
+        # Results come back as they complete, so the first mismatch
+        # is raised without waiting for the remaining files
+        return dict(pool.imap_unordered(verify, sorted(expected)))
+    finally:
+        pool.terminate()
+
+
+def pool_dir(component, source_name):
+    if source_name.startswith('lib'):
+        prefix = source_name[:4]
+    else:
+        prefix = source_name[:1]
+    return os.path.join('pool', component, prefix, source_name)
+
+
+def binary_stanza(control, filename, checksums):
+    stanza = deb822.Deb822()
+    for k, v in control.items():
+        stanza[k] = v
+    stanza['Filename'] = filename
+    stanza['Size'] = str(checksums['size'])
+    stanza['MD5sum'] = checksums['md5']
+    stanza['SHA1'] = checksums['sha1']
+    stanza['SHA256'] = checksums['sha256']
+    return stanza.dump()
+
+
+def source_stanza(dsc, directory, files):
+    """files is a list of (name, checksums) including the .dsc itself"""
+    stanza = deb822.Deb822()
+    stanza['Package'] = dsc['Source']
+    for k, v in dsc.items():
+        if k in ('Source', 'Files', 'Checksums-Sha1', 'Checksums-Sha256'):
+            continue
+        stanza[k] = v
+    stanza['Directory'] = directory
+    for field, key in (('Files', 'md5'), ('Checksums-Sha1', 'sha1'), ('Checksums-Sha256', 'sha256')):
+        stanza[field] = ''.join(['\n %s %d %s' % (checksums[key], checksums['size'], name)
+                                 for name, checksums in files])
+    return stanza.dump()
+
+
+def _compress_gz(data):
+    buf = io.BytesIO()
+    with gzip.GzipFile(filename='', mode='wb', fileobj=buf, mtime=0) as fp:
+        fp.write(data)
+    return buf.getvalue()
+
+
+def _compress_xz(data):
+    return lzma.compress(data)
+
+
+COMPRESSORS = [('', lambda data: data),
+               ('.gz', _compress_gz),
+               ('.bz2', bz2.compress)]
+
+if lzma is not None:
+    COMPRESSORS.append(('.xz', _compress_xz))
+
+
+def write_atomically(path, data):
+    tmppath = path + '.new'
+    with open(tmppath, 'wb') as fp:
+        fp.write(data)
+    os.rename(tmppath, path)
+
+
+def write_index(dirpath, basename, data, by_hash=True, pool=None):
+    """Write data as dirpath/basename and its compressed variants
+
+    The variants are compressed in parallel. Returns a dict mapping each
+    file name written to its checksums."""
+    if not os.path.isdir(dirpath):
+        os.makedirs(dirpath)
+
+    def write_variant(variant):
+        suffix, compress = variant
+        compressed = compress(data)
+        write_atomically(os.path.join(dirpath, basename + suffix), compressed)
+        return basename + suffix, checksum_data(compressed)
+
+    if pool is None:
+        pool = ThreadPool(len(COMPRESSORS))
+        try:
+            written = dict(pool.map(write_variant, COMPRESSORS))
+        finally:
+            pool.close()
+    else:
+        written = dict(pool.map(write_variant, COMPRESSORS))
+
+    if by_hash:
+        update_by_hash(dirpath, written)
+
+    return written
+
+
+def update_by_hash(dirpath, written):
+    """Link the files just written into dirpath/by-hash/SHA256/
+
+    Older generations are kept for a while for the benefit of clients
+    that fetched the previous Release file."""
+    by_hash_dir = os.path.join(dirpath, 'by-hash', 'SHA256')
+    if not os.path.isdir(by_hash_dir):
+        os.makedirs(by_hash_dir)
+
+    for name, checksums in written.items():
+        target = os.path.join(by_hash_dir, checksums['sha256'])
+        if not os.path.exists(target):
+            os.link(os.path.join(dirpath, name), target)
+
+    current = set(checksums['sha256'] for checksums in written.values())
+    entries = sorted([(os.stat(os.path.join(by_hash_dir, f)).st_mtime, f)
+                      for f in os.listdir(by_hash_dir) if f not in current],
+                     reverse=True)
+    keep = len(written) * (BY_HASH_GENERATIONS - 1)
+    for mtime, f in entries[keep:]:
+        os.unlink(os.path.join(by_hash_dir, f))
+
+
+def release_file(fields, files):
+    """Render a Release file
+
+    fields is a list of (name, value) pairs for the header. files maps
+    paths relative to the Release file to their checksums."""
+    lines = ['%s: %s' % (k, v) for k, v in fields]
+    lines.append('Date: %s' % (email.utils.formatdate(usegmt=True),))
+    lines.append('Acquire-By-Hash: yes')
+    for field, key in CHECKSUM_FIELDS:
+        lines.append('%s:' % (field,))
+        for path in sorted(files):
+            lines.append(' %s %16d %s' % (files[path][key], files[path]['size'], path))
+    return '\n'.join(lines) + '\n'
@@ -7,6 +7,7 @@ class BuildSvcAuthzBackend(object):
     known_app_models = (('buildsvc', 'repository'),
                         ('buildsvc', 'packagesource'),
                         ('buildsvc', 'externaldependency'),
+                        ('buildsvc', 'repositorysnapshot'),
                         ('mirrorsvc', 'mirror'),
                         ('mirrorsvc', 'mirrorset'),
                         ('mirrorsvc', 'snapshot'))
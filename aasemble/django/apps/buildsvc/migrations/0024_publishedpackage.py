@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.1 on 2026-10-18 09:12
+from __future__ import unicode_literals
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('buildsvc', '0023_auto_20160128_1603'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PublishedPackage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('component', models.CharField(default='main', max_length=100)),
+                ('architecture', models.CharField(max_length=50)),
+                ('name', models.CharField(max_length=200)),
+                ('version', models.CharField(max_length=200)),
+                ('source_name', models.CharField(max_length=200)),
+                ('filename', models.CharField(max_length=500)),
+                ('size', models.BigIntegerField()),
+                ('sha256', models.CharField(max_length=64)),
+                ('control', models.TextField()),
+                ('files', models.TextField()),
+                ('published', models.DateTimeField(auto_now_add=True)),
+                ('build_record', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='buildsvc.BuildRecord')),
+                ('series', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='packages', to='buildsvc.Series')),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='publishedpackage',
+            index_together=set([('series', 'component', 'architecture')]),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.1 on 2026-10-18 10:41
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('buildsvc', '0025_pooledkey'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='repository',
+            name='keep_logs_days',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='repository',
+            name='keep_versions',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.1 on 2026-10-18 11:20
+from __future__ import unicode_literals
+
+import uuid
+
+from django.db import migrations, models
+
+
+def gen_uuid(apps, schema_editor):
+    PublishedPackage = apps.get_model('buildsvc', 'PublishedPackage')
+    for row in PublishedPackage.objects.all():
+        row.uuid = uuid.uuid4()
+        row.save()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('buildsvc', '0026_repository_retention'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='publishedpackage',
+            name='uuid',
+            field=models.UUIDField(editable=False, null=True),
+        ),
+        migrations.RunPython(gen_uuid, reverse_code=migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='publishedpackage',
+            name='uuid',
+            field=models.UUIDField(default=uuid.uuid4, editable=False, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='publishedpackage',
+            name='name',
+            field=models.CharField(db_index=True, max_length=200),
+        ),
+        migrations.AlterField(
+            model_name='publishedpackage',
+            name='source_name',
+            field=models.CharField(db_index=True, max_length=200),
+        ),
+        migrations.AlterIndexTogether(
+            name='publishedpackage',
+            index_together=set([('series', 'component', 'architecture'), ('series', 'name')]),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.1 on 2026-10-18 11:52
+from __future__ import unicode_literals
+
+import uuid
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('buildsvc', '0027_publishedpackage_uuid'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RepositorySnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('uuid', models.UUIDField(default=uuid.uuid4, editable=False, unique=True)),
+                ('timestamp', models.DateTimeField(auto_now_add=True)),
+                ('ready', models.BooleanField(default=False)),
+                ('repository', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='snapshots', to='buildsvc.Repository')),
+            ],
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.1 on 2026-10-18 14:02
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('buildsvc', '0028_repositorysnapshot'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='repository',
+            name='config_generation',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
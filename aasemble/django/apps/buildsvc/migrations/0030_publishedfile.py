@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.2 on 2026-10-19 00:55
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def record_published_files(apps, schema_editor):
+    PublishedPackage = apps.get_model("buildsvc", "PublishedPackage")
+    PublishedFile = apps.get_model("buildsvc", "PublishedFile")
+    for package in PublishedPackage.objects.iterator():
+        PublishedFile.objects.bulk_create([PublishedFile(package=package, path=path)
+                                           for path in package.files.split('\n') if path])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('buildsvc', '0029_repository_config_generation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PublishedFile',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(db_index=True, max_length=500)),
+                ('package', models.ForeignKey(on_delete=models.CASCADE, related_name='pool_files', to='buildsvc.PublishedPackage')),
+            ],
+        ),
+        migrations.RunPython(record_published_files, reverse_code=migrations.RunPython.noop),
+    ]
@@ -1,5 +1,8 @@
 from .build_record import BuildRecord  # noqa
 from .external_dependency import ExternalDependency  # noqa
 from .package_source import PackageSource  # noqa
+from .pooled_key import PooledKey  # noqa
+from .published_package import PublishedFile, PublishedPackage  # noqa
 from .repository import Repository  # noqa
+from .repository_snapshot import RepositorySnapshot  # noqa
 from .series import Series  # noqa
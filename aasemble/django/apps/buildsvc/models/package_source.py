@@ -154,12 +154,10 @@ class PackageSource(models.Model):
             br.build_finished = now()
             br.save()
 
-            changes_files = filter(lambda s: s.endswith('.changes'), os.listdir(tmpdir))
+            changes_files = [os.path.join(tmpdir, f) for f in os.listdir(tmpdir) if f.endswith('.changes')]
 
-            for changes_file in changes_files:
-                self.series.process_changes(os.path.join(tmpdir, changes_file))
-
-            self.series.export()
+            if changes_files:
+                self.series.repository.enqueue_publish(self.series.name, changes_files, br)
 
     def increment_build_counter(self):
         with transaction.atomic():
@@ -0,0 +1,51 @@
+import logging
+import os.path
+
+from django.conf import settings
+from django.db import models
+
+from aasemble.django.apps.buildsvc.repodrivers import get_repo_driver_class
+from aasemble.utils import ensure_dir, file_lock
+
+LOG = logging.getLogger(__name__)
+
+
+class PooledKey(models.Model):
+    """A pre-generated signing key waiting for a new repository to claim it"""
+    key_id = models.CharField(max_length=100)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ('created',)
+
+    @classmethod
+    def target_depth(cls):
+        return getattr(settings, 'BUILDSVC_KEY_POOL_SIZE', 5)
+
+    @classmethod
+    def claim(cls):
+        """Take the oldest key out of the pool
+
+        Returns its key id, or None if the pool is empty."""
+        for key in cls.objects.all()[:10]:
+            # Whoever gets to delete the row owns the key
+            deleted, _ = cls.objects.filter(id=key.id).delete()
+            if deleted:
+                LOG.info('Claimed pooled key %s. Key pool depth: %d/%d' % (key.key_id, cls.objects.count(), cls.target_depth()))
+                return key.key_id
+        LOG.warning('Key pool is empty')
+        return None
+
+    @classmethod
+    def refill(cls):
+        lockfile = os.path.join(ensure_dir(settings.BUILDSVC_REPOS_BASE_DIR), '.keypool.lock')
+        with file_lock(lockfile, blocking=False) as acquired:
+            if not acquired:
+                # Someone else is already refilling the pool
+                return
+
+            driver_class = get_repo_driver_class()
+            while cls.objects.count() < cls.target_depth():
+                cls.objects.create(key_id=driver_class.generate_pool_key())
+
+        LOG.info('Key pool depth: %d/%d' % (cls.objects.count(), cls.target_depth()))
@@ -0,0 +1,53 @@
+import uuid
+
+from django.db import models
+from django.utils.encoding import python_2_unicode_compatible
+
+from aasemble.django.apps.buildsvc.models.build_record import BuildRecord
+from aasemble.django.apps.buildsvc.models.series import Series
+
+
+@python_2_unicode_compatible
+class PublishedPackage(models.Model):
+    """A binary or source package published into a series
+
+    Source packages have architecture 'source'. control holds the complete
+    stanza for the Packages or Sources index, and files the pool paths
+    (relative to the repository's outdir) of every file belonging to the
+    package, one per line."""
+    uuid = models.UUIDField(unique=True, default=uuid.uuid4, editable=False)
+    series = models.ForeignKey(Series, related_name='packages')
+    component = models.CharField(max_length=100, default='main')
+    architecture = models.CharField(max_length=50)
+    name = models.CharField(max_length=200, db_index=True)
+    version = models.CharField(max_length=200)
+    source_name = models.CharField(max_length=200, db_index=True)
+    filename = models.CharField(max_length=500)
+    size = models.BigIntegerField()
+    sha256 = models.CharField(max_length=64)
+    control = models.TextField()
+    files = models.TextField()
+    build_record = models.ForeignKey(BuildRecord, null=True, blank=True, on_delete=models.SET_NULL)
+    published = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        index_together = (('series', 'component', 'architecture'),
+                          ('series', 'name'))
+
+    def __str__(self):
+        return '%s_%s_%s' % (self.name, self.version, self.architecture)
+
+    def file_list(self):
+        return [f for f in self.files.split('\n') if f]
+
+    def save(self, *args, **kwargs):
+        super(PublishedPackage, self).save(*args, **kwargs)
+        PublishedFile.objects.filter(package=self).delete()
+        PublishedFile.objects.bulk_create([PublishedFile(package=self, path=path) for path in self.file_list()])
+
+
+class PublishedFile(models.Model):
+    """A pool file of a PublishedPackage, one per line of its files, so the
+    packages using a file can be looked up by its exact path"""
+    package = models.ForeignKey(PublishedPackage, related_name='pool_files', on_delete=models.CASCADE)
+    path = models.CharField(max_length=500, db_index=True)
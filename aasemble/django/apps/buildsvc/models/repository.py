@@ -7,7 +7,9 @@ from django.db import models
 from django.utils.encoding import python_2_unicode_compatible
 
 from aasemble.django.apps.buildsvc import tasks
+from aasemble.django.apps.buildsvc.publishqueue import PublishQueue
 from aasemble.django.apps.buildsvc.repodrivers import get_repo_driver
+from aasemble.django.apps.buildsvc.retention import GarbageCollector
 from aasemble.utils import ensure_dir
 
 
@@ -19,6 +21,11 @@ class Repository(models.Model):
     key_id = models.CharField(max_length=100)
     key_data = models.TextField(null=False)
     extra_admins = models.ManyToManyField(auth_models.Group)
+    keep_versions = models.PositiveIntegerField(default=0)
+    keep_logs_days = models.PositiveIntegerField(default=0)
+    # Bumped whenever the repository or its series change. See
+    # RepreproDriver.ensure_directory_structure
+    config_generation = models.PositiveIntegerField(default=0, editable=False)
 
     class Meta:
         verbose_name_plural = 'repositories'
@@ -69,10 +76,41 @@ class Repository(models.Model):
     def process_changes(self, series_name, changes_file):
         return get_repo_driver(self).process_changes(series_name, changes_file)
 
+    def publish(self):
+        """Start a publish transaction. See repodrivers.PublishTransaction"""
+        self.first_series()
+        return get_repo_driver(self).transaction()
+
+    def enqueue_publish(self, series_name, changes_files, build_record=None):
+        PublishQueue(self).enqueue(series_name, changes_files, build_record)
+        tasks.publish.delay(self.id)
+
+    def drain_publish_queue(self):
+        PublishQueue(self).drain()
+
+    def promote(self, series_name, package_ids):
+        """Schedule publishing already published packages into series_name"""
+        tasks.promote.delay(self.id, series_name, list(package_ids))
+
+    def promote_real(self, series_name, package_ids):
+        with self.publish() as txn:
+            for package_id in package_ids:
+                txn.promote(series_name, package_id)
+
+    def collect_garbage(self):
+        return GarbageCollector(self).run()
+
     def save(self, *args, **kwargs):
         super(Repository, self).save(*args, **kwargs)
         tasks.export.delay(self.id)
 
+    def config_changed(self):
+        Repository.objects.filter(id=self.id).update(config_generation=models.F('config_generation') + 1)
+
+    def current_config_generation(self):
+        """config_generation as currently stored, without reloading anything else"""
+        return Repository.objects.filter(id=self.id).values_list('config_generation', flat=True)[0]
+
     @property
     def base_url(self):
         return '%s/%s/%s' % (settings.BUILDSVC_REPOS_BASE_URL,
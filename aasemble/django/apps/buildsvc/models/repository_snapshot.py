@@ -0,0 +1,68 @@
+import logging
+import os.path
+import shutil
+import uuid
+
+from django.db import models
+from django.utils.encoding import python_2_unicode_compatible
+
+from aasemble.django.apps.buildsvc import tasks
+from aasemble.django.apps.buildsvc.models.repository import Repository
+from aasemble.django.apps.buildsvc.repodrivers import get_repo_driver
+from aasemble.utils import ensure_dir
+
+LOG = logging.getLogger(__name__)
+
+
+@python_2_unicode_compatible
+class RepositorySnapshot(models.Model):
+    """A frozen copy of a repository
+
+    Only dists/ is copied. The pool is hardlinked, so a snapshot costs
+    next to nothing in disk space and keeps working after the packages in
+    it are removed from the repository."""
+    uuid = models.UUIDField(unique=True, default=uuid.uuid4, editable=False)
+    repository = models.ForeignKey(Repository, related_name='snapshots')
+    timestamp = models.DateTimeField(auto_now_add=True)
+    ready = models.BooleanField(default=False)
+
+    def __str__(self):
+        return '%s@%s' % (self.repository, self.timestamp)
+
+    @property
+    def basepath(self):
+        return os.path.join(ensure_dir(os.path.join(self.repository.outdir(), 'snapshots')), str(self.uuid))
+
+    @property
+    def base_url(self):
+        return '%s/snapshots/%s' % (self.repository.base_url, self.uuid)
+
+    def save(self, *args, **kwargs):
+        perform_snapshot = self.pk is None
+
+        super(RepositorySnapshot, self).save(*args, **kwargs)
+
+        if perform_snapshot:
+            tasks.snapshot_repository.apply_async((self.id,), countdown=5)
+
+    def perform_snapshot(self):
+        if self.ready:
+            # Snapshots are immutable
+            return
+
+        tmpdir = '%s.tmp' % (self.basepath,)
+        if os.path.exists(tmpdir):
+            shutil.rmtree(tmpdir)
+
+        get_repo_driver(self.repository).snapshot(tmpdir)
+        os.rename(tmpdir, self.basepath)
+
+        RepositorySnapshot.objects.filter(id=self.id).update(ready=True)
+        LOG.info('Snapshot %s of %s is ready' % (self.uuid, self.repository))
+
+    def delete_on_filesystem(self):
+        if os.path.exists(self.basepath):
+            shutil.rmtree(self.basepath)
+
+    def user_can_modify(self, user):
+        return self.repository.user_can_modify(user)
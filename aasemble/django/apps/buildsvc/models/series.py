@@ -37,19 +37,30 @@ class Series(models.Model):
     def process_changes(self, changes_file):
         self.repository.process_changes(self.name, changes_file)
 
-    def build_sources_list(self):
+    def build_sources_list(self, external_dependencies=None):
+        if external_dependencies is None:
+            external_dependencies = self.externaldependency_set.all()
         sources = []
         for series in ('trusty', 'trusty-updates', 'trusty-security'):
             sources += ['deb http://archive.ubuntu.com/ubuntu {} main universe restricted multiverse'.format(series)]
         sources += [self.binary_source_list(force_trusted=True)]
-        sources += sum([extdep.deb_lines for extdep in self.externaldependency_set.all()], [])
+        sources += sum([extdep.deb_lines for extdep in external_dependencies], [])
         return '\n'.join(sources)
 
-    def build_apt_keys(self):
+    def build_apt_keys(self, external_dependencies=None):
+        if external_dependencies is None:
+            external_dependencies = self.externaldependency_set.all()
         keys = [self.repository.key_data]
-        keys += [extdep.key for extdep in self.externaldependency_set.all()]
+        keys += [extdep.key for extdep in external_dependencies]
         return '\n'.join(keys)
 
+    def build_environment(self):
+        """Sources list and apt keys for builds in this series, with a single
+        query for the external dependencies"""
+        external_dependencies = list(self.externaldependency_set.all())
+        return {'sources_list': self.build_sources_list(external_dependencies),
+                'apt_keys': self.build_apt_keys(external_dependencies)}
+
     def export(self):
         self.repository.export()
 
@@ -22,6 +22,9 @@ import yaml
 
 LOG = logging.getLogger(__name__)
 
+METADATA_CACHE = '.aasemble-metadata.json'
+MANIFEST_CACHE = '.aasemble-manifest.json'
+
 
 class BuilderBackend(object):
     def __init__(self, proxy=None, parallel=1):
@@ -57,8 +60,8 @@ def get_build_backend(backend_name, **kwargs):
         return DbuildBuilderBackend(**kwargs)
 
 
-def fetch_build_http(url):
-    return requests.get(url).json()
+def fetch_build_http(url, session=requests):
+    return session.get(url).json()
 
 
 def fetch_build_file(path):
@@ -74,17 +77,58 @@ def fetch_build(build_id):
     return None
 
 
+def fetch_manifest_http(url, session=requests):
+    resp = session.get(url.rstrip('/') + '/manifest/')
+    if resp.status_code == 404:
+        # Older servers have no manifest endpoint
+        return {'build': fetch_build_http(url, session)}
+    resp.raise_for_status()
+    return resp.json()
+
+
+def fetch_manifest(build_id, basedir, session=requests):
+    """Fetch build record, sources list and apt keys for a build
+
+    Over HTTP, this is one request to the build's manifest endpoint. The
+    result is cached in basedir, so subsequent actions for the same build
+    need no network access."""
+    if not (build_id.startswith('http://') or build_id.startswith('https://')):
+        return {'build': fetch_build(build_id)}
+
+    cache_path = os.path.join(basedir, MANIFEST_CACHE)
+    if os.path.exists(cache_path):
+        with open(cache_path, 'r') as fp:
+            cached = json.load(fp)
+        if cached.get('url') == build_id:
+            return cached['manifest']
+
+    manifest = fetch_manifest_http(build_id, session)
+
+    if os.path.isdir(basedir):
+        with open(cache_path, 'w') as fp:
+            json.dump({'url': build_id, 'manifest': manifest}, fp)
+
+    return manifest
+
+
+class MetadataError(Exception):
+    pass
+
+
 class PackageBuilder(object):
     def __init__(self, basedir, build_record, backend_name='dbuild',
                  full_name='Name not specified', email='build@example.com', **kwargs):
         self.basedir = basedir
         self.build_dependencies = []
         self.runtime_dependencies = []
-        self.build_record = fetch_build(build_record)
+        self.session = requests.Session()
+        self.manifest = fetch_manifest(build_record, basedir, self.session)
+        self.build_record = self.manifest['build']
         self.full_name = full_name
         self.email = email
         self.logger = LOG
         self.backend = get_build_backend(backend_name, **kwargs)
+        self._metadata = None
 
     @property
     def builddir(self):
@@ -131,12 +175,17 @@ class PackageBuilder(object):
     def build_external_dependency_repo_keys(self):
         """create a file which has all external dependency repos keys"""
         with open(os.path.join(self.basedir, 'keys'), 'wb') as fp:
-            fp.write(requests.get(self.build_record['source']['repository_info']['build_apt_keys']).content)
+            fp.write(self._manifest_item('apt_keys', 'build_apt_keys'))
 
     def build_external_dependency_repo_sources(self):
         """create a file which has all external dependency repo sources"""
         with open(os.path.join(self.basedir, 'repos'), 'wb') as fp:
-            fp.write(requests.get(self.build_record['source']['repository_info']['build_sources_list']).content)
+            fp.write(self._manifest_item('sources_list', 'build_sources_list'))
+
+    def _manifest_item(self, key, repository_info_url):
+        if key in self.manifest:
+            return self.manifest[key].encode('utf-8')
+        return self.session.get(self.build_record['source']['repository_info'][repository_info_url]).content
 
     def docker_build_source_package(self):
         """Build source package in docker"""
@@ -208,13 +257,51 @@ class PackageBuilder(object):
             fp.write(rendered)
             fp.write(current_changelog)
 
+    @property
+    def metadata_cache_path(self):
+        return os.path.join(self.basedir, METADATA_CACHE)
+
+    @property
+    def metadata(self):
+        """Package name and native version, extracted once per build
+
+        The result is kept in memory and in the build's basedir, so that the
+        separate aasemble-pkgbuild invocations for a single build only pay
+        for the extraction once."""
+        if self._metadata is None:
+            self._metadata = self.load_metadata()
+        return self._metadata
+
+    def load_metadata(self):
+        sha = self.build_record['sha']
+
+        if os.path.exists(self.metadata_cache_path):
+            with open(self.metadata_cache_path, 'r') as fp:
+                metadata = json.load(fp)
+            if metadata.get('sha') == sha:
+                return metadata
+
+        metadata = self.detect_metadata()
+        metadata['sha'] = sha
+
+        if os.path.isdir(self.builddir):
+            with open(self.metadata_cache_path, 'w') as fp:
+                json.dump(metadata, fp)
+
+        return metadata
+
+    def detect_metadata(self):
+        """Extract package name and native version from the source tree"""
+        return {'name': self.name,
+                'native_version': None}
+
     @property
     def sanitized_package_name(self):
         return self.package_name.replace('_', '-')
 
     @property
     def package_name(self):
-        return self.name
+        return self.metadata['name']
 
     @property
     def binary_pkg_name(self):
@@ -252,7 +339,7 @@ class PackageBuilder(object):
 
     @property
     def native_version(self):
-        return None
+        return self.metadata['native_version']
 
     @classmethod
     def is_suitable(cls, path):
@@ -2,6 +2,7 @@ from __future__ import absolute_import
 
 import os.path
 
+import debian.changelog
 import debian.deb822
 
 from aasemble.django.apps.buildsvc.pkgbuild import PackageBuilder, PackageBuilderRegistry
@@ -13,21 +14,27 @@ class DebianBuilder(PackageBuilder):
     def is_suitable(cls, path):
         return os.path.isdir(os.path.join(path, 'debian'))
 
-    @property
-    def native_version(self):
-        cmd = ['dpkg-parsechangelog', '--show-field', 'Version']
-        v = run_cmd(cmd, cwd=self.builddir).strip().decode()
+    def detect_metadata(self):
+        with open(os.path.join(self.builddir, 'debian/control'), 'r') as fp:
+            ctrl = debian.deb822.Deb822(fp)
+
+        return {'name': ctrl['Source'],
+                'native_version': self.detect_native_version()}
+
+    def detect_native_version(self):
+        try:
+            with open(os.path.join(self.builddir, 'debian/changelog'), 'r') as fp:
+                v = str(debian.changelog.Changelog(fp, max_blocks=1, strict=True).version)
+        except (debian.changelog.ChangelogParseError, ValueError):
+            cmd = ['dpkg-parsechangelog', '--show-field', 'Version']
+            v = run_cmd(cmd, cwd=self.builddir).strip().decode()
+
         if ':' in v:
             v = v.split(':')[1]
         if '-' in v:
             v = v.split('-')[0]
         return v
 
-    @property
-    def package_name(self):
-        ctrl = debian.deb822.Deb822(open(os.path.join(self.builddir, 'debian/control'), 'r'))
-        return ctrl['Source']
-
     def populate_debian_dir(self):
         pass
 
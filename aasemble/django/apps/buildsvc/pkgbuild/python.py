@@ -1,8 +1,11 @@
 import os.path
+import re
 
 from django.template.loader import render_to_string
 
-from aasemble.django.apps.buildsvc.pkgbuild import PackageBuilder, PackageBuilderRegistry
+from six.moves import configparser
+
+from aasemble.django.apps.buildsvc.pkgbuild import MetadataError, PackageBuilder, PackageBuilderRegistry
 from aasemble.utils import run_cmd
 
 
@@ -11,27 +14,90 @@ class PythonBuilder(PackageBuilder):
     def is_suitable(cls, path):
         return os.path.exists(os.path.join(path, 'setup.py'))
 
-    def retry_if_has_newlines(self, cmd, logger):
+    def retry_if_has_newlines(self, cmd, logger, expected_lines=1):
         """Sometimes the first run will have noise in it"""
         def run_it():
             return run_cmd(cmd, cwd=self.builddir, discard_stderr=True, logger=logger).strip()
 
         out = run_it()
 
-        if '\n' in out:
+        if out.count(b'\n') >= expected_lines:
             out = run_it()
 
         return out.decode()
 
-    @property
-    def native_version(self):
-        return self.retry_if_has_newlines(['python', 'setup.py', '--version'],
-                                          logger=self.logger)
-
-    @property
-    def package_name(self):
-        return self.retry_if_has_newlines(['python', 'setup.py', '--name'],
-                                          logger=self.logger)
+    def detect_metadata(self):
+        metadata = self.static_metadata()
+        if metadata.get('name') and metadata.get('version'):
+            return {'name': metadata['name'],
+                    'native_version': metadata['version']}
+
+        out = self.retry_if_has_newlines(['python', 'setup.py', '--name', '--version'],
+                                         logger=self.logger, expected_lines=2)
+        lines = [line.strip() for line in out.split('\n')]
+        if len(lines) >= 2 and all(lines[-2:]):
+            name, version = lines[-2:]
+        else:
+            # An empty name or version leaves a single line, and which one
+            # it is cannot be told
+            self.logger.info('python setup.py --name --version printed %r. Asking for each separately.' % (out,))
+            name, version = self.setup_py_field('name'), self.setup_py_field('version')
+        return {'name': name,
+                'native_version': version}
+
+    def setup_py_field(self, field):
+        out = self.retry_if_has_newlines(['python', 'setup.py', '--%s' % (field,)], logger=self.logger)
+        value = out.split('\n')[-1].strip()
+        if not value:
+            raise MetadataError('python setup.py --%s printed no %s for %s' % (field, field, self.builddir))
+        return value
+
+    def static_metadata(self):
+        """Name and version as declared in setup.cfg or pyproject.toml
+
+        Values that need code to be evaluated (e.g. "attr:" references or
+        versions derived from git by pbr) are left out."""
+        metadata = {}
+        metadata.update(self.pyproject_metadata())
+        for k, v in self.setup_cfg_metadata().items():
+            metadata.setdefault(k, v)
+        return metadata
+
+    def setup_cfg_metadata(self):
+        setup_cfg = os.path.join(self.builddir, 'setup.cfg')
+        parser = configparser.RawConfigParser()
+        try:
+            parser.read(setup_cfg)
+        except configparser.Error:
+            return {}
+
+        metadata = {}
+        for key in ('name', 'version'):
+            if parser.has_option('metadata', key):
+                value = parser.get('metadata', key).strip()
+                if value and ':' not in value:
+                    metadata[key] = value
+        return metadata
+
+    def pyproject_metadata(self):
+        pyproject = os.path.join(self.builddir, 'pyproject.toml')
+        if not os.path.exists(pyproject):
+            return {}
+
+        metadata = {}
+        section = None
+        with open(pyproject, 'r') as fp:
+            for line in fp:
+                line = line.strip()
+                if line.startswith('['):
+                    section = line.strip('[]').strip()
+                    continue
+                if section != 'project':
+                    continue
+                m = re.match(r'^(name|version)\s*=\s*["\']([^"\']+)["\']', line)
+                if m:
+                    metadata[m.group(1)] = m.group(2)
+        return metadata
 
     @property
     def binary_pkg_name(self):
@@ -0,0 +1,127 @@
+import json
+import logging
+import os
+import os.path
+import shutil
+import time
+import uuid
+
+from debian import deb822
+
+from django.conf import settings
+
+from aasemble.utils import ensure_dir, file_lock
+from aasemble.utils.exceptions import ChecksumMismatch, CommandFailed
+
+LOG = logging.getLogger(__name__)
+
+
+def files_in_changes(changes_file):
+    with open(changes_file, 'r') as fp:
+        changes = deb822.Changes(fp)
+    return [f['name'] for f in changes.get('Files', [])]
+
+
+class PublishQueue(object):
+    """Spool of finished builds waiting to be published into a repository
+
+    Builds enqueue their artifacts and return. Whoever holds the drain lock
+    publishes everything pending in batches, one publish transaction (and
+    hence one export) per batch, so concurrent builds into the same
+    repository never contend for reprepro's lock."""
+    def __init__(self, repository):
+        self.repository = repository
+
+    @property
+    def spooldir(self):
+        return ensure_dir(os.path.join(settings.BUILDSVC_REPOS_BASE_DIR,
+                                       self.repository.user.username,
+                                       self.repository.name,
+                                       'incoming'))
+
+    @property
+    def batch_size(self):
+        return getattr(settings, 'BUILDSVC_PUBLISH_BATCH_SIZE', 20)
+
+    def enqueue(self, series_name, changes_files, build_record=None):
+        """Move changes_files and the files they list into the spool"""
+        # Entries are published in the order their names sort in
+        entry_id = '%017.6f-%s' % (time.time(), uuid.uuid4().hex)
+        tmpdir = ensure_dir(os.path.join(self.spooldir, '.tmp-%s' % (entry_id,)))
+
+        for changes_file in changes_files:
+            srcdir = os.path.dirname(changes_file)
+            for name in files_in_changes(changes_file):
+                shutil.move(os.path.join(srcdir, name), os.path.join(tmpdir, name))
+            shutil.move(changes_file, os.path.join(tmpdir, os.path.basename(changes_file)))
+
+        with open(os.path.join(tmpdir, 'entry.json'), 'w') as fp:
+            json.dump({'series': series_name,
+                       'changes': [os.path.basename(f) for f in changes_files],
+                       'build_record': build_record and build_record.id}, fp)
+
+        # Entries only become visible once complete
+        entrydir = os.path.join(self.spooldir, entry_id)
+        os.rename(tmpdir, entrydir)
+        return entrydir
+
+    def pending(self):
+        return [os.path.join(self.spooldir, name)
+                for name in sorted(os.listdir(self.spooldir))
+                if not name.startswith('.')]
+
+    def drain(self):
+        while self.pending():
+            with file_lock(os.path.join(self.spooldir, '.drain.lock'), blocking=False) as acquired:
+                if not acquired:
+                    # Someone else is draining. They check for new entries
+                    # after releasing the lock, so ours will not get lost.
+                    return
+
+                while True:
+                    batch = self.pending()[:self.batch_size]
+                    if not batch:
+                        break
+                    self.publish_batch(batch)
+
+    def publish_batch(self, batch):
+        try:
+            self.publish(batch)
+        except (ChecksumMismatch, CommandFailed):
+            if len(batch) == 1:
+                self.failed(batch[0])
+                return
+
+            LOG.warning('Publishing a batch of %d into %s failed. Retrying one by one.' % (len(batch), self.repository))
+            for entrydir in batch:
+                self.publish_batch([entrydir])
+
+    def publish(self, batch):
+        entries = [self.load_entry(entrydir) for entrydir in batch]
+
+        with self.repository.publish() as txn:
+            for entrydir, entry in zip(batch, entries):
+                for changes_file in entry['changes']:
+                    txn.include(entry['series'], os.path.join(entrydir, changes_file),
+                                build_record_id=entry['build_record'])
+
+        LOG.info('Published %d queued builds into %s' % (len(batch), self.repository))
+
+        for entrydir in batch:
+            shutil.rmtree(entrydir)
+
+    def failed(self, entrydir):
+        from aasemble.django.apps.buildsvc.models import BuildRecord
+
+        entry = self.load_entry(entrydir)
+        LOG.error('Failed to publish %s into %s' % (entry['changes'], self.repository))
+
+        if entry['build_record']:
+            BuildRecord.objects.filter(id=entry['build_record']).update(state=BuildRecord.FAILED_TO_UPLOAD)
+
+        faileddir = ensure_dir(os.path.join(self.spooldir, '.failed'))
+        os.rename(entrydir, os.path.join(faileddir, os.path.basename(entrydir)))
+
+    def load_entry(self, entrydir):
+        with open(os.path.join(entrydir, 'entry.json'), 'r') as fp:
+            return json.load(fp)
@@ -1,14 +1,21 @@
+import contextlib
+import json
 import logging
 import os.path
+import shutil
+import time
+import uuid
 
-import deb822
+from debian import deb822, debfile
 
 from django.conf import settings
 from django.template.loader import render_to_string
 from django.utils.module_loading import import_string
 
-from aasemble.django.utils import recursive_render
-from aasemble.utils import ensure_dir, run_cmd
+from aasemble.django.apps.buildsvc import aptindex
+from aasemble.django.apps.buildsvc.signing import Signer
+from aasemble.django.utils import recursive_render, tree_digest
+from aasemble.utils import BlobStore, ensure_dir, file_lock, hardlink_tree, run_cmd
 
 LOG = logging.getLogger(__name__)
 
@@ -27,38 +34,114 @@ def remove_ddebs_from_changes(changes_file):
         fp.write(changes.dump())
 
 
+def get_blob_store():
+    """The pool files of all repositories are hardlinks into this store"""
+    return BlobStore(os.path.join(settings.BUILDSVC_REPOS_BASE_PUBLIC_DIR, '.blobs'))
+
+
+class PublishTransaction(object):
+    """A batch of changes to a repository
+
+    Operations are queued and applied by the repository driver on commit,
+    which exports (and signs) the repository exactly once. Used as a context
+    manager, the transaction commits when the block exits without an
+    exception."""
+    def __init__(self, driver):
+        self.driver = driver
+        self.operations = []
+
+    def include(self, series_name, changes_file, build_record_id=None):
+        self.operations.append(('include', series_name, changes_file, build_record_id))
+
+    def remove_source(self, series_name, source_name):
+        self.operations.append(('removesrc', series_name, source_name))
+
+    def remove_version(self, series_name, source_name, version):
+        """Remove version of source_name and the binaries built from it"""
+        self.operations.append(('removeversion', series_name, (source_name, version)))
+
+    def promote(self, series_name, package_id):
+        """Publish an already published package (of any repository) into series_name"""
+        self.operations.append(('promote', series_name, package_id))
+
+    def commit(self):
+        operations, self.operations = self.operations, []
+        return self.driver.commit(operations)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc, value, tb):
+        if exc is None:
+            self.commit()
+
+
 class RepositoryDriver(object):
     def __init__(self, repository):
         self.repository = repository
 
     def ensure_key(self):
         if not self.repository.key_id:
-            self.repository.key_id = self.generate_key()
+            self.repository.key_id = self.claim_pooled_key() or self.generate_key()
             self.repository.save()
         if not self.repository.key_data:
             self.repository.key_data = self.repository._key_data()
             self.repository.save()
 
+    def claim_pooled_key(self):
+        from aasemble.django.apps.buildsvc import tasks
+        from aasemble.django.apps.buildsvc.models import PooledKey
+
+        key_id = PooledKey.claim()
+        tasks.refill_key_pool.delay()
+        return key_id
+
+    def transaction(self):
+        return PublishTransaction(self)
+
+    def collect_garbage(self):
+        pass
+
+    def process_changes(self, series_name, changes_file):
+        with self.transaction() as txn:
+            txn.include(series_name, changes_file)
+
 
 class FakeDriver(RepositoryDriver):
     def generate_key(self):
         return 'FAKEID'
 
+    @classmethod
+    def generate_pool_key(cls):
+        return 'FAKEID'
+
     def key_data(self):
         return self.repository.key_id * 50
 
     def export(self):
-        pass
+        return {}
 
-    def process_changes(self, series_name, changes_file):
-        pass
+    def commit(self, operations):
+        return {}
+
+    def snapshot(self, destdir):
+        ensure_dir(destdir)
 
 
 class RepreproDriver(RepositoryDriver):
     def generate_key(self):
         LOG.info('Generating key for %s' % (self.repository))
+        return self.generate_named_key('%s repository' % (self.repository.name,))
+
+    @classmethod
+    def generate_pool_key(cls):
+        LOG.info('Generating key for the key pool')
+        return cls.generate_named_key('aaSemble repository')
+
+    @staticmethod
+    def generate_named_key(name):
         gpg_input = render_to_string('buildsvc/gpg-keygen-input.tmpl',
-                                     {'repository': self.repository})
+                                     {'name': name})
         output = run_cmd(['gpg', '--batch', '--gen-key'], input=gpg_input)
 
         for l in output.split('\n'):
@@ -67,11 +150,7 @@ class RepreproDriver(RepositoryDriver):
 
     def key_data(self):
         if self.repository.key_id:
-            env = {'GNUPG_HOME': self.gpghome()}
-            return run_cmd(['gpg', '-a', '--export', self.repository.key_id], override_env=env)
-
-    def gpghome(self):
-        return os.path.join(self.basedir, '.gnupg')
+            return run_cmd(['gpg', '-a', '--export', self.repository.key_id])
 
     @property
     def basedir(self):
@@ -80,21 +159,293 @@ class RepreproDriver(RepositoryDriver):
         return ensure_dir(basedir)
 
     def export(self):
+        """Export the indices of the repository
+
+        Returns the latencies of signing them, as sign_releases() does."""
+        with self.lock():
+            return self._export()
+
+    def _export(self):
+        """export(), for callers that hold the lock already"""
         self.ensure_key()
         self.ensure_directory_structure()
         self.export_key()
-        self._reprepro('export')
+        with self.staged_dists() as distsdir:
+            self._reprepro('--distdir', distsdir, 'export')
+            return self.sign_releases([os.path.join(distsdir, series.name, 'Release')
+                                       for series in self.repository.series.all()])
 
-    def process_changes(self, series_name, changes_file):
-        self.ensure_directory_structure()
-        remove_ddebs_from_changes(changes_file)
-        self._reprepro('--ignore=wrongdistribution', 'include', series_name, changes_file)
-        self.export()
+    def commit(self, operations):
+        with self.lock():
+            self.ensure_directory_structure()
+            for operation in operations:
+                self.apply(*operation)
+            # flock() locks are per open file, so taking the lock again
+            # in export() would deadlock
+            return self._export()
+
+    def apply(self, action, series_name, arg, build_record_id=None):
+        if action == 'include':
+            remove_ddebs_from_changes(arg)
+            checksums = self.verify_changes(arg)
+            self._reprepro('--export=never', '--ignore=wrongdistribution', 'include', series_name, arg)
+            checksums = self.dedupe_pool_files(arg, checksums=checksums)
+            self.record_changes(series_name, arg, checksums, build_record_id=build_record_id)
+        elif action == 'removesrc':
+            self._reprepro('--export=never', 'removesrc', series_name, arg)
+            self.remove_source_packages(series_name, arg)
+        elif action == 'removeversion':
+            self._reprepro('--export=never', 'removesrc', series_name, *arg)
+            self.remove_source_packages(series_name, *arg)
+        elif action == 'promote':
+            package = self.promoted_package(arg)
+            if package.architecture == 'source':
+                command = 'includedsc'
+            else:
+                command = 'includedeb'
+            self._reprepro('--export=never', command, series_name,
+                           os.path.join(package.series.repository.outdir(), package.filename))
+            blob_store = get_blob_store()
+            for path in package.file_list():
+                fullpath = os.path.join(self.repository.outdir(), path)
+                if os.path.exists(fullpath):
+                    blob_store.dedupe(fullpath)
+            self.record_promotion(series_name, package)
+        else:
+            raise ValueError('Unknown publish operation: %r' % (action,))
+
+    def promoted_package(self, package_id):
+        from aasemble.django.apps.buildsvc.models import PublishedPackage
+
+        return PublishedPackage.objects.select_related('series__repository__user').get(id=package_id)
+
+    def record_promotion(self, series_name, package):
+        """Record a copy of package as published in series_name"""
+        package.id = None
+        package.uuid = uuid.uuid4()
+        package.series = self.repository.series.get(name=series_name)
+        self.record_package(package)
+        return set([(series_name, package.component, package.architecture)])
+
+    def snapshot(self, destdir):
+        """Copy dists/ and hardlink the pool of the repository into destdir"""
+        outdir = self.repository.outdir()
+        with self.lock():
+            ensure_dir(destdir)
+            if os.path.isdir(os.path.join(outdir, 'dists')):
+                shutil.copytree(os.path.join(outdir, 'dists'), os.path.join(destdir, 'dists'), symlinks=True)
+            if os.path.isdir(os.path.join(outdir, 'pool')):
+                hardlink_tree(os.path.join(outdir, 'pool'), os.path.join(destdir, 'pool'))
+            if os.path.exists(os.path.join(outdir, 'repo.key')):
+                shutil.copy(os.path.join(outdir, 'repo.key'), destdir)
+
+    def collect_garbage(self):
+        with self.lock():
+            self._reprepro('tidytracks')
+            self._reprepro('deleteunreferenced')
+
+    @property
+    def verify_parallel(self):
+        return getattr(settings, 'BUILDSVC_VERIFY_PARALLEL', 4)
+
+    def verify_changes(self, changes_file):
+        return aptindex.verify_changes(changes_file, parallel=self.verify_parallel)
+
+    def dedupe_pool_files(self, changes_file, component='main', checksums=None):
+        """Replace the pool files reprepro just added with blob store links
+
+        checksums optionally maps file names to their already verified
+        checksums. Returns a dict mapping the name of each of the pool
+        files to its checksums."""
+        known = checksums or {}
+        with open(changes_file, 'r') as fp:
+            changes = deb822.Changes(fp)
+
+        directory = os.path.join(self.repository.outdir(),
+                                 aptindex.pool_dir(component, changes['Source'].split(' ')[0]))
+        checksums = {}
+        blob_store = get_blob_store()
+        for f in changes['Files']:
+            path = os.path.join(directory, f['name'])
+            if os.path.exists(path):
+                checksums[f['name']] = known.get(f['name']) or aptindex.checksum_file(path)
+                blob_store.dedupe(path, checksums[f['name']]['sha256'])
+        return checksums
+
+    def packages_from_changes(self, series, changes_file, checksums, component='main', build_record_id=None):
+        """Unsaved PublishedPackages for the packages listed in changes_file
+
+        checksums maps the names of the files in the .changes to their
+        checksums."""
+        from aasemble.django.apps.buildsvc.models import PublishedPackage
+
+        srcdir = os.path.dirname(changes_file)
+        with open(changes_file, 'r') as fp:
+            changes = deb822.Changes(fp)
+
+        source_name = changes['Source'].split(' ')[0]
+        directory = aptindex.pool_dir(component, source_name)
+
+        packages = []
+        for name in sorted(checksums):
+            path = os.path.join(srcdir, name)
+            filename = os.path.join(directory, name)
+            if name.endswith('.deb') or name.endswith('.udeb'):
+                control = debfile.DebFile(path).debcontrol()
+                packages.append(PublishedPackage(series=series, component=component,
+                                                 architecture=control['Architecture'],
+                                                 name=control['Package'], version=control['Version'],
+                                                 source_name=source_name, filename=filename,
+                                                 size=checksums[name]['size'], sha256=checksums[name]['sha256'],
+                                                 control=aptindex.binary_stanza(control, filename, checksums[name]),
+                                                 files=filename, build_record_id=build_record_id))
+            elif name.endswith('.dsc'):
+                with open(path, 'r') as fp:
+                    dsc = deb822.Dsc(fp)
+                files = [(name, checksums[name])]
+                files += [(f['name'], checksums.get(f['name']) or aptindex.checksum_file(os.path.join(self.repository.outdir(), directory, f['name'])))
+                          for f in dsc['Files']]
+                packages.append(PublishedPackage(series=series, component=component,
+                                                 architecture='source',
+                                                 name=dsc['Source'], version=dsc['Version'],
+                                                 source_name=source_name, filename=filename,
+                                                 size=checksums[name]['size'], sha256=checksums[name]['sha256'],
+                                                 control=aptindex.source_stanza(dsc, directory, files),
+                                                 files='\n'.join([os.path.join(directory, f) for f, c in files]),
+                                                 build_record_id=build_record_id))
+        return packages
+
+    def record_changes(self, series_name, changes_file, checksums, component='main', build_record_id=None):
+        """Record the packages in changes_file as published
+
+        Returns the set of (series, component, architecture) touched."""
+        series = self.repository.series.get(name=series_name)
+        dirty = set()
+        for package in self.packages_from_changes(series, changes_file, checksums, component, build_record_id):
+            self.record_package(package)
+            dirty.add((series.name, component, package.architecture))
+        return dirty
+
+    def record_package(self, package):
+        """Save package, replacing any other version of it in its series"""
+        from aasemble.django.apps.buildsvc.models import PublishedPackage
+
+        superseded = PublishedPackage.objects.filter(series=package.series,
+                                                     component=package.component,
+                                                     architecture=package.architecture,
+                                                     name=package.name)
+        superseded = list(superseded)
+        # Save first, so that files shared with the superseded packages
+        # are still referenced when those are forgotten
+        package.save()
+        self.forget_packages(superseded)
+
+    def remove_source_packages(self, series_name, source_name, version=None):
+        packages = self.repository.series.get(name=series_name).packages.filter(source_name=source_name)
+        if version is not None:
+            packages = packages.filter(version=version)
+        packages = list(packages)
+        self.forget_packages(packages)
+        return set((series_name, p.component, p.architecture) for p in packages)
+
+    def forget_packages(self, packages):
+        from aasemble.django.apps.buildsvc.models import PublishedPackage
+
+        PublishedPackage.objects.filter(id__in=[p.id for p in packages]).delete()
+
+    def lock(self):
+        return file_lock(os.path.join(self.basedir, '.publish.lock'))
+
+    @property
+    def dists_generations(self):
+        return getattr(settings, 'BUILDSVC_DISTS_GENERATIONS', 3)
+
+    @contextlib.contextmanager
+    def staged_dists(self, copy_current=False):
+        """Yields a new directory to export the indices into
+
+        dists/ in the public directory is a symlink. Once the block
+        completes, it is atomically switched over to the new directory, so
+        clients never see a partially exported repository. If copy_current
+        is set, the new directory starts out as a (hardlinked) copy of the
+        current one."""
+        outdir = self.repository.outdir()
+        generations = ensure_dir(os.path.join(outdir, '.dists'))
+        staging = os.path.join(generations, '%017.6f' % (time.time(),))
+
+        current = os.path.join(outdir, 'dists')
+        if copy_current and os.path.isdir(current):
+            hardlink_tree(current, staging)
+        else:
+            ensure_dir(staging)
+
+        try:
+            yield staging
+        except Exception:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+
+        self.publish_dists(staging)
+
+    def publish_dists(self, staging):
+        outdir = self.repository.outdir()
+        dists = os.path.join(outdir, 'dists')
+        generations = os.path.dirname(staging)
+
+        if os.path.isdir(dists) and not os.path.islink(dists):
+            # Exported before dists/ became a symlink
+            os.rename(dists, os.path.join(generations, '%017.6f' % (time.time() - 1,)))
+
+        tmplink = os.path.join(outdir, '.dists.new')
+        if os.path.lexists(tmplink):
+            os.unlink(tmplink)
+        os.symlink(os.path.relpath(staging, outdir), tmplink)
+        os.rename(tmplink, dists)
+
+        # Keep a few previous generations for clients that fetched the old
+        # Release file and are still downloading the indices it lists
+        old = sorted(name for name in os.listdir(generations) if name != os.path.basename(staging))
+        for name in old[:max(len(old) - self.dists_generations + 1, 0)]:
+            shutil.rmtree(os.path.join(generations, name), ignore_errors=True)
 
     def ensure_directory_structure(self):
+        """Render reprepro's configuration, unless it is already up to date
+
+        The configuration only depends on the repository and its series,
+        which bump the repository's config_generation whenever they change.
+        The generation it was last rendered for is kept in a marker file."""
         tmpl_dir = os.path.abspath(os.path.join(os.path.dirname(__file__),
                                    'templates/buildsvc/reprepro'))
+        marker = os.path.join(self.basedir, '.config-generation')
+        generation = '%d %s' % (self.repository.current_config_generation(), tree_digest(tmpl_dir))
+
+        if os.path.exists(marker):
+            with open(marker, 'r') as fp:
+                if fp.read() == generation:
+                    return
+
         recursive_render(tmpl_dir, self.basedir, {'repository': self.repository})
+        aptindex.write_atomically(marker, generation.encode('utf-8'))
+
+    def signer(self):
+        # Keys are generated in the default keyring, whether for a
+        # repository or for the key pool, so all repositories share it
+        # and one gpg-agent
+        return Signer(self.repository.key_id)
+
+    def sign_releases(self, release_paths):
+        """Sign release_paths with the repository's key
+
+        Returns a dict mapping each Release file to how long each of its
+        signatures took."""
+        if not self.repository.key_id:
+            return {}
+        latencies = self.signer().sign_releases(release_paths)
+        if latencies:
+            signatures = [latency for release in latencies.values() for latency in release.values()]
+            LOG.info('Signed %d Release files of %s: %d signatures, %.3fs in total, %.3fs at most' %
+                     (len(latencies), self.repository, len(signatures), sum(signatures), max(signatures)))
+        return latencies
 
     def export_key(self):
         keypath = os.path.join(self.repository.outdir(), 'repo.key')
@@ -103,12 +454,244 @@ class RepreproDriver(RepositoryDriver):
                 fp.write(self.repository.key_data)
 
     def _reprepro(self, *args):
-        env = {'GNUPG_HOME': self.gpghome()}
-        return run_cmd(['reprepro', '-b', self.basedir, '--waitforlock=10'] + list(args),
-                       override_env=env)
+        return run_cmd(['reprepro', '-b', self.basedir, '--waitforlock=10'] + list(args))
 
 
-def get_repo_driver(repository):
+class AptIndexDriver(RepreproDriver):
+    """Generates the apt indices natively instead of using reprepro
+
+    Package metadata is kept in PublishedPackage, so a commit only
+    regenerates the indices of the series, component and architecture
+    combinations it touched, plus the affected Release files. Keys are
+    handled the same way as for RepreproDriver."""
+    components = ('main',)
+    # Binary architectures of series with only architecture independent
+    # packages, whose Packages indices still need to list those
+    default_architectures = ('amd64',)
+
+    def commit(self, operations):
+        with self.lock():
+            dirty = set()
+            for operation in operations:
+                dirty |= self.apply(*operation)
+            return self._export(dirty)
+
+    def apply(self, action, series_name, arg, build_record_id=None):
+        if action == 'include':
+            remove_ddebs_from_changes(arg)
+            return self.include_changes(series_name, arg, build_record_id=build_record_id)
+        elif action == 'removesrc':
+            return self.remove_source_packages(series_name, arg)
+        elif action == 'removeversion':
+            return self.remove_source_packages(series_name, *arg)
+        elif action == 'promote':
+            package = self.promoted_package(arg)
+            srcdir = package.series.repository.outdir()
+            for path in package.file_list():
+                self.add_to_pool(os.path.join(srcdir, path), os.path.dirname(path))
+            return self.record_promotion(series_name, package)
+        raise ValueError('Unknown publish operation: %r' % (action,))
+
+    def include_changes(self, series_name, changes_file, component='main', build_record_id=None):
+        srcdir = os.path.dirname(changes_file)
+        with open(changes_file, 'r') as fp:
+            changes = deb822.Changes(fp)
+
+        directory = aptindex.pool_dir(component, changes['Source'].split(' ')[0])
+
+        checksums = self.verify_changes(changes_file)
+        for name in checksums:
+            self.add_to_pool(os.path.join(srcdir, name), directory, checksums[name])
+
+        return self.record_changes(series_name, changes_file, checksums, component, build_record_id)
+
+    def collect_garbage(self):
+        # Superseded files are removed from the pool as part of publishing,
+        # once no index clients may still use lists them
+        with self.lock():
+            self.remove_forgotten_files()
+
+    def add_to_pool(self, path, directory, checksums=None):
+        if checksums is None:
+            checksums = aptindex.checksum_file(path)
+        blob_store = get_blob_store()
+        blob_store.add(path, checksums['sha256'])
+        blob_store.link(checksums['sha256'],
+                        os.path.join(self.repository.outdir(), directory, os.path.basename(path)),
+                        source=path)
+        return checksums
+
+    def forget_packages(self, packages):
+        if not packages:
+            return
+
+        super(AptIndexDriver, self).forget_packages(packages)
+
+        # The published indices still list them, so they stay in the pool
+        # until remove_forgotten_files() finds those indices gone
+        forgotten = time.time()
+        with open(self.forgotten_files_path, 'a') as fp:
+            for path in sorted(set(sum([p.file_list() for p in packages], []))):
+                fp.write('%f %s\n' % (forgotten, path))
+
+    @property
+    def forgotten_files_path(self):
+        return os.path.join(ensure_dir(self.basedir), 'forgotten-files')
+
+    def remove_forgotten_files(self):
+        """Remove the pool files of forgotten packages that no package
+        uses any more, once every generation of dists/ that may still list
+        them has been replaced
+
+        Generations are named after the time they were staged, so those
+        staged after a file was forgotten do not list it. Must be called
+        with the lock held."""
+        from aasemble.django.apps.buildsvc.models import PublishedFile
+
+        queue = self.forgotten_files_path
+        if not os.path.exists(queue):
+            return
+
+        generations = os.path.join(self.repository.outdir(), '.dists')
+        staged = [float(name) for name in os.listdir(generations)] if os.path.isdir(generations) else []
+        oldest = min(staged) if staged else time.time()
+
+        with open(queue, 'r') as fp:
+            queued = [line.rstrip('\n').split(' ', 1) for line in fp if line.strip()]
+        due = set(path for forgotten, path in queued if float(forgotten) < oldest)
+        pending = [(forgotten, path) for forgotten, path in queued if float(forgotten) >= oldest]
+
+        in_use = set()
+        repository_files = PublishedFile.objects.filter(package__series__repository=self.repository)
+        due = sorted(due)
+        for i in range(0, len(due), 500):
+            in_use.update(repository_files.filter(path__in=due[i:i + 500]).values_list('path', flat=True))
+        for path in due:
+            fullpath = os.path.join(self.repository.outdir(), path)
+            if path not in in_use and os.path.exists(fullpath):
+                os.unlink(fullpath)
+
+        aptindex.write_atomically(queue, ''.join('%s %s\n' % item for item in pending).encode('utf-8'))
+
+    def series_architectures(self, series):
+        """The binary architectures series has packages for"""
+        architectures = (series.packages.exclude(architecture__in=('source', 'all'))
+                         .values_list('architecture', flat=True).distinct())
+        return tuple(sorted(architectures)) or self.default_architectures
+
+    def all_indices(self, series, architectures=None):
+        if architectures is None:
+            architectures = self.series_architectures(series)
+        return set((series.name, component, arch)
+                   for component in self.components
+                   for arch in architectures + ('source',))
+
+    def export(self, dirty=None):
+        with self.lock():
+            return self._export(dirty)
+
+    def _export(self, dirty=None):
+        self.ensure_key()
+        self.export_key()
+
+        checksums = {}
+        with self.staged_dists(copy_current=True) as distsdir:
+            release_paths = []
+            for series in self.repository.series.all():
+                architectures = self.series_architectures(series)
+                if dirty is None or not os.path.exists(self.release_path(series, distsdir)):
+                    series_dirty = self.all_indices(series, architectures)
+                else:
+                    series_dirty = set(d for d in dirty if d[0] == series.name)
+                    if any(arch == 'all' for _, _, arch in series_dirty):
+                        series_dirty |= set((series.name, component, arch)
+                                            for _, component, _ in series_dirty
+                                            for arch in architectures)
+                if series_dirty:
+                    checksums[series.name] = self.export_series(series, series_dirty, distsdir, architectures)
+                    release_paths.append(self.release_path(series, distsdir))
+
+            latencies = self.sign_releases(release_paths)
+
+        self.remove_forgotten_files()
+
+        # Only remembered once published, so a failed export leaves
+        # these matching what is actually in dists/
+        for series_name, series_checksums in checksums.items():
+            with open(self.checksums_path(series_name), 'w') as fp:
+                json.dump(series_checksums, fp)
+
+        return latencies
+
+    def distdir(self, series, distsdir=None):
+        return os.path.join(distsdir or os.path.join(self.repository.outdir(), 'dists'), series.name)
+
+    def release_path(self, series, distsdir=None):
+        return os.path.join(self.distdir(series, distsdir), 'Release')
+
+    def checksums_path(self, series_name):
+        return os.path.join(ensure_dir(os.path.join(self.basedir, 'indices')), '%s.json' % (series_name,))
+
+    def index_location(self, component, arch):
+        """(directory under dists/<series>, basename, architectures listed)
+        of the index of component for arch"""
+        if arch == 'source':
+            return os.path.join(component, 'source'), 'Sources', ['source']
+        return os.path.join(component, 'binary-%s' % (arch,)), 'Packages', [arch, 'all']
+
+    def export_series(self, series, dirty, distsdir=None, architectures=None):
+        if architectures is None:
+            architectures = self.series_architectures(series)
+        checksums = {}
+        if os.path.exists(self.checksums_path(series.name)):
+            with open(self.checksums_path(series.name), 'r') as fp:
+                checksums = json.load(fp)
+
+        # Drop the indices of architectures the series has no packages
+        # for any more
+        for component in self.components:
+            componentdir = os.path.join(self.distdir(series, distsdir), component)
+            for subdir in (os.listdir(componentdir) if os.path.isdir(componentdir) else []):
+                if subdir.startswith('binary-') and subdir[len('binary-'):] not in architectures:
+                    shutil.rmtree(os.path.join(componentdir, subdir))
+                    prefix = os.path.join(component, subdir) + '/'
+                    checksums = dict((path, sums) for path, sums in checksums.items() if not path.startswith(prefix))
+
+        # ... and add those of architectures new to it
+        dirty = set(dirty)
+        for component in self.components:
+            for arch in architectures + ('source',):
+                subdir, basename, archs = self.index_location(component, arch)
+                if os.path.join(subdir, basename) not in checksums:
+                    dirty.add((series.name, component, arch))
+
+        for _, component, arch in sorted(dirty):
+            if arch == 'all' or arch not in architectures + ('source',):
+                continue
+            subdir, basename, archs = self.index_location(component, arch)
+            stanzas = series.packages.filter(component=component, architecture__in=archs).order_by('name', 'version').values_list('control', flat=True)
+            data = '\n'.join(stanzas).encode('utf-8')
+            written = aptindex.write_index(os.path.join(self.distdir(series, distsdir), subdir), basename, data)
+            for name, sums in written.items():
+                checksums[os.path.join(subdir, name)] = sums
+
+        fields = [('Origin', self.repository.name.capitalize()),
+                  ('Label', self.repository.name.capitalize()),
+                  ('Suite', series.name),
+                  ('Codename', series.name),
+                  ('Architectures', ' '.join(architectures)),
+                  ('Components', ' '.join(self.components)),
+                  ('Description', '%s %s' % (self.repository.name, series.name))]
+        aptindex.write_atomically(self.release_path(series, distsdir),
+                                  aptindex.release_file(fields, checksums).encode('utf-8'))
+        return checksums
+
+
+def get_repo_driver_class():
     driver_name = getattr(settings, 'BUILDSVC_REPODRIVER', 'aasemble.django.apps.buildsvc.repodrivers.RepreproDriver')
-    driver = import_string(driver_name)
+    return import_string(driver_name)
+
+
+def get_repo_driver(repository):
+    driver = get_repo_driver_class()
     return driver(repository)
@@ -0,0 +1,174 @@
+import datetime
+import functools
+import logging
+import os
+import os.path
+import time
+import uuid
+
+from debian.debian_support import version_compare
+
+from django.conf import settings
+from django.utils.timezone import now
+
+from aasemble.django.apps.buildsvc.repodrivers import get_repo_driver
+
+LOG = logging.getLogger(__name__)
+
+
+def batch_size():
+    return getattr(settings, 'BUILDSVC_GC_BATCH_SIZE', 100)
+
+
+def throttle():
+    """Give everybody else a go at the disk between batches"""
+    time.sleep(getattr(settings, 'BUILDSVC_GC_PAUSE', 0.5))
+
+
+def in_batches(items):
+    items = list(items)
+    for i in range(0, len(items), batch_size()):
+        if i:
+            throttle()
+        yield items[i:i + batch_size()]
+
+
+def remove_file(path):
+    """Remove path and return the number of bytes reclaimed"""
+    try:
+        size = os.stat(path).st_size
+        os.unlink(path)
+        return size
+    except OSError:
+        return 0
+
+
+class GarbageCollector(object):
+    """Enforces a repository's retention policy
+
+    Repository.keep_versions limits the number of versions of each source
+    kept published in each series. Older versions are removed from the
+    repository, so their pool files go, too, and the logs of all but the
+    latest keep_versions builds of each source are removed. Build records
+    are kept, as they are the build history. Repository.keep_logs_days
+    limits how long build logs are kept. Zero means keep forever. Work is
+    done in throttled batches and the publish lock is only taken while the
+    repository driver removes packages and drops files no longer
+    referenced by any index."""
+    def __init__(self, repository):
+        self.repository = repository
+        self.report = {'packages': 0, 'logs': 0, 'bytes': 0}
+
+    def run(self):
+        if self.repository.keep_versions:
+            self.expire_versions()
+            self.expire_build_logs()
+        if self.repository.keep_logs_days:
+            self.expire_logs()
+        get_repo_driver(self.repository).collect_garbage()
+
+        LOG.info('Garbage collected %s: removed %d package versions and %d logs, reclaiming %d bytes' %
+                 (self.repository, self.report['packages'], self.report['logs'], self.report['bytes']))
+        return self.report
+
+    def expired_versions(self):
+        """(series name, source name, version) of every published version of
+        a source beyond the latest keep_versions in its series"""
+        from aasemble.django.apps.buildsvc.models import PublishedPackage
+
+        published = {}
+        for series_name, source_name, version in (PublishedPackage.objects.filter(series__repository=self.repository)
+                                                  .values_list('series__name', 'source_name', 'version')
+                                                  .distinct()):
+            published.setdefault((series_name, source_name), set()).add(version)
+
+        expired = []
+        for (series_name, source_name), versions in sorted(published.items()):
+            versions = sorted(versions, key=functools.cmp_to_key(version_compare), reverse=True)
+            expired += [(series_name, source_name, version)
+                        for version in versions[self.repository.keep_versions:]]
+        return expired
+
+    def expire_versions(self):
+        for batch in in_batches(self.expired_versions()):
+            with self.repository.publish() as txn:
+                for series_name, source_name, version in batch:
+                    txn.remove_version(series_name, source_name, version)
+            self.report['packages'] += len(batch)
+
+    def expire_build_logs(self):
+        from aasemble.django.apps.buildsvc.models import BuildRecord
+
+        for source in self.repository.sources:
+            expired = (BuildRecord.objects.filter(source=source, build_finished__isnull=False)
+                                          .order_by('-build_counter')[self.repository.keep_versions:])
+            for batch in in_batches(expired):
+                for br in batch:
+                    self.remove_log(br)
+
+    def expire_logs(self):
+        from aasemble.django.apps.buildsvc.models import BuildRecord
+
+        max_age = datetime.timedelta(days=self.repository.keep_logs_days)
+        cutoff = now() - max_age
+        expired = BuildRecord.objects.filter(source__series__repository=self.repository,
+                                             build_finished__lt=cutoff)
+        for batch in in_batches(expired):
+            for br in batch:
+                self.remove_log(br)
+
+        # Logs of builds that never got a version
+        mtime_cutoff = time.time() - max_age.total_seconds()
+        stray = []
+        for dirpath, dirnames, filenames in os.walk(self.repository.buildlogdir):
+            stray += [os.path.join(dirpath, f) for f in filenames
+                      if f.endswith('.tmp.log') and
+                      os.stat(os.path.join(dirpath, f)).st_mtime < mtime_cutoff]
+
+        for batch in in_batches(stray):
+            for path in batch:
+                self.count_log(remove_file(path))
+
+    def remove_log(self, br):
+        path = os.path.join(self.repository.buildlogdir, br.logpath())
+        if os.path.exists(path):
+            self.count_log(remove_file(path))
+
+    def count_log(self, size):
+        self.report['logs'] += 1
+        self.report['bytes'] += size
+
+
+def collect_temporary_logs(max_age=datetime.timedelta(days=1)):
+    """Remove build logs from AASEMBLE_BUILDSVC_BUILDLOG_TMPDIR that are no
+    longer needed, i.e. ones belonging to finished or deleted builds
+
+    Returns the number of logs removed and the number of bytes reclaimed."""
+    from aasemble.django.apps.buildsvc.models import BuildRecord
+
+    tmpdir = getattr(settings, 'AASEMBLE_BUILDSVC_BUILDLOG_TMPDIR', os.environ.get('TMPDIR', '/tmp'))
+    if not os.path.isdir(tmpdir):
+        return 0, 0
+
+    cutoff = time.time() - max_age.total_seconds()
+    candidates = {}
+    for f in os.listdir(tmpdir):
+        try:
+            uuid.UUID(f)
+        except ValueError:
+            continue
+        path = os.path.join(tmpdir, f)
+        if os.stat(path).st_mtime < cutoff:
+            candidates[f] = path
+
+    removed, reclaimed = 0, 0
+    for batch in in_batches(sorted(candidates)):
+        unfinished = set(str(u) for u in BuildRecord.objects.filter(uuid__in=batch, build_finished__isnull=True)
+                                                            .values_list('uuid', flat=True))
+        for f in batch:
+            if f not in unfinished:
+                reclaimed += remove_file(candidates[f])
+                removed += 1
+
+    LOG.info('Removed %d temporary build logs, reclaiming %d bytes' % (removed, reclaimed))
+    return removed, reclaimed
@@ -28,3 +28,21 @@ def user_save_handler(sender, **kwargs):
 @receiver(post_delete, sender=models.PackageSource)
 def package_source_post_delete_handler(sender, instance, **kwargs):
     instance.delete_on_filesystem()
+
+
+@receiver(post_delete, sender=models.RepositorySnapshot)
+def repository_snapshot_post_delete_handler(sender, instance, **kwargs):
+    instance.delete_on_filesystem()
+
+
+@receiver(post_save, sender=models.Repository)
+def repository_post_save_handler(sender, instance, raw=False, **kwargs):
+    if not raw:
+        instance.config_changed()
+
+
+@receiver(post_save, sender=models.Series)
+@receiver(post_delete, sender=models.Series)
+def series_changed_handler(sender, instance, raw=False, **kwargs):
+    if not raw:
+        instance.repository.config_changed()
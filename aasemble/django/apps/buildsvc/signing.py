@@ -0,0 +1,319 @@
+import base64
+import binascii
+import collections
+import contextlib
+import hashlib
+import logging
+import os
+import os.path
+import re
+import socket
+import struct
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+
+from aasemble.utils import run_cmd
+from aasemble.utils.exceptions import CommandFailed
+
+LOG = logging.getLogger(__name__)
+
+# OpenPGP numbers (RFC 4880, sections 5.2.1, 5.2.3.1 and 9)
+BINARY_SIGNATURE = 0x00
+TEXT_SIGNATURE = 0x01
+PUBKEY_RSA = 1
+HASH_SHA256 = 8
+SUBPACKET_CREATION_TIME = 2
+SUBPACKET_ISSUER = 16
+SUBPACKET_ISSUER_FINGERPRINT = 33
+
+# libgcrypt's number for SHA256, which is what gpg-agent expects
+GCRY_MD_SHA256 = 8
+
+# Agent sockets by gpg environment, None where no agent could be started
+_agents = {}
+# Signing keys by gpg environment and key ID, None where the agent
+# cannot sign with them
+_keys = {}
+_agents_lock = threading.Lock()
+
+SigningKey = collections.namedtuple('SigningKey', ['fingerprint', 'keygrip'])
+
+
+class AgentError(Exception):
+    pass
+
+
+def _unescape(data):
+    """Undo the percent escaping of Assuan data lines"""
+    return re.sub(b'%([0-9A-Fa-f]{2})', lambda match: binascii.unhexlify(match.group(1)), data)
+
+
+def _sexp_value(sexp, name):
+    """The value of the first (name value) pair in the canonical
+    S-expression sexp"""
+    token = ('(%d:%s' % (len(name), name)).encode('ascii')
+    start = sexp.index(token) + len(token)
+    colon = sexp.index(b':', start)
+    end = colon + 1 + int(sexp[start:colon])
+    return sexp[colon + 1:end]
+
+
+def _subpacket(kind, body):
+    return struct.pack('>BB', len(body) + 1, kind) + body
+
+
+def _mpi(value):
+    value = value.lstrip(b'\x00')
+    return struct.pack('>H', int(binascii.hexlify(value) or b'0', 16).bit_length()) + value
+
+
+def _crc24(data):
+    crc = 0xB704CE
+    for octet in bytearray(data):
+        crc ^= octet << 16
+        for i in range(8):
+            crc <<= 1
+            if crc & 0x1000000:
+                crc ^= 0x1864CFB
+    return crc & 0xFFFFFF
+
+
+def _armor(packet):
+    encoded = base64.b64encode(packet)
+    lines = [encoded[i:i + 64] for i in range(0, len(encoded), 64)]
+    checksum = base64.b64encode(struct.pack('>I', _crc24(packet))[1:])
+    return (b'-----BEGIN PGP SIGNATURE-----\n\n' + b'\n'.join(lines) +
+            b'\n=' + checksum + b'\n-----END PGP SIGNATURE-----\n')
+
+
+def _cleartext_lines(data):
+    """The lines of data as a cleartext signature signs them: without
+    trailing whitespace, and without the final line ending"""
+    if data.endswith(b'\n'):
+        data = data[:-1]
+    return [line.rstrip(b' \t\r') for line in data.split(b'\n')]
+
+
+class AgentConnection(object):
+    """A connection to gpg-agent, which holds the secret keys, speaking
+    its Assuan protocol"""
+    def __init__(self, path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.connect(path)
+            self.fp = self.sock.makefile('rb')
+            self._response()
+        except Exception:
+            self.sock.close()
+            raise
+
+    def close(self):
+        self.fp.close()
+        self.sock.close()
+
+    def command(self, line):
+        self.sock.sendall(line.encode('utf-8') + b'\n')
+        return self._response()
+
+    def _response(self):
+        data = b''
+        while True:
+            line = self.fp.readline()
+            if not line:
+                raise AgentError('gpg-agent closed the connection')
+            line = line.rstrip(b'\n')
+            if line == b'OK' or line.startswith(b'OK '):
+                return data
+            elif line.startswith(b'D '):
+                data += _unescape(line[2:])
+            elif line.startswith(b'ERR '):
+                raise AgentError(line[4:].decode('utf-8', 'replace'))
+            elif line.startswith(b'INQUIRE '):
+                # Only asked when the key needs a passphrase, which there is
+                # nobody to give. The agent answers with an error.
+                self.sock.sendall(b'CAN\n')
+
+    def pksign(self, keygrip, digest):
+        """The RSA signature of the SHA256 digest by the key keygrip"""
+        self.command('RESET')
+        self.command('SIGKEY %s' % (keygrip,))
+        self.command('SETHASH %d %s' % (GCRY_MD_SHA256, binascii.hexlify(digest).decode('ascii').upper()))
+        return _sexp_value(self.command('PKSIGN'), 's')
+
+
+class Signer(object):
+    """Signs files with a repository's key
+
+    A long-lived gpg-agent holds the keyring, so it is loaded once per
+    worker rather than once per signature. Signatures are made over
+    connections to the agent, without running gpg for each, unless the
+    agent cannot be reached or the key is not RSA, in which case gpg is
+    run against the agent. Release files for several series can be signed
+    in one batch."""
+    def __init__(self, key_id, env=None):
+        self.key_id = key_id
+        self.env = env or {}
+        self._connections = []
+        self._connections_lock = threading.Lock()
+
+    @property
+    def parallel(self):
+        return getattr(settings, 'BUILDSVC_SIGNING_PARALLEL', 4)
+
+    def ensure_agent(self):
+        """Start gpg-agent unless it is running already
+
+        Returns the path of its socket, or None if it could not be started."""
+        agent = tuple(sorted(self.env.items()))
+        with _agents_lock:
+            if agent not in _agents:
+                try:
+                    # Starts the agent unless one is already running
+                    run_cmd(['gpg-connect-agent', '/bye'], override_env=self.env)
+                    _agents[agent] = run_cmd(['gpgconf', '--list-dirs', 'agent-socket'],
+                                             override_env=self.env, discard_stderr=True).decode('utf-8').strip()
+                except (CommandFailed, OSError):
+                    LOG.warning('Could not start gpg-agent. Signing will be slower.')
+                    _agents[agent] = None
+            return _agents[agent]
+
+    def signing_key(self):
+        """The fingerprint and keygrip of the key, if the agent is running
+        and can sign with it"""
+        if self.ensure_agent() is None:
+            return None
+        key = (tuple(sorted(self.env.items())), self.key_id)
+        with _agents_lock:
+            if key not in _keys:
+                _keys[key] = self._find_signing_key()
+            return _keys[key]
+
+    def _find_signing_key(self):
+        try:
+            listing = run_cmd(['gpg', '--batch', '--with-colons', '--with-fingerprint', '--with-keygrip',
+                               '--list-secret-keys', self.key_id],
+                              override_env=self.env, discard_stderr=True).decode('utf-8')
+        except (CommandFailed, OSError):
+            LOG.warning('Could not look up key %s. Signing will be slower.' % (self.key_id,))
+            return None
+
+        records = [line.split(':') for line in listing.split('\n')]
+        primary = [fields for fields in records if fields[0] == 'sec']
+        if not primary or primary[0][3] != str(PUBKEY_RSA) or 's' not in primary[0][11]:
+            LOG.info('Key %s is not an RSA signing key. Signing with gpg.' % (self.key_id,))
+            return None
+        # The fingerprint and keygrip of the primary key follow its sec record
+        following = records[records.index(primary[0]):]
+        fingerprint = [fields[9] for fields in following if fields[0] == 'fpr'][0]
+        keygrip = [fields[9] for fields in following if fields[0] == 'grp'][0]
+        return SigningKey(fingerprint, keygrip)
+
+    @contextlib.contextmanager
+    def connection(self, path):
+        """An idle connection to the agent, or a new one"""
+        with self._connections_lock:
+            connection = self._connections.pop() if self._connections else None
+        if connection is None:
+            connection = AgentConnection(path)
+        try:
+            yield connection
+        except Exception:
+            connection.close()
+            raise
+        with self._connections_lock:
+            self._connections.append(connection)
+
+    def close(self):
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+        for connection in connections:
+            connection.close()
+
+    def signature(self, data, signature_type, key):
+        """An armored OpenPGP signature of data, made by the agent"""
+        hashed = (_subpacket(SUBPACKET_CREATION_TIME, struct.pack('>I', int(time.time()))) +
+                  _subpacket(SUBPACKET_ISSUER_FINGERPRINT, b'\x04' + binascii.unhexlify(key.fingerprint)))
+        header = struct.pack('>BBBBH', 4, signature_type, PUBKEY_RSA, HASH_SHA256, len(hashed)) + hashed
+        digest = hashlib.sha256(data + header + b'\x04\xff' + struct.pack('>I', len(header))).digest()
+
+        with self.connection(self.ensure_agent()) as connection:
+            value = connection.pksign(key.keygrip, digest)
+
+        unhashed = _subpacket(SUBPACKET_ISSUER, binascii.unhexlify(key.fingerprint[-16:]))
+        body = header + struct.pack('>H', len(unhashed)) + unhashed + digest[:2] + _mpi(value)
+        # Old format signature packet with a two octet length
+        return _armor(struct.pack('>BH', 0x89, len(body)) + body)
+
+    def _sign(self, path, output, sign, args):
+        key = self.signing_key()
+        if key is not None:
+            with open(path, 'rb') as fp:
+                data = fp.read()
+            try:
+                signed = sign(data, key)
+            except (AgentError, ValueError, socket.error) as e:
+                LOG.warning('Signing %s through gpg-agent failed: %s. Running gpg instead.' % (path, e))
+            else:
+                tmppath = output + '.new'
+                with open(tmppath, 'wb') as fp:
+                    fp.write(signed)
+                os.rename(tmppath, output)
+                return
+        self._gpg(args, path, output)
+
+    def _gpg(self, args, path, output):
+        tmppath = output + '.new'
+        run_cmd(['gpg', '--batch', '--yes', '--default-key', self.key_id] + args + ['-o', tmppath, path],
+                override_env=self.env)
+        os.rename(tmppath, output)
+
+    def _detach_sign(self, data, key):
+        return self.signature(data, BINARY_SIGNATURE, key)
+
+    def _clearsign(self, data, key):
+        lines = _cleartext_lines(data)
+        signature = self.signature(b'\r\n'.join(lines), TEXT_SIGNATURE, key)
+        # Dash escaping (RFC 4880, section 7.1)
+        text = b''.join((b'- ' + line if line.startswith(b'-') else line) + b'\n' for line in lines)
+        return b'-----BEGIN PGP SIGNED MESSAGE-----\nHash: SHA256\n\n' + text + signature
+
+    def detach_sign(self, path, output=None):
+        self._sign(path, output or path + '.gpg', self._detach_sign, ['--armor', '--detach-sign'])
+
+    def clearsign(self, path, output):
+        self._sign(path, output, self._clearsign, ['--clearsign'])
+
+    def sign_release(self, release_path):
+        """Write InRelease and Release.gpg next to release_path
+
+        Returns a dict mapping each signature to how long it took."""
+        distdir = os.path.dirname(release_path)
+        latencies = {}
+        for name, sign in (('InRelease', self.clearsign), ('Release.gpg', self.detach_sign)):
+            started = time.time()
+            sign(release_path, os.path.join(distdir, name))
+            latencies[name] = time.time() - started
+            LOG.info('Signed %s in %.3fs' % (os.path.join(distdir, name), latencies[name]))
+        return latencies
+
+    def sign_releases(self, release_paths):
+        """Sign several Release files in parallel, each worker over a
+        connection of its own to the agent
+
+        Returns a dict mapping each Release file to its signing latencies."""
+        if not release_paths:
+            return {}
+
+        self.signing_key()
+
+        pool = ThreadPool(min(len(release_paths), self.parallel))
+        try:
+            latencies = pool.map(self.sign_release, release_paths)
+        finally:
+            pool.close()
+            self.close()
+
+        return dict(zip(release_paths, latencies))
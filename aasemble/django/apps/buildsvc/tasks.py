@@ -1,5 +1,11 @@
+import logging
+
 from celery import shared_task
 
+from django.conf import settings
+
+LOG = logging.getLogger(__name__)
+
 
 @shared_task(ignore_result=True)
 def reprepro(repository_id, *args):
@@ -15,6 +21,27 @@ def export(repository_id):
     r.export()
 
 
+@shared_task(ignore_result=True)
+def publish(repository_id):
+    from .models import Repository
+    r = Repository.objects.get(id=repository_id)
+    r.drain_publish_queue()
+
+
+@shared_task(ignore_result=True)
+def promote(repository_id, series_name, package_ids):
+    from .models import Repository
+    r = Repository.objects.get(id=repository_id)
+    r.promote_real(series_name, package_ids)
+
+
+@shared_task(ignore_result=True)
+def snapshot_repository(snapshot_id):
+    from .models import RepositorySnapshot
+    s = RepositorySnapshot.objects.get(id=snapshot_id)
+    s.perform_snapshot()
+
+
 @shared_task(ignore_result=True)
 def build(package_source_id):
     from .models import PackageSource
@@ -35,3 +62,34 @@ def poll_all():
     from .models import PackageSource
     for ps in PackageSource.objects.filter(webhook_registered=False).exclude(disabled=True):
         poll_one.delay(ps.id)
+
+
+@shared_task(ignore_result=True)
+def refill_key_pool():
+    from .models import PooledKey
+    PooledKey.refill()
+
+
+@shared_task(ignore_result=True)
+def gc_blobs():
+    from .repodrivers import get_blob_store
+    removed, reclaimed = get_blob_store().gc()
+    LOG.info('Removed %d unreferenced blobs, reclaiming %d bytes' % (removed, reclaimed))
+
+
+@shared_task(ignore_result=True)
+def collect_garbage(repository_id):
+    from .models import Repository
+    r = Repository.objects.get(id=repository_id)
+    r.collect_garbage()
+
+
+@shared_task(ignore_result=True)
+def collect_garbage_all():
+    from .models import Repository
+    from .retention import collect_temporary_logs
+    collect_temporary_logs()
+    # Spread the repositories out so they don't all hit the disk at once
+    interval = getattr(settings, 'BUILDSVC_GC_INTERVAL', 60)
+    for i, r in enumerate(Repository.objects.exclude(keep_versions=0, keep_logs_days=0)):
+        collect_garbage.apply_async((r.id,), countdown=i * interval)
@@ -1,13 +1,18 @@
+import datetime
+import json
 import os.path
 import shutil
 import subprocess
 import sys
 import tempfile
+import threading
+import time
 
 from django.contrib.auth import models as auth_models
 from django.db.utils import IntegrityError
 from django.test import override_settings
 from django.test.utils import skipIf
+from django.utils.timezone import now
 
 import github3
 
@@ -15,12 +20,16 @@ import mock
 
 from six import StringIO
 
-from aasemble.django.apps.buildsvc import executors, repodrivers
-from aasemble.django.apps.buildsvc.models import BuildRecord, PackageSource, Repository, Series
+from aasemble.django.apps.buildsvc import aptindex, executors, repodrivers
+from aasemble.django.apps.buildsvc.models import BuildRecord, PackageSource, PooledKey, PublishedPackage, Repository, Series
 from aasemble.django.apps.buildsvc.models.package_source import NotAValidGithubRepository
+from aasemble.django.apps.buildsvc.publishqueue import PublishQueue
+from aasemble.django.apps.buildsvc.retention import collect_temporary_logs
+from aasemble.django.apps.buildsvc.signing import Signer
 from aasemble.django.tests import AasembleLiveServerTestCase as LiveServerTestCase
 from aasemble.django.tests import AasembleTestCase as TestCase
-from aasemble.utils.exceptions import CommandFailed
+from aasemble.utils import ensure_dir, file_lock
+from aasemble.utils.exceptions import ChecksumMismatch, CommandFailed
 
 
 try:
@@ -29,6 +38,12 @@ try:
 except:
     docker_available = False
 
+try:
+    subprocess.check_call(['gpg', '--version'], stdout=subprocess.PIPE)
+    gpg_available = True
+except:
+    gpg_available = False
+
 
 class PkgBuildTestCase(LiveServerTestCase):
     @skipIf(not docker_available, 'Docker unavailable')
@@ -64,6 +79,100 @@ class PkgBuildTestCase(LiveServerTestCase):
             shutil.rmtree(tmpdir)
 
 
+class PackageBuilderMetadataTestCase(TestCase):
+    def setUp(self):
+        self.basedir = tempfile.mkdtemp()
+        self.build_record = os.path.join(self.basedir, 'build_record.json')
+        with open(self.build_record, 'w') as fp:
+            json.dump({'sha': 'e65b55054c5220321c56bb3dfa96fbe5199f329c',
+                       'build_counter': 10,
+                       'source': {'git_repository': 'https://github.com/eric/some_project',
+                                  'last_built_version': None}}, fp)
+
+    def tearDown(self):
+        shutil.rmtree(self.basedir)
+
+    def _copy_test_data(self):
+        shutil.copytree(os.path.join(os.path.dirname(__file__), 'test_data', 'debian', 'build'),
+                        os.path.join(self.basedir, 'build'))
+
+    @mock.patch('aasemble.django.apps.buildsvc.pkgbuild.debian.run_cmd')
+    def test_debian_metadata_is_read_statically(self, run_cmd):
+        from .pkgbuild.debian import DebianBuilder
+        self._copy_test_data()
+
+        builder = DebianBuilder(self.basedir, self.build_record)
+
+        self.assertEquals(builder.sanitized_package_name, 'buildsvctest')
+        self.assertEquals(builder.package_version, '0.1+10')
+        run_cmd.assert_not_called()
+
+    def test_metadata_is_cached_in_basedir(self):
+        from .pkgbuild.debian import DebianBuilder
+        self._copy_test_data()
+
+        DebianBuilder(self.basedir, self.build_record).metadata
+
+        with mock.patch.object(DebianBuilder, 'detect_metadata') as detect_metadata:
+            builder = DebianBuilder(self.basedir, self.build_record)
+            self.assertEquals(builder.package_name, 'buildsvctest')
+            self.assertEquals(builder.native_version, '0.1')
+            detect_metadata.assert_not_called()
+
+    @mock.patch('aasemble.django.apps.buildsvc.pkgbuild.python.run_cmd')
+    def test_python_metadata_from_setup_cfg(self, run_cmd):
+        from .pkgbuild.python import PythonBuilder
+        os.mkdir(os.path.join(self.basedir, 'build'))
+        with open(os.path.join(self.basedir, 'build', 'setup.cfg'), 'w') as fp:
+            fp.write('[metadata]\nname = some_project\nversion = 1.2.3\n')
+
+        builder = PythonBuilder(self.basedir, self.build_record)
+
+        self.assertEquals(builder.binary_pkg_name, 'python-some_project')
+        self.assertEquals(builder.package_version, '1.2.3+10')
+        run_cmd.assert_not_called()
+
+    @mock.patch('aasemble.django.apps.buildsvc.pkgbuild.python.run_cmd')
+    def test_python_metadata_falls_back_to_single_setup_py_run(self, run_cmd):
+        from .pkgbuild.python import PythonBuilder
+        os.mkdir(os.path.join(self.basedir, 'build'))
+        with open(os.path.join(self.basedir, 'build', 'setup.cfg'), 'w') as fp:
+            fp.write('[metadata]\nname = some_project\n')
+        run_cmd.return_value = b'some_project\n1.2.4.dev3\n'
+
+        builder = PythonBuilder(self.basedir, self.build_record)
+
+        self.assertEquals(builder.package_name, 'some_project')
+        self.assertEquals(builder.native_version, '1.2.4.dev3')
+        self.assertEquals(run_cmd.call_count, 1)
+
+    @mock.patch('aasemble.django.apps.buildsvc.pkgbuild.python.run_cmd')
+    def test_python_metadata_asks_separately_when_setup_py_prints_one_line(self, run_cmd):
+        from .pkgbuild.python import PythonBuilder
+        os.mkdir(os.path.join(self.basedir, 'build'))
+        run_cmd.side_effect = [b'1.2.4\n', b'some_project\n', b'1.2.4\n']
+
+        builder = PythonBuilder(self.basedir, self.build_record)
+
+        self.assertEquals(builder.package_name, 'some_project')
+        self.assertEquals(builder.native_version, '1.2.4')
+        self.assertEquals([c[0][0] for c in run_cmd.call_args_list],
+                          [['python', 'setup.py', '--name', '--version'],
+                           ['python', 'setup.py', '--name'],
+                           ['python', 'setup.py', '--version']])
+
+    @mock.patch('aasemble.django.apps.buildsvc.pkgbuild.python.run_cmd')
+    def test_python_metadata_without_name_fails(self, run_cmd):
+        from .pkgbuild import MetadataError
+        from .pkgbuild.python import PythonBuilder
+        os.mkdir(os.path.join(self.basedir, 'build'))
+        run_cmd.side_effect = [b'\n1.2.4\n', b'\n']
+
+        builder = PythonBuilder(self.basedir, self.build_record)
+
+        self.assertRaises(MetadataError, lambda: builder.package_name)
+
+
 class RepositoryTestCase(TestCase):
     def test_unicode(self):
         repo = Repository.objects.get(id=12)
@@ -84,6 +193,15 @@ class RepositoryTestCase(TestCase):
                           'deb http://example.com/ubuntu trusty main universe\n'
                           'deb http://example.com/ubuntu trusty-updates main universe')
 
+    def test_build_environment(self):
+        # Fetched the way the manifest view fetches it, with the repository
+        # and its owner, which the sources list needs
+        series = Series.objects.select_related('repository__user').get(repository_id=1)
+        with self.assertNumQueries(1):
+            environment = series.build_environment()
+        self.assertEquals(environment['sources_list'], series.build_sources_list())
+        self.assertEquals(environment['apt_keys'], series.build_apt_keys())
+
     def test_lookup_by_user_with_extra_admin(self):
         charles = auth_models.User.objects.get(id=3)
         self.assertEquals(set([2, 3]), set([repo.id for repo in Repository.lookup_by_user(charles)]))
@@ -396,6 +514,221 @@ class PackageSourceTestCase(TestCase):
         ps.build_real()
 
 
+class PublishQueueTestCase(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.override = override_settings(BUILDSVC_REPOS_BASE_DIR=os.path.join(self.tmpdir, 'repos'))
+        self.override.enable()
+        self.repo = Repository.objects.get(id=12)
+        self.queue = PublishQueue(self.repo)
+
+    def tearDown(self):
+        self.override.disable()
+        shutil.rmtree(self.tmpdir)
+
+    def _build_output(self, name):
+        builddir = tempfile.mkdtemp(dir=self.tmpdir)
+        with open(os.path.join(builddir, '%s_1.0_amd64.deb' % (name,)), 'w') as fp:
+            fp.write('not really a deb')
+        changes_file = os.path.join(builddir, '%s_1.0_amd64.changes' % (name,))
+        with open(changes_file, 'w') as fp:
+            fp.write('Format: 1.8\n'
+                     'Source: %s\n'
+                     'Files:\n'
+                     ' 00000000000000000000000000000000 16 misc optional %s_1.0_amd64.deb\n' % (name, name))
+        return changes_file
+
+    def test_enqueue_moves_artifacts_to_spool(self):
+        changes_file = self._build_output('foo')
+
+        entrydir = self.queue.enqueue('aasemble', [changes_file])
+
+        self.assertEquals(self.queue.pending(), [entrydir])
+        self.assertTrue(os.path.exists(os.path.join(entrydir, 'foo_1.0_amd64.deb')))
+        self.assertTrue(os.path.exists(os.path.join(entrydir, 'foo_1.0_amd64.changes')))
+        self.assertFalse(os.path.exists(changes_file))
+
+    @mock.patch('aasemble.django.apps.buildsvc.models.Repository.publish')
+    def test_drain_publishes_pending_entries_in_one_transaction(self, publish):
+        first = self.queue.enqueue('aasemble', [self._build_output('foo')])
+        second = self.queue.enqueue('aasemble', [self._build_output('bar')])
+
+        self.queue.drain()
+
+        self.assertEquals(publish.call_count, 1)
+        txn = publish.return_value.__enter__.return_value
+        self.assertEquals(txn.include.call_args_list,
+                          [mock.call('aasemble', os.path.join(first, 'foo_1.0_amd64.changes'), build_record_id=None),
+                           mock.call('aasemble', os.path.join(second, 'bar_1.0_amd64.changes'), build_record_id=None)])
+        self.assertEquals(self.queue.pending(), [])
+
+    @mock.patch('aasemble.django.apps.buildsvc.models.Repository.publish')
+    def test_drain_leaves_queue_to_current_lock_holder(self, publish):
+        self.queue.enqueue('aasemble', [self._build_output('foo')])
+
+        with file_lock(os.path.join(self.queue.spooldir, '.drain.lock')):
+            self.queue.drain()
+
+        publish.assert_not_called()
+        self.assertEquals(len(self.queue.pending()), 1)
+
+    @mock.patch('aasemble.django.apps.buildsvc.models.Repository.publish')
+    def test_drain_isolates_failed_entry(self, publish):
+        br = BuildRecord.objects.create(source_id=1, state=BuildRecord.SUCCESFULLY_BUILT)
+        self.queue.enqueue('aasemble', [self._build_output('foo')])
+        self.queue.enqueue('aasemble', [self._build_output('bar')], br)
+
+        def include(series_name, changes_file, build_record_id=None):
+            if 'bar' in changes_file:
+                raise CommandFailed('reprepro failed', ['reprepro'], 255, '')
+
+        publish.return_value.__enter__.return_value.include.side_effect = include
+        publish.return_value.__exit__.return_value = False
+
+        self.queue.drain()
+
+        self.assertEquals(self.queue.pending(), [])
+        br.refresh_from_db()
+        self.assertEquals(br.state, BuildRecord.FAILED_TO_UPLOAD)
+
+    @mock.patch('aasemble.django.apps.buildsvc.tasks.publish')
+    def test_enqueue_publish_schedules_drain(self, publish):
+        self.repo.enqueue_publish('aasemble', [self._build_output('foo')])
+        publish.delay.assert_called_with(12)
+
+
+@override_settings(BUILDSVC_GC_PAUSE=0, BUILDSVC_GC_BATCH_SIZE=1)
+class GarbageCollectorTestCase(TestCase):
+    def setUp(self):
+        super(GarbageCollectorTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def touch(self, path, age=0):
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as fp:
+            fp.write('log')
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+
+    def test_keep_versions(self):
+        source = PackageSource.objects.get(id=1)
+        repo = source.series.repository
+        repo.keep_versions = 2
+
+        with override_settings(BUILDSVC_REPOS_BASE_PUBLIC_DIR=self.tmpdir):
+            build_records = []
+            for counter in (10, 11, 12):
+                version = '1.%d' % (counter,)
+                br = BuildRecord.objects.create(source=source, version=version,
+                                                build_counter=counter, build_finished=now())
+                build_records.append(br.id)
+                self.touch(os.path.join(repo.buildlogdir, br.logpath()))
+                # Binary package names that change between versions leave
+                # the older versions published
+                PublishedPackage.objects.create(series=source.series, architecture='amd64', name='libfoo%d' % (counter,),
+                                                version=version, source_name='foo',
+                                                filename='pool/main/f/foo/libfoo%d_%s_amd64.deb' % (counter, version),
+                                                size=3, sha256='abc', control='Package: libfoo%d\n' % (counter,),
+                                                files='pool/main/f/foo/libfoo%d_%s_amd64.deb' % (counter, version))
+
+            with mock.patch('aasemble.django.apps.buildsvc.repodrivers.FakeDriver.commit') as commit:
+                report = repo.collect_garbage()
+
+            commit.assert_called_once_with([('removeversion', source.series.name, ('foo', '1.10'))])
+            self.assertEquals(report['packages'], 1)
+            # Build history stays, only the log goes
+            self.assertEquals(BuildRecord.objects.filter(id__in=build_records).count(), 3)
+            self.assertEquals(report['logs'], 1)
+            self.assertEquals(report['bytes'], 3)
+            self.assertFalse(os.path.exists(os.path.join(repo.buildlogdir, source.long_name, '%s_1.10.log' % (source.long_name,))))
+            self.assertTrue(os.path.exists(os.path.join(repo.buildlogdir, source.long_name, '%s_1.11.log' % (source.long_name,))))
+
+    def test_keep_logs_days(self):
+        source = PackageSource.objects.get(id=1)
+        repo = source.series.repository
+        repo.keep_logs_days = 7
+
+        with override_settings(BUILDSVC_REPOS_BASE_PUBLIC_DIR=self.tmpdir):
+            old = BuildRecord.objects.create(source=source, version='1.10', build_counter=10,
+                                             build_finished=now() - datetime.timedelta(days=8))
+            new = BuildRecord.objects.create(source=source, version='1.11', build_counter=11,
+                                             build_finished=now())
+            for br in (old, new):
+                self.touch(os.path.join(repo.buildlogdir, br.logpath()))
+            self.touch(os.path.join(repo.buildlogdir, 'stray_1.tmp.log'), age=8 * 86400)
+
+            report = repo.collect_garbage()
+
+            self.assertEquals(report['logs'], 2)
+            self.assertEquals(report['packages'], 0)
+            self.assertFalse(os.path.exists(os.path.join(repo.buildlogdir, old.logpath())))
+            self.assertTrue(os.path.exists(os.path.join(repo.buildlogdir, new.logpath())))
+            self.assertTrue(BuildRecord.objects.filter(id=old.id).exists())
+
+    def test_collect_temporary_logs(self):
+        for name in ('f5575921-c9a1-4cc8-a235-5b1756ca59ef',  # unfinished
+                     '1dcc86aa-c925-49b0-9f1e-ffe6839150b7',  # finished
+                     '00000000-0000-0000-0000-000000000000'):  # no longer exists
+            self.touch(os.path.join(self.tmpdir, name), age=2 * 86400)
+        self.touch(os.path.join(self.tmpdir, '11111111-1111-1111-1111-111111111111'))
+
+        with override_settings(AASEMBLE_BUILDSVC_BUILDLOG_TMPDIR=self.tmpdir):
+            self.assertEquals(collect_temporary_logs(), (2, 6))
+
+        self.assertEquals(sorted(os.listdir(self.tmpdir)), ['11111111-1111-1111-1111-111111111111',
+                                                            'f5575921-c9a1-4cc8-a235-5b1756ca59ef'])
+
+
+class PooledKeyTestCase(TestCase):
+    def test_claim_empty_pool(self):
+        self.assertIsNone(PooledKey.claim())
+
+    def test_claim_oldest(self):
+        PooledKey.objects.create(key_id='FIRST')
+        PooledKey.objects.create(key_id='SECOND')
+
+        self.assertEquals(PooledKey.claim(), 'FIRST')
+        self.assertEquals(list(PooledKey.objects.values_list('key_id', flat=True)), ['SECOND'])
+
+    @override_settings(BUILDSVC_KEY_POOL_SIZE=3)
+    def test_refill(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+
+        PooledKey.objects.create(key_id='EXISTING')
+        with override_settings(BUILDSVC_REPOS_BASE_DIR=tmpdir):
+            PooledKey.refill()
+
+        self.assertEquals(PooledKey.objects.count(), 3)
+
+    @mock.patch('aasemble.django.apps.buildsvc.tasks.refill_key_pool')
+    def test_ensure_key_claims_pooled_key(self, refill_key_pool):
+        PooledKey.objects.create(key_id='POOLED')
+        repo = Repository.objects.get(id=12)
+        repo.key_id = ''
+
+        repodriver = repodrivers.get_repo_driver(repo)
+        with mock.patch.object(repodriver, 'generate_key') as generate_key:
+            repodriver.ensure_key()
+
+            generate_key.assert_not_called()
+            refill_key_pool.delay.assert_called_with()
+        self.assertEquals(Repository.objects.get(id=12).key_id, 'POOLED')
+
+    @mock.patch('aasemble.django.apps.buildsvc.tasks.refill_key_pool')
+    def test_ensure_key_falls_back_to_generating(self, refill_key_pool):
+        repo = Repository.objects.get(id=12)
+        repo.key_id = ''
+
+        repodriver = repodrivers.get_repo_driver(repo)
+        with mock.patch.object(repodriver, 'generate_key', return_value='GENERATED'):
+            repodriver.ensure_key()
+
+        self.assertEquals(Repository.objects.get(id=12).key_id, 'GENERATED')
+
+
 class ExecutorTestCase(TestCase):
     @mock.patch('aasemble.django.apps.buildsvc.executors.GCENode.destroy')
     @mock.patch('aasemble.django.apps.buildsvc.executors.GCENode.launch')
@@ -421,60 +754,270 @@ class ExecutorTestCase(TestCase):
 class RepreproDriverTestCase(TestCase):
     def test_export(self):
         repo = mock.MagicMock()
+        series = [mock.Mock(), mock.Mock()]
+        series[0].name, series[1].name = 'trusty', 'xenial'
+        repo.series.all.return_value = series
         repodriver = repodrivers.get_repo_driver(repo)
         with mock.patch.multiple(repodriver,
                                  ensure_key=mock.DEFAULT,
                                  ensure_directory_structure=mock.DEFAULT,
                                  export_key=mock.DEFAULT,
+                                 sign_releases=mock.DEFAULT,
+                                 staged_dists=mock.DEFAULT,
+                                 lock=mock.DEFAULT,
                                  _reprepro=mock.DEFAULT) as mocks:
-            repodriver.export()
+            mocks['staged_dists'].return_value.__enter__.return_value = '/some/staging/dir'
+            self.assertEquals(repodriver.export(), mocks['sign_releases'].return_value)
 
-            mocks['ensure_key'].ensure_called_with()
-            mocks['ensure_directory_structure'].ensure_called_with()
-            mocks['export_key'].ensure_called_with()
-            mocks['_reprepro'].ensure_called_with('export')
+            self.assertTrue(mocks['lock'].return_value.__enter__.called)
+
+            mocks['_reprepro'].assert_called_with('--distdir', '/some/staging/dir', 'export')
+            mocks['staged_dists'].return_value.__exit__.assert_called_with(None, None, None)
+
+            mocks['ensure_key'].assert_called_with()
+            mocks['ensure_directory_structure'].assert_called_with()
+            mocks['export_key'].assert_called_with()
+            mocks['sign_releases'].assert_called_with(['/some/staging/dir/trusty/Release',
+                                                       '/some/staging/dir/xenial/Release'])
+
+    def test_sign_releases(self):
+        repo = mock.MagicMock()
+        repo.key_id = 'ABCDEF'
+        repodriver = repodrivers.get_repo_driver(repo)
+        latencies = {'/some/dists/trusty/Release': {'InRelease': 0.01, 'Release.gpg': 0.02}}
+        with mock.patch.object(repodriver, 'signer') as signer:
+            signer.return_value.sign_releases.return_value = latencies
+            self.assertEquals(repodriver.sign_releases(['/some/dists/trusty/Release']), latencies)
+
+    def test_sign_releases_without_key(self):
+        repo = mock.MagicMock()
+        repo.key_id = None
+        repodriver = repodrivers.get_repo_driver(repo)
+        with mock.patch.object(repodriver, 'signer') as signer:
+            self.assertEquals(repodriver.sign_releases(['/some/dists/trusty/Release']), {})
+            signer.assert_not_called()
+
+    def test_staged_dists(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        repo = mock.MagicMock()
+        repo.outdir.return_value = tmpdir
+        repodriver = repodrivers.get_repo_driver(repo)
+
+        # Exported before dists/ was a symlink
+        os.makedirs(os.path.join(tmpdir, 'dists', 'aasemble'))
+        with open(os.path.join(tmpdir, 'dists', 'aasemble', 'Release'), 'w') as fp:
+            fp.write('legacy')
+
+        def read_release():
+            with open(os.path.join(tmpdir, 'dists', 'aasemble', 'Release'), 'r') as fp:
+                return fp.read()
+
+        with override_settings(BUILDSVC_DISTS_GENERATIONS=2):
+            for i in range(3):
+                with repodriver.staged_dists(copy_current=True) as distsdir:
+                    self.assertEquals(os.listdir(os.path.join(distsdir, 'aasemble')), ['Release'])
+                    aptindex.write_atomically(os.path.join(distsdir, 'aasemble', 'Release'),
+                                              ('generation %d' % (i,)).encode('utf-8'))
+                    self.assertNotEquals(read_release(), 'generation %d' % (i,))
+                self.assertEquals(read_release(), 'generation %d' % (i,))
+
+            self.assertTrue(os.path.islink(os.path.join(tmpdir, 'dists')))
+            self.assertEquals(len(os.listdir(os.path.join(tmpdir, '.dists'))), 2)
+
+            with self.assertRaises(ValueError):
+                with repodriver.staged_dists() as distsdir:
+                    raise ValueError()
+
+            self.assertEquals(read_release(), 'generation 2')
+            self.assertEquals(len(os.listdir(os.path.join(tmpdir, '.dists'))), 2)
 
     @mock.patch('aasemble.django.apps.buildsvc.repodrivers.remove_ddebs_from_changes')
     def test_process_changes(self, remove_ddebs_from_changes):
         repo = mock.MagicMock()
         repodriver = repodrivers.get_repo_driver(repo)
         with mock.patch.multiple(repodriver,
-                                 export=mock.DEFAULT,
+                                 _export=mock.DEFAULT,
                                  ensure_directory_structure=mock.DEFAULT,
+                                 lock=mock.DEFAULT,
+                                 verify_changes=mock.DEFAULT,
+                                 dedupe_pool_files=mock.DEFAULT,
+                                 record_changes=mock.DEFAULT,
+                                 remove_source_packages=mock.DEFAULT,
                                  _reprepro=mock.DEFAULT) as mocks:
 
-            # Ensure that ensure_directory_structure() is called and ddebs are removed before _reprepro
-            mocks['_reprepro'].side_effect = lambda *args: self.assertTrue(mocks['ensure_directory_structure'].called and remove_ddebs_from_changes.called)
+            # Ensure that ensure_directory_structure() is called, ddebs are removed and checksums verified before _reprepro
+            mocks['_reprepro'].side_effect = lambda *args: self.assertTrue(mocks['ensure_directory_structure'].called and
+                                                                           remove_ddebs_from_changes.called and
+                                                                           mocks['verify_changes'].called)
 
             # Ensure that _reprepro() is called before export
-            mocks['export'].side_effect = lambda: self.assertTrue(mocks['_reprepro'].called)
+            mocks['_export'].side_effect = lambda: self.assertTrue(mocks['_reprepro'].called)
 
             repodriver.process_changes('myseries', '/path/to/changes')
 
             remove_ddebs_from_changes.assert_called_with('/path/to/changes')
-            mocks['export'].assert_called_with()
+            mocks['verify_changes'].assert_called_with('/path/to/changes')
+            mocks['dedupe_pool_files'].assert_called_with('/path/to/changes', checksums=mocks['verify_changes'].return_value)
+            mocks['_export'].assert_called_with()
             mocks['ensure_directory_structure'].ensure_called_with()
             mocks['_reprepro'].ensure_called_with('--ignore=wrongdistribution', 'include', 'myseries', '/path/to/changes')
 
-    @mock.patch('aasemble.django.apps.buildsvc.repodrivers.ensure_dir', lambda s: s)
-    @override_settings(BUILDSVC_REPOS_BASE_DIR='/some/public/dir')
-    def test_ensure_directory_structure(self):
-        with mock.patch('aasemble.django.apps.buildsvc.repodrivers.recursive_render') as recursive_render:
-            repo = Repository.objects.get(id=12)
-            repodriver = repodrivers.get_repo_driver(repo)
-            repodriver.ensure_directory_structure()
+    @mock.patch('aasemble.django.apps.buildsvc.repodrivers.remove_ddebs_from_changes')
+    def test_transaction_exports_once(self, remove_ddebs_from_changes):
+        repo = mock.MagicMock()
+        repodriver = repodrivers.get_repo_driver(repo)
+        with mock.patch.multiple(repodriver,
+                                 _export=mock.DEFAULT,
+                                 ensure_directory_structure=mock.DEFAULT,
+                                 lock=mock.DEFAULT,
+                                 verify_changes=mock.DEFAULT,
+                                 dedupe_pool_files=mock.DEFAULT,
+                                 record_changes=mock.DEFAULT,
+                                 remove_source_packages=mock.DEFAULT,
+                                 _reprepro=mock.DEFAULT) as mocks:
+            with repodriver.transaction() as txn:
+                txn.include('myseries', '/path/to/first.changes')
+                txn.include('myseries', '/path/to/second.changes')
+                txn.remove_source('myseries', 'oldpackage')
+                mocks['_reprepro'].assert_not_called()
+
+            self.assertEquals(mocks['_reprepro'].call_args_list,
+                              [mock.call('--export=never', '--ignore=wrongdistribution', 'include', 'myseries', '/path/to/first.changes'),
+                               mock.call('--export=never', '--ignore=wrongdistribution', 'include', 'myseries', '/path/to/second.changes'),
+                               mock.call('--export=never', 'removesrc', 'myseries', 'oldpackage')])
+            self.assertEquals(mocks['_export'].call_count, 1)
+            self.assertEquals(mocks['ensure_directory_structure'].call_count, 1)
+            self.assertEquals(mocks['lock'].call_count, 1)
+            self.assertEquals(mocks['record_changes'].call_count, 2)
+            mocks['remove_source_packages'].assert_called_with('myseries', 'oldpackage')
+
+    def test_remove_version(self):
+        repo = mock.MagicMock()
+        repodriver = repodrivers.get_repo_driver(repo)
+        with mock.patch.multiple(repodriver,
+                                 _export=mock.DEFAULT,
+                                 ensure_directory_structure=mock.DEFAULT,
+                                 lock=mock.DEFAULT,
+                                 remove_source_packages=mock.DEFAULT,
+                                 _reprepro=mock.DEFAULT) as mocks:
+            with repodriver.transaction() as txn:
+                txn.remove_version('myseries', 'foo', '1.0')
 
-            srcdir = os.path.abspath(os.path.join(os.path.dirname(__file__), 'templates', 'buildsvc', 'reprepro'))
-            dstdir = '/some/public/dir/eric/eric5'
-            context = {'repository': repo}
-            recursive_render.assert_called_with(srcdir, dstdir, context)
+            mocks['_reprepro'].assert_called_with('--export=never', 'removesrc', 'myseries', 'foo', '1.0')
+            mocks['remove_source_packages'].assert_called_with('myseries', 'foo', '1.0')
 
-    @override_settings(BUILDSVC_REPOS_BASE_DIR='/some/dir')
-    @mock.patch('aasemble.django.apps.buildsvc.repodrivers.ensure_dir', lambda s: s)
-    def test_gpghome(self):
-        repo = Repository.objects.get(id=12)
+    def test_transaction_not_committed_on_error(self):
+        repo = mock.MagicMock()
         repodriver = repodrivers.get_repo_driver(repo)
-        self.assertEquals(repodriver.gpghome(), '/some/dir/eric/eric5/.gnupg')
+        with mock.patch.object(repodriver, 'commit') as commit:
+            try:
+                with repodriver.transaction() as txn:
+                    txn.include('myseries', '/path/to/changes')
+                    raise ValueError()
+            except ValueError:
+                pass
+            commit.assert_not_called()
+
+    def test_dedupe_pool_files(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+
+        changes_file = os.path.join(tmpdir, 'foo_1.0_amd64.changes')
+        with open(changes_file, 'w') as fp:
+            fp.write('Source: foo\nFiles:\n 00000000000000000000000000000000 3 misc optional foo_1.0_amd64.deb\n')
+
+        with override_settings(BUILDSVC_REPOS_BASE_PUBLIC_DIR=tmpdir):
+            pool_files = []
+            for repo in Repository.objects.filter(id__in=[1, 12]):
+                pool_file = os.path.join(repo.outdir(), 'pool', 'main', 'f', 'foo', 'foo_1.0_amd64.deb')
+                os.makedirs(os.path.dirname(pool_file))
+                with open(pool_file, 'w') as fp:
+                    fp.write('deb')
+                repodrivers.RepreproDriver(repo).dedupe_pool_files(changes_file)
+                pool_files.append(pool_file)
+
+            self.assertTrue(os.path.samefile(*pool_files))
+            self.assertEquals(os.stat(pool_files[0]).st_nlink, 3)
+
+    def test_promote(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+
+        source = PublishedPackage.objects.create(series_id=9, architecture='amd64', name='foo', version='1.0',
+                                                 source_name='foo', filename='pool/main/f/foo/foo_1.0_amd64.deb',
+                                                 size=3, sha256='abc', control='Package: foo\n',
+                                                 files='pool/main/f/foo/foo_1.0_amd64.deb')
+        superseded = PublishedPackage.objects.create(series_id=8, architecture='amd64', name='foo', version='0.9',
+                                                     source_name='foo', filename='pool/main/f/foo/foo_0.9_amd64.deb',
+                                                     size=3, sha256='def', control='Package: foo\n',
+                                                     files='pool/main/f/foo/foo_0.9_amd64.deb')
+
+        with override_settings(BUILDSVC_REPOS_BASE_DIR=os.path.join(tmpdir, 'private'),
+                               BUILDSVC_REPOS_BASE_PUBLIC_DIR=os.path.join(tmpdir, 'public')):
+            repodriver = repodrivers.RepreproDriver(Repository.objects.get(id=11))
+            with mock.patch.multiple(repodriver,
+                                     _export=mock.DEFAULT,
+                                     ensure_directory_structure=mock.DEFAULT,
+                                     _reprepro=mock.DEFAULT) as mocks:
+                with repodriver.transaction() as txn:
+                    txn.promote('aasemble', source.id)
+
+                mocks['_reprepro'].assert_called_with('--export=never', 'includedeb', 'aasemble',
+                                                      os.path.join(source.series.repository.outdir(), source.filename))
+
+        promoted = PublishedPackage.objects.get(series_id=8)
+        self.assertEquals(promoted.version, '1.0')
+        self.assertNotEquals(promoted.uuid, source.uuid)
+        self.assertFalse(PublishedPackage.objects.filter(id=superseded.id).exists())
+        self.assertTrue(PublishedPackage.objects.filter(id=source.id, series_id=9).exists())
+
+    def test_snapshot(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+
+        with override_settings(BUILDSVC_REPOS_BASE_DIR=os.path.join(tmpdir, 'private'),
+                               BUILDSVC_REPOS_BASE_PUBLIC_DIR=os.path.join(tmpdir, 'public')):
+            repo = Repository.objects.get(id=12)
+            outdir = repo.outdir()
+            for path in ('dists/aasemble/Release', 'pool/main/f/foo/foo_1.0_amd64.deb'):
+                os.makedirs(os.path.dirname(os.path.join(outdir, path)))
+                with open(os.path.join(outdir, path), 'w') as fp:
+                    fp.write(path)
+
+            snapshotdir = os.path.join(tmpdir, 'snapshot')
+            repodrivers.RepreproDriver(repo).snapshot(snapshotdir)
+
+            self.assertTrue(os.path.samefile(os.path.join(outdir, 'pool/main/f/foo/foo_1.0_amd64.deb'),
+                                             os.path.join(snapshotdir, 'pool/main/f/foo/foo_1.0_amd64.deb')))
+            self.assertFalse(os.path.samefile(os.path.join(outdir, 'dists/aasemble/Release'),
+                                              os.path.join(snapshotdir, 'dists/aasemble/Release')))
+
+    def test_ensure_directory_structure(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        with override_settings(BUILDSVC_REPOS_BASE_DIR=tmpdir):
+            with mock.patch('aasemble.django.apps.buildsvc.repodrivers.recursive_render') as recursive_render:
+                repo = Repository.objects.get(id=12)
+                repodriver = repodrivers.get_repo_driver(repo)
+                repodriver.ensure_directory_structure()
+
+                srcdir = os.path.abspath(os.path.join(os.path.dirname(__file__), 'templates', 'buildsvc', 'reprepro'))
+                dstdir = os.path.join(tmpdir, 'eric', 'eric5')
+                context = {'repository': repo}
+                recursive_render.assert_called_with(srcdir, dstdir, context)
+
+                # Nothing changed, so nothing to do
+                repodriver.ensure_directory_structure()
+                self.assertEquals(recursive_render.call_count, 1)
+
+                Series.objects.create(repository=repo, name='newseries')
+                repodriver.ensure_directory_structure()
+                self.assertEquals(recursive_render.call_count, 2)
+
+                Series.objects.get(repository=repo, name='newseries').delete()
+                repodriver.ensure_directory_structure()
+                self.assertEquals(recursive_render.call_count, 3)
 
     @override_settings(BUILDSVC_REPOS_BASE_DIR='/some/dir')
     @mock.patch('aasemble.django.apps.buildsvc.repodrivers.ensure_dir', lambda s: s)
@@ -482,3 +1025,262 @@ class RepreproDriverTestCase(TestCase):
         repo = Repository.objects.get(id=12)
         repodriver = repodrivers.get_repo_driver(repo)
         self.assertEquals(repodriver.basedir, '/some/dir/eric/eric5')
+
+
+class SignerTestCase(TestCase):
+    @mock.patch('aasemble.django.apps.buildsvc.signing.os.rename')
+    @mock.patch('aasemble.django.apps.buildsvc.signing.run_cmd')
+    def test_sign_releases_with_gpg(self, run_cmd, rename):
+        signer = Signer('ABCDEF', env={'GNUPGHOME': '/some/dir/.gnupg'})
+        release_paths = ['/some/dists/%s/Release' % (s,) for s in ('one', 'two')]
+
+        # No agent to sign through
+        with mock.patch.object(signer, 'ensure_agent', return_value=None) as ensure_agent:
+            latencies = signer.sign_releases(release_paths)
+
+            self.assertTrue(ensure_agent.called)
+
+        self.assertEquals(set(latencies), set(release_paths))
+        for release_path in release_paths:
+            self.assertEquals(set(latencies[release_path]), set(['InRelease', 'Release.gpg']))
+            distdir = os.path.dirname(release_path)
+            run_cmd.assert_any_call(['gpg', '--batch', '--yes', '--default-key', 'ABCDEF', '--clearsign',
+                                     '-o', os.path.join(distdir, 'InRelease.new'), release_path],
+                                    override_env={'GNUPGHOME': '/some/dir/.gnupg'})
+            rename.assert_any_call(os.path.join(distdir, 'Release.gpg.new'), os.path.join(distdir, 'Release.gpg'))
+        self.assertEquals(run_cmd.call_count, 4)
+
+    def test_sign_releases_nothing_to_do(self):
+        signer = Signer('ABCDEF')
+        with mock.patch.object(signer, 'ensure_agent') as ensure_agent:
+            self.assertEquals(signer.sign_releases([]), {})
+            ensure_agent.assert_not_called()
+
+    @skipIf(not gpg_available, 'gpg unavailable')
+    def test_sign_releases_through_agent(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        env = {'GNUPGHOME': os.path.join(tmpdir, '.gnupg')}
+        os.mkdir(env['GNUPGHOME'], 0o700)
+        self.addCleanup(subprocess.call, ['gpgconf', '--kill', 'gpg-agent'], env=dict(os.environ, **env))
+
+        def gpg(*args, **kwargs):
+            proc = subprocess.Popen(['gpg', '--batch'] + list(args), env=dict(os.environ, **env),
+                                    stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            stdout, stderr = proc.communicate(kwargs.get('input'))
+            self.assertEquals(proc.returncode, 0, stderr)
+            return stdout.decode('utf-8')
+
+        gpg('--gen-key', input=b'Key-Type: 1\nKey-Length: 2048\nName-Real: Test\n%no-protection\n%commit\n')
+        key_id = gpg('--with-colons', '--list-secret-keys').split('\n')[0].split(':')[4]
+
+        release_paths = []
+        for series, release in (('one', 'Origin: Test\nSuite: one\n-\nTrailing space \n'), ('two', 'Suite: two')):
+            ensure_dir(os.path.join(tmpdir, series))
+            release_paths.append(os.path.join(tmpdir, series, 'Release'))
+            with open(release_paths[-1], 'w') as fp:
+                fp.write(release)
+
+        signer = Signer(key_id, env=env)
+        self.assertIsNotNone(signer.signing_key())
+        with mock.patch('aasemble.django.apps.buildsvc.signing.run_cmd') as run_cmd:
+            latencies = signer.sign_releases(release_paths)
+            run_cmd.assert_not_called()
+        self.assertEquals(set(latencies), set(release_paths))
+
+        for release_path in release_paths:
+            distdir = os.path.dirname(release_path)
+            gpg('--verify', os.path.join(distdir, 'InRelease'))
+            gpg('--verify', os.path.join(distdir, 'Release.gpg'), release_path)
+
+
+class AptIndexTestCase(TestCase):
+    def setUp(self):
+        super(AptIndexTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def test_pool_dir(self):
+        self.assertEquals(aptindex.pool_dir('main', 'foo'), 'pool/main/f/foo')
+        self.assertEquals(aptindex.pool_dir('main', 'libfoo'), 'pool/main/libf/libfoo')
+
+    def test_write_index(self):
+        written = aptindex.write_index(self.tmpdir, 'Packages', b'Package: foo\n')
+
+        self.assertIn('Packages', written)
+        self.assertIn('Packages.gz', written)
+        self.assertEquals(written['Packages'], aptindex.checksum_file(os.path.join(self.tmpdir, 'Packages')))
+        for name, checksums in written.items():
+            self.assertTrue(os.path.exists(os.path.join(self.tmpdir, 'by-hash', 'SHA256', checksums['sha256'])))
+
+    def test_write_index_prunes_by_hash(self):
+        for i in range(aptindex.BY_HASH_GENERATIONS + 2):
+            written = aptindex.write_index(self.tmpdir, 'Packages', ('Package: foo%d\n' % (i,)).encode('utf-8'))
+
+        by_hash = os.listdir(os.path.join(self.tmpdir, 'by-hash', 'SHA256'))
+        self.assertEquals(len(by_hash), len(written) * aptindex.BY_HASH_GENERATIONS)
+
+    def test_verify_changes(self):
+        deb = os.path.join(self.tmpdir, 'foo_1.0_amd64.deb')
+        with open(deb, 'wb') as fp:
+            fp.write(b'not really a deb')
+        checksums = aptindex.checksum_data(b'not really a deb')
+        changes_file = os.path.join(self.tmpdir, 'foo_1.0_amd64.changes')
+
+        def write_changes(**kwargs):
+            with open(changes_file, 'w') as fp:
+                fp.write('Source: foo\n'
+                         'Checksums-Sha1:\n %(sha1)s %(size)d foo_1.0_amd64.deb\n'
+                         'Checksums-Sha256:\n %(sha256)s %(size)d foo_1.0_amd64.deb\n'
+                         'Files:\n %(md5)s %(size)d misc optional foo_1.0_amd64.deb\n' % dict(checksums, **kwargs))
+
+        write_changes()
+        self.assertEquals(aptindex.verify_changes(changes_file), {'foo_1.0_amd64.deb': checksums})
+
+        write_changes(sha256='0' * 64)
+        with self.assertRaises(ChecksumMismatch) as cm:
+            aptindex.verify_changes(changes_file)
+        self.assertEquals(cm.exception.algorithm, 'sha256')
+        self.assertEquals(cm.exception.path, deb)
+
+        write_changes()
+        os.unlink(deb)
+        self.assertRaises(ChecksumMismatch, aptindex.verify_changes, changes_file)
+
+    def test_release_file(self):
+        checksums = aptindex.checksum_data(b'Package: foo\n')
+        release = aptindex.release_file([('Suite', 'aasemble')], {'main/binary-amd64/Packages': checksums})
+
+        self.assertIn('Suite: aasemble\n', release)
+        self.assertIn(' %s %16d main/binary-amd64/Packages\n' % (checksums['sha256'], checksums['size']), release)
+
+    @override_settings(BUILDSVC_REPODRIVER='aasemble.django.apps.buildsvc.repodrivers.AptIndexDriver')
+    def test_export_only_regenerates_dirty_indices(self):
+        series = Series.objects.get(id=1)
+        PublishedPackage.objects.create(series=series, architecture='amd64', name='foo', version='1.0',
+                                        source_name='foo', filename='pool/main/f/foo/foo_1.0_amd64.deb',
+                                        size=3, sha256='abc', control='Package: foo\n',
+                                        files='pool/main/f/foo/foo_1.0_amd64.deb')
+
+        with override_settings(BUILDSVC_REPOS_BASE_DIR=self.tmpdir):
+            repodriver = repodrivers.get_repo_driver(series.repository)
+            self.assertIsInstance(repodriver, repodrivers.AptIndexDriver)
+            with mock.patch.multiple(repodriver,
+                                     ensure_key=mock.DEFAULT,
+                                     export_key=mock.DEFAULT,
+                                     sign_releases=mock.DEFAULT):
+                with mock.patch('aasemble.django.apps.buildsvc.aptindex.write_index', wraps=aptindex.write_index) as write_index:
+                    repodriver.export()
+                    self.assertEquals(write_index.call_count, 2)
+
+                    write_index.reset_mock()
+                    repodriver.export(set([(series.name, 'main', 'amd64')]))
+                    self.assertEquals(write_index.call_count, 1)
+
+            distdir = repodriver.distdir(series)
+            with open(os.path.join(distdir, 'main', 'binary-amd64', 'Packages'), 'r') as fp:
+                self.assertEquals(fp.read(), 'Package: foo\n')
+            with open(os.path.join(distdir, 'Release'), 'r') as fp:
+                self.assertIn('main/source/Sources', fp.read())
+
+    def test_remove_version(self):
+        series = Series.objects.get(id=1)
+        with override_settings(BUILDSVC_REPOS_BASE_DIR=self.tmpdir, BUILDSVC_REPOS_BASE_PUBLIC_DIR=self.tmpdir):
+            paths = {}
+            for name, version in (('libfoo1', '1.0'), ('libfoo2', '2.0')):
+                paths[version] = 'pool/main/f/foo/%s_%s_amd64.deb' % (name, version)
+                PublishedPackage.objects.create(series=series, architecture='amd64', name=name, version=version,
+                                                source_name='foo', filename=paths[version], size=3, sha256='abc',
+                                                control='Package: %s\n' % (name,), files=paths[version])
+                fullpath = os.path.join(series.repository.outdir(), paths[version])
+                ensure_dir(os.path.dirname(fullpath))
+                with open(fullpath, 'w') as fp:
+                    fp.write('deb')
+
+            repodriver = repodrivers.AptIndexDriver(series.repository)
+            with mock.patch.multiple(repodriver,
+                                     ensure_key=mock.DEFAULT,
+                                     export_key=mock.DEFAULT,
+                                     sign_releases=mock.DEFAULT):
+                repodriver.export()
+                self.assertEquals(repodriver.apply('removeversion', series.name, ('foo', '1.0')),
+                                  set([(series.name, 'main', 'amd64')]))
+
+                self.assertEquals(list(series.packages.values_list('version', flat=True)), ['2.0'])
+                # Still listed by the published indices
+                self.assertTrue(os.path.exists(os.path.join(series.repository.outdir(), paths['1.0'])))
+
+                with override_settings(BUILDSVC_DISTS_GENERATIONS=2):
+                    repodriver.export(set([(series.name, 'main', 'amd64')]))
+                    # ... and by the previous generation of them
+                    self.assertTrue(os.path.exists(os.path.join(series.repository.outdir(), paths['1.0'])))
+                    repodriver.export(set([(series.name, 'main', 'amd64')]))
+
+            self.assertFalse(os.path.exists(os.path.join(series.repository.outdir(), paths['1.0'])))
+            self.assertTrue(os.path.exists(os.path.join(series.repository.outdir(), paths['2.0'])))
+
+    def test_indices_of_the_architectures_of_the_series(self):
+        series = Series.objects.get(id=1)
+        with override_settings(BUILDSVC_REPOS_BASE_DIR=self.tmpdir, BUILDSVC_REPOS_BASE_PUBLIC_DIR=self.tmpdir):
+            repodriver = repodrivers.AptIndexDriver(series.repository)
+            for name, architecture in (('foo', 'all'), ('bar', 'i386')):
+                PublishedPackage.objects.create(series=series, architecture=architecture, name=name, version='1.0',
+                                                source_name=name, filename='pool/%s.deb' % (name,), size=3,
+                                                sha256='abc', control='Package: %s\n' % (name,),
+                                                files='pool/%s.deb' % (name,))
+            with mock.patch.multiple(repodriver,
+                                     ensure_key=mock.DEFAULT,
+                                     export_key=mock.DEFAULT,
+                                     sign_releases=mock.DEFAULT):
+                repodriver.export()
+                distdir = repodriver.distdir(series)
+                self.assertFalse(os.path.exists(os.path.join(distdir, 'main', 'binary-amd64')))
+                with open(os.path.join(distdir, 'main', 'binary-i386', 'Packages'), 'r') as fp:
+                    self.assertEquals(fp.read(), 'Package: bar\n\nPackage: foo\n')
+                with open(os.path.join(distdir, 'Release'), 'r') as fp:
+                    self.assertIn('Architectures: i386\n', fp.read())
+
+                # Only architecture independent packages left
+                series.packages.filter(name='bar').delete()
+                repodriver.export(set([(series.name, 'main', 'i386')]))
+                self.assertFalse(os.path.exists(os.path.join(distdir, 'main', 'binary-i386')))
+                with open(os.path.join(distdir, 'main', 'binary-amd64', 'Packages'), 'r') as fp:
+                    self.assertEquals(fp.read(), 'Package: foo\n')
+                with open(os.path.join(distdir, 'Release'), 'r') as fp:
+                    release = fp.read()
+                self.assertIn('Architectures: amd64\n', release)
+                self.assertNotIn('binary-i386', release)
+
+    @override_settings(BUILDSVC_REPODRIVER='aasemble.django.apps.buildsvc.repodrivers.AptIndexDriver')
+    def test_export_and_commit_do_not_overlap(self):
+        # The threads get connections of their own, which cannot see this
+        # test's transaction, so load everything the lock needs up front
+        series = Series.objects.select_related('repository__user').get(id=1)
+        started, proceed = threading.Event(), threading.Event()
+        calls = []
+
+        def _export(dirty=None):
+            calls.append(('start', dirty))
+            if len(calls) == 1:
+                started.set()
+                proceed.wait(5)
+            calls.append(('end', dirty))
+
+        with override_settings(BUILDSVC_REPOS_BASE_DIR=self.tmpdir):
+            repodriver = repodrivers.get_repo_driver(series.repository)
+            with mock.patch.object(repodriver, '_export', side_effect=_export):
+                exporter = threading.Thread(target=repodriver.export)
+                exporter.start()
+                started.wait(5)
+
+                committer = threading.Thread(target=repodriver.commit, args=([],))
+                committer.start()
+                committer.join(0.5)
+                # Waiting for the export to finish
+                self.assertTrue(committer.is_alive())
+
+                proceed.set()
+                exporter.join()
+                committer.join()
+
+        self.assertEquals(calls, [('start', None), ('end', None), ('start', set()), ('end', set())])
@@ -0,0 +1 @@
+default_app_config = 'aasemble.django.apps.mirrorsvc.apps.MirrorServiceConfig'
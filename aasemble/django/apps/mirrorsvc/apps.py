@@ -5,4 +5,4 @@ class MirrorServiceConfig(AppConfig):
     name = 'aasemble.django.apps.mirrorsvc'
 
     def ready(self):
-        from . import checks  # noqa
+        from . import checks, signals  # noqa
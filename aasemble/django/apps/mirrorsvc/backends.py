@@ -0,0 +1,133 @@
+import os.path
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from aasemble.django.apps.mirrorsvc import engine
+from aasemble.utils import BlobStore, run_cmd
+
+
+def max_concurrent_refreshes():
+    return getattr(settings, 'MIRRORSVC_MAX_CONCURRENT_REFRESHES', 4)
+
+
+class MirrorBackend(object):
+    def __init__(self, mirror):
+        self.mirror = mirror
+
+    @property
+    def rate_limit(self):
+        """Bytes per second this refresh may download at
+
+        Every refresh that may run at the same time gets an equal share of
+        MIRRORSVC_BANDWIDTH_LIMIT, so together they never exceed it."""
+        limit = getattr(settings, 'MIRRORSVC_BANDWIDTH_LIMIT', None)
+        if not limit:
+            return None
+        return max(1, limit // max_concurrent_refreshes())
+
+    @property
+    def blob_store_path(self):
+        return getattr(settings, 'MIRRORSVC_BLOB_STORE_PATH', os.path.join(settings.MIRRORSVC_BASE_PATH, 'blobs'))
+
+    def blob_store(self):
+        return BlobStore(self.blob_store_path)
+
+    def archive_sync(self, **kwargs):
+        return engine.ArchiveSync(self.mirror.url, self.mirror.archive_dir,
+                                  suites=self.mirror.series_list(),
+                                  components=self.mirror.components.split(' '),
+                                  architectures=self.mirror.architecture_list(),
+                                  include_source=self.mirror.include_source,
+                                  manifest=self.mirror.manifest(),
+                                  logger=self.mirror.logger,
+                                  **kwargs)
+
+    def update(self):
+        """Refresh the mirror. Returns a dict of statistics about the refresh:
+
+        bytes: how many bytes were downloaded
+        reused_bytes: how many bytes did not need downloading, because the
+                      files were in the blob store already
+        deduplicated_bytes: how many bytes of files downloaded anyway were
+                            replaced by links into the blob store"""
+        raise NotImplementedError()
+
+
+class AptMirrorBackend(MirrorBackend):
+    # Download threads, as set in apt-mirror.conf
+    threads = 20
+
+    def update(self):
+        rate_limit = self.rate_limit
+        self.mirror.write_config(limit_rate=rate_limit and max(1, rate_limit // self.threads))
+        run_cmd(['apt-mirror', 'mirror.conf'], cwd=self.mirror.basepath, logger=self.mirror.logger)
+
+        # apt-mirror knows nothing of the manifest, so record what it
+        # published afterwards
+        archive_sync = self.archive_sync()
+        new = []
+        for suite in self.mirror.series_list():
+            new += archive_sync.update_manifest(suite)
+        self.mirror.manifest().prune()
+
+        # apt-mirror does its own downloading, so the best we can do is
+        # share what it downloaded with the other mirrors after the fact
+        blob_store = self.blob_store()
+        deduplicated = blob_store.dedupe_files(os.path.join(self.mirror.archive_dir, path) for path in new)
+        blob_store.gc()
+        return {'deduplicated_bytes': deduplicated}
+
+
+class NativeBackend(MirrorBackend):
+    """Mirrors the archive with engine.ArchiveSync instead of apt-mirror"""
+
+    @property
+    def parallel(self):
+        return getattr(settings, 'MIRRORSVC_DOWNLOAD_PARALLEL', 8)
+
+    @property
+    def cleanup_delay(self):
+        return getattr(settings, 'MIRRORSVC_CLEANUP_DELAY', 86400)
+
+    def downloader(self, logger):
+        return engine.Downloader(parallel=self.parallel, rate_limit=self.rate_limit, logger=logger)
+
+    def archive_sync(self, **kwargs):
+        return super(NativeBackend, self).archive_sync(downloader=self.downloader(self.mirror.logger),
+                                                       cleanup_delay=self.cleanup_delay,
+                                                       blob_store=self.blob_store(),
+                                                       **kwargs)
+
+    def update(self):
+        stats = self.archive_sync().run()
+        self.mirror.manifest().prune()
+        if stats['removed']:
+            self.blob_store().gc()
+        return stats
+
+
+class OnDemandBackend(NativeBackend):
+    """Mirrors only the indices. Pool files are fetched by fetch_file() the
+    first time a client asks for them."""
+    def archive_sync(self, **kwargs):
+        return super(OnDemandBackend, self).archive_sync(on_demand=True, **kwargs)
+
+    def fetch_file(self, path, info):
+        """Fetch the pool file at path, listed with info, unless we have it
+        already. Returns where it is and the statistics of the fetch."""
+        archive_sync = self.archive_sync()
+        return archive_sync.fetch_file(path, info), archive_sync.stats
+
+
+def get_mirror_backend_class():
+    backend_name = getattr(settings, 'MIRRORSVC_BACKEND', 'aasemble.django.apps.mirrorsvc.backends.AptMirrorBackend')
+    return import_string(backend_name)
+
+
+def get_mirror_backend(mirror):
+    if mirror.on_demand:
+        # apt-mirror has no way of leaving the pool out
+        return OnDemandBackend(mirror)
+    backend = get_mirror_backend_class()
+    return backend(mirror)
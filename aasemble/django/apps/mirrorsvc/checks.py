@@ -2,6 +2,8 @@ import os
 
 from django.core.checks import Error, register
 
+from aasemble.django.apps.mirrorsvc.backends import AptMirrorBackend, get_mirror_backend_class
+
 E001 = Error(
     "You do not seem to have reprepro installed",
     id='aasemble.mirrorsvc.E001',
@@ -10,6 +12,8 @@ E001 = Error(
 
 @register(deploy=True)
 def reprepro_available(app_configs, **kwargs):
+    if not issubclass(get_mirror_backend_class(), AptMirrorBackend):
+        return []
     for d in os.environ['PATH'].split(':'):
         if os.access(os.path.join(d, 'apt-mirror'), os.X_OK):
             return []
@@ -0,0 +1,837 @@
+"""Native apt archive mirroring
+
+Nothing in here knows about Django. backends.NativeBackend drives it for
+a Mirror."""
+import bz2
+import errno
+import gzip
+import hashlib
+import io
+import logging
+import os
+import os.path
+import re
+import shutil
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from debian import deb822
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from aasemble.utils import ensure_dir, file_lock, hardlink_tree, sha256_file
+from aasemble.utils.exceptions import ChecksumMismatch, DownloadFailed
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+LOG = logging.getLogger(__name__)
+
+RELEASE_FILES = ('InRelease', 'Release', 'Release.gpg')
+
+
+def _gunzip(data):
+    with gzip.GzipFile(fileobj=io.BytesIO(data), mode='rb') as fp:
+        return fp.read()
+
+
+# Variants of an index we know how to read, most preferred first
+DECOMPRESSORS = [('.gz', _gunzip),
+                 ('.bz2', bz2.decompress),
+                 ('', lambda data: data)]
+
+if lzma is not None:
+    DECOMPRESSORS.insert(0, ('.xz', lzma.decompress))
+
+
+def parse_release(data):
+    """Parse a Release (or InRelease) file
+
+    Returns the Release and a dict mapping the path of each file it lists
+    to its sha256 and size."""
+    release = deb822.Release(data.decode('utf-8'))
+    files = {}
+    for f in release.get('SHA256', []):
+        files[f['name']] = {'sha256': f['sha256'], 'size': int(f['size'])}
+    return release, files
+
+
+def wanted_index(path, components, architectures, include_source=False):
+    """Whether path (relative to a Release file) is an index we mirror"""
+    parts = path.split('/')
+    if len(parts) != 3 or parts[0] not in components:
+        return False
+    if parts[1] in ['binary-%s' % (arch,) for arch in architectures]:
+        return True
+    return include_source and parts[1] == 'source'
+
+
+def wanted_dists_entry(name, architectures, include_source=False):
+    """Whether a file or directory called name in a suite of dists/ is
+    of use to clients of architectures (and of sources, if include_source)
+
+    Anything not specific to an architecture is."""
+    base = name.split('.')[0]
+    if base == 'source':
+        return include_source
+    for prefix in ('binary-', 'installer-', 'Contents-udeb-', 'Contents-'):
+        if base.startswith(prefix):
+            arch = base[len(prefix):]
+            if arch == 'source':
+                return include_source
+            return arch == 'all' or arch in architectures
+    return True
+
+
+def index_files(index_path, data):
+    """Yield (pool path, {sha256, size}, {package, version, architecture})
+    for each file listed in a Packages or Sources index"""
+    text = data.decode('utf-8')
+    if os.path.basename(index_path).startswith('Sources'):
+        for src in deb822.Sources.iter_paragraphs(text.splitlines(True)):
+            package = {'package': src['Package'], 'version': src['Version'], 'architecture': 'source'}
+            for f in src.get('Checksums-Sha256', []):
+                path = os.path.join(src['Directory'], f['name'])
+                yield path, {'sha256': f['sha256'], 'size': int(f['size'])}, package
+    else:
+        for pkg in deb822.Packages.iter_paragraphs(text.splitlines(True)):
+            package = {'package': pkg['Package'], 'version': pkg['Version'], 'architecture': pkg['Architecture']}
+            yield pkg['Filename'], {'sha256': pkg['SHA256'], 'size': int(pkg['Size'])}, package
+
+
+def pool_entries(index_path, data):
+    """Map the pool path of each file listed in a Packages or Sources index
+    to its sha256 and size"""
+    return dict((path, info) for path, info, package in index_files(index_path, data))
+
+
+class PatchFailed(Exception):
+    pass
+
+
+def parse_pdiff_index(data):
+    """Parse the Index of a pdiff directory (e.g. Packages.diff/Index)
+
+    Returns a list of (name, sha256 of the file the patch applies to,
+    sha256 of the patch, sha256 of the compressed patch), oldest first,
+    and whether the patches are merged (i.e. each of them goes all the
+    way to the current version rather than just to the next one)."""
+    index = deb822.Deb822(data.decode('utf-8'))
+
+    def entries(field):
+        return [line.split() for line in index.get(field, '').splitlines() if line.strip()]
+
+    patches = dict((name, sha256) for sha256, size, name in entries('SHA256-Patches'))
+    downloads = dict((name, sha256) for sha256, size, name in entries('SHA256-Download'))
+    history = [(name, sha256, patches.get(name), downloads.get(name + '.gz'))
+               for sha256, size, name in entries('SHA256-History')]
+    return history, index.get('X-Patch-Precedence') == 'merged'
+
+
+ED_COMMAND = re.compile(br'^(\d+)(?:,(\d+))?([acd])$')
+
+
+def apply_ed_script(data, script):
+    """Apply an ed script of the restricted form used by pdiffs to data"""
+    lines = data.splitlines(True)
+    script_lines = script.splitlines(True)
+    i = 0
+    while i < len(script_lines):
+        command = script_lines[i].strip()
+        i += 1
+        if not command:
+            continue
+        m = ED_COMMAND.match(command)
+        if not m:
+            raise PatchFailed('Unsupported ed command: %r' % (command,))
+        start = int(m.group(1))
+        end = int(m.group(2) or start)
+        action = m.group(3)
+
+        new_lines = []
+        if action in (b'a', b'c'):
+            while True:
+                if i >= len(script_lines):
+                    raise PatchFailed('Unterminated %r' % (command,))
+                line = script_lines[i]
+                i += 1
+                if line.rstrip(b'\n') == b'.':
+                    break
+                new_lines.append(line)
+
+        if action == b'a':
+            lines[start:start] = new_lines
+        else:
+            lines[start - 1:end] = new_lines
+    return b''.join(lines)
+
+
+class TokenBucket(object):
+    """Limits the combined rate of everyone consume()ing from it to rate
+    bytes per second, allowing bursts of up to burst bytes"""
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self.tokens = self.capacity
+        self.timestamp = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self, amount):
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+            self.timestamp = now
+            # Going into debt keeps this fair without any bookkeeping
+            # of who is waiting for what
+            self.tokens -= amount
+            deficit = -self.tokens
+        if deficit > 0:
+            time.sleep(deficit / float(self.rate))
+
+
+class Downloader(object):
+    """Fetches files over a bounded pool of keep-alive connections per host
+
+    With a rate_limit, all downloads together stay below that many bytes
+    per second."""
+    bufsize = 64 * 1024
+    timeout = 60
+
+    def __init__(self, parallel=8, retries=3, rate_limit=None, logger=LOG):
+        self.parallel = parallel
+        self.logger = logger
+        self.bucket = rate_limit and TokenBucket(rate_limit) or None
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=parallel,
+                              max_retries=retries, pool_block=True)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get(self, url):
+        """The contents of url, or None if it does not exist"""
+        try:
+            response = self.session.get(url, timeout=self.timeout)
+        except requests.RequestException as e:
+            raise DownloadFailed(url, reason=str(e))
+        if response.status_code == 404:
+            return None
+        if response.status_code != 200:
+            raise DownloadFailed(url, status=response.status_code)
+        self.throttle(len(response.content))
+        return response.content
+
+    def throttle(self, amount):
+        if self.bucket is not None:
+            self.bucket.consume(amount)
+
+    def fetch(self, url, dest, sha256=None, size=None):
+        """Download url to dest, verifying sha256 as the data streams in
+
+        The data is written to dest.partial, which the next attempt resumes
+        if the download is interrupted, and only renamed to dest once it is
+        complete and verified. Returns the number of bytes downloaded."""
+        ensure_dir(os.path.dirname(dest))
+        partial = dest + '.partial'
+
+        digest = hashlib.sha256()
+        offset = 0
+        headers = {}
+        if os.path.exists(partial):
+            with open(partial, 'rb') as fp:
+                for buf in iter(lambda: fp.read(self.bufsize), b''):
+                    digest.update(buf)
+                    offset += len(buf)
+            headers['Range'] = 'bytes=%d-' % (offset,)
+
+        try:
+            response = self.session.get(url, headers=headers, stream=True, timeout=self.timeout)
+        except requests.RequestException as e:
+            raise DownloadFailed(url, reason=str(e))
+
+        try:
+            if response.status_code == 416:
+                # Whatever we had is no good
+                os.unlink(partial)
+                return self.fetch(url, dest, sha256, size)
+            if response.status_code not in (200, 206):
+                raise DownloadFailed(url, status=response.status_code)
+            if response.status_code == 200 and offset:
+                # Server does not do ranges. Start over.
+                digest = hashlib.sha256()
+                offset = 0
+
+            downloaded = 0
+            with open(partial, offset and 'ab' or 'wb') as fp:
+                try:
+                    for buf in response.iter_content(self.bufsize):
+                        fp.write(buf)
+                        digest.update(buf)
+                        downloaded += len(buf)
+                        self.throttle(len(buf))
+                except requests.RequestException as e:
+                    raise DownloadFailed(url, reason=str(e))
+        finally:
+            response.close()
+
+        if size is not None and offset + downloaded != size:
+            os.unlink(partial)
+            raise ChecksumMismatch(dest, 'size', size, offset + downloaded)
+        if sha256 is not None and digest.hexdigest() != sha256:
+            os.unlink(partial)
+            raise ChecksumMismatch(dest, 'sha256', sha256, digest.hexdigest())
+
+        os.rename(partial, dest)
+        return downloaded
+
+    def fetch_many(self, items, missing_ok=False):
+        """fetch() each of items, a list of (url, dest, sha256, size), in parallel
+
+        Failures are logged rather than raised, so that one bad file does
+        not stop the rest. Returns the number of bytes downloaded and the
+        list of items that failed. With missing_ok, files that do not exist
+        upstream do not count as failures."""
+        def fetch_one(item):
+            try:
+                return self.fetch(*item), None
+            except DownloadFailed as e:
+                if missing_ok and e.status == 404:
+                    return 0, None
+                self.logger.warning(str(e))
+            except ChecksumMismatch as e:
+                self.logger.warning(str(e))
+            return 0, item
+
+        if not items:
+            return 0, []
+
+        pool = ThreadPool(min(self.parallel, len(items)))
+        try:
+            results = pool.map(fetch_one, items)
+        finally:
+            pool.close()
+
+        return sum(r[0] for r in results), [r[1] for r in results if r[1] is not None]
+
+
+class ArchiveSync(object):
+    """Mirrors suites of the apt archive at url into destdir
+
+    destdir ends up with the same dists/ and pool/ layout as the archive.
+    The indices of a suite are only put in place once every pool file
+    they list has been downloaded, and the Release files last of all, so
+    the mirror is consistent at all times.
+
+    Refreshes are incremental: suites whose Release file has not changed
+    are skipped, only the indices that changed are fetched (through pdiffs
+    where the archive has them) and only the pool files that are new are
+    downloaded. Pool files that are no longer listed are removed once
+    cleanup_delay seconds have passed, so clients in the middle of an
+    update can still fetch them.
+
+    With a blob_store (an aasemble.utils.BlobStore), pool files are stored
+    in it. Files it has already are linked from there rather than
+    downloaded.
+
+    With a manifest, every suite that changed is recorded in it once it is
+    published. A manifest has these methods:
+
+        is_current(suite, release_sha256): Whether the suite is recorded
+            as of the Release file with the given sha256
+        update_suite(suite, release_sha256, files, packages): Record that
+            suite lists files (pool path -> {sha256, size}) and packages
+            (dicts of path, component, package, version and architecture).
+            Returns the pool paths that were not recorded before.
+        remove_files(paths): Forget the pool files at paths
+
+    With on_demand, refreshes only fetch and publish the indices. Pool
+    files are left for fetch_file() to fetch the first time a client asks
+    for them. A later refresh without on_demand fills in whatever the pool
+    is missing."""
+    def __init__(self, url, destdir, suites, components, architectures=('amd64',),
+                 include_source=False, on_demand=False,
+                 downloader=None, cleanup_delay=86400, blob_store=None, manifest=None, logger=LOG):
+        self.url = url.rstrip('/')
+        self.destdir = destdir
+        self.suites = suites
+        self.components = components
+        self.architectures = architectures
+        self.include_source = include_source
+        self.on_demand = on_demand
+        self.cleanup_delay = cleanup_delay
+        self.logger = logger
+        self.downloader = downloader or Downloader(logger=logger)
+        self.blob_store = blob_store
+        self.manifest = manifest
+        self.stats = {'files': 0, 'bytes': 0, 'removed': 0, 'reused': 0, 'reused_bytes': 0}
+
+    def run(self):
+        if self.on_demand:
+            with open(self.incomplete_marker(), 'a'):
+                pass
+        for suite in self.suites:
+            self.sync_suite(suite)
+        self.cleanup()
+        if not self.on_demand and not self.pool_complete():
+            os.unlink(self.incomplete_marker())
+        self.logger.info('Downloaded %(files)d files (%(bytes)d bytes). Reused %(reused)d files (%(reused_bytes)d bytes). '
+                         'Removed %(removed)d files.' % self.stats)
+        return self.stats
+
+    def suite_url(self, suite, path):
+        return '%s/dists/%s/%s' % (self.url, suite, path)
+
+    def distdir(self, suite):
+        return os.path.join(self.destdir, 'dists', suite)
+
+    def staging_dir(self, suite):
+        return os.path.join(self.destdir, '.staging', suite)
+
+    def generations_dir(self, suite):
+        return os.path.join(self.destdir, '.dists', suite)
+
+    def cleanup_queue(self):
+        return os.path.join(self.destdir, '.cleanup-queue')
+
+    def incomplete_marker(self):
+        return os.path.join(ensure_dir(self.destdir), '.pool-incomplete')
+
+    def pool_complete(self):
+        """Whether the pool has every file the published indices list, i.e.
+        it has not been mirrored on demand since the last full refresh"""
+        return not os.path.exists(self.incomplete_marker())
+
+    def sync_suite(self, suite):
+        release_files = self.fetch_release_files(suite)
+        if self.unchanged(suite, release_files) and (self.on_demand or self.pool_complete()):
+            self.logger.info('%s %s is unchanged' % (self.url, suite))
+            # In case the manifest was lost or never made
+            self.update_manifest(suite)
+            return
+
+        self.logger.info('Mirroring %s %s' % (self.url, suite))
+        release, files = parse_release(release_files.get('Release') or release_files['InRelease'])
+
+        indices = self.wanted_indices(files)
+        published = self.published_pool_entries(suite)
+        unchanged = self.update_indices(suite, files, indices)
+        entries = self.pool_entries(suite, indices, unchanged)
+        if not self.on_demand:
+            # What the published indices list is only known to be present
+            # if nothing was left to be fetched on demand
+            self.fetch_pool(entries, published if self.pool_complete() else None)
+        self.publish_suite(suite, release, indices, unchanged, release_files)
+        self.queue_cleanup(set(published) - set(entries))
+        self.update_manifest(suite)
+
+    def wanted_indices(self, files):
+        return dict((path, info) for path, info in files.items()
+                    if wanted_index(path, self.components, self.architectures, self.include_source))
+
+    def fetch_release_files(self, suite):
+        release_files = {}
+        for name in RELEASE_FILES:
+            data = self.downloader.get(self.suite_url(suite, name))
+            if data is not None:
+                release_files[name] = data
+        if 'Release' not in release_files and 'InRelease' not in release_files:
+            raise DownloadFailed(self.suite_url(suite, 'Release'), status=404)
+        return release_files
+
+    def unchanged(self, suite, release_files):
+        """Whether the Release files upstream are the ones we last published"""
+        for name, data in release_files.items():
+            path = os.path.join(self.distdir(suite), name)
+            if not os.path.exists(path):
+                return False
+            with open(path, 'rb') as fp:
+                if fp.read() != data:
+                    return False
+        return True
+
+    def local_copy_matches(self, path, info):
+        if not os.path.exists(path) or os.path.getsize(path) != info['size']:
+            return False
+        with open(path, 'rb') as fp:
+            return hashlib.sha256(fp.read()).hexdigest() == info['sha256']
+
+    def update_indices(self, suite, files, indices):
+        """Bring the indices of suite up to date in its staging directory
+
+        Returns the set of indices whose published copy is still current."""
+        staging = self.staging_dir(suite)
+        distdir = self.distdir(suite)
+        unchanged = set()
+        items = []
+        for base in sorted(set(self.index_base(path) for path in indices)):
+            variants = [path for path in sorted(indices) if self.index_base(path) == base]
+            if all(self.local_copy_matches(os.path.join(distdir, path), indices[path]) for path in variants):
+                unchanged.update(variants)
+                continue
+            if self.patch_index(suite, base, files):
+                continue
+            for path in variants:
+                if self.local_copy_matches(os.path.join(distdir, path), indices[path]):
+                    unchanged.add(path)
+                else:
+                    items.append((self.suite_url(suite, path), os.path.join(staging, path),
+                                  indices[path]['sha256'], indices[path]['size']))
+        self.download(items, missing_ok=True)
+        return unchanged
+
+    def patch_index(self, suite, base, files):
+        """Try to bring base up to date by applying pdiffs to our copy of it
+
+        The patched (uncompressed) index is written to the staging
+        directory. Returns whether that worked."""
+        index_path = base + '.diff/Index'
+        local = os.path.join(self.distdir(suite), base)
+        if index_path not in files or base not in files or not os.path.exists(local):
+            return False
+
+        try:
+            index = self.downloader.get(self.suite_url(suite, index_path))
+            if index is None or hashlib.sha256(index).hexdigest() != files[index_path]['sha256']:
+                return False
+            history, merged = parse_pdiff_index(index)
+
+            with open(local, 'rb') as fp:
+                data = fp.read()
+            current = hashlib.sha256(data).hexdigest()
+            pending = [i for i, (name, sha256, _, _) in enumerate(history) if sha256 == current]
+            if not pending:
+                return False
+            patches = history[pending[0]:]
+            if merged:
+                patches = patches[:1]
+
+            for name, _, patch_sha256, download_sha256 in patches:
+                compressed = self.downloader.get(self.suite_url(suite, '%s.diff/%s.gz' % (base, name)))
+                if compressed is None or hashlib.sha256(compressed).hexdigest() != download_sha256:
+                    return False
+                patch = _gunzip(compressed)
+                if hashlib.sha256(patch).hexdigest() != patch_sha256:
+                    return False
+                data = apply_ed_script(data, patch)
+                self.stats['files'] += 1
+                self.stats['bytes'] += len(compressed)
+        except (DownloadFailed, PatchFailed, IOError) as e:
+            self.logger.info('Could not patch %s: %s' % (base, e))
+            return False
+
+        if hashlib.sha256(data).hexdigest() != files[base]['sha256']:
+            self.logger.info('Patching %s did not produce the expected result' % (base,))
+            return False
+
+        path = os.path.join(ensure_dir(os.path.join(self.staging_dir(suite), os.path.dirname(base))),
+                            os.path.basename(base))
+        with open(path, 'wb') as fp:
+            fp.write(data)
+        self.logger.info('Patched %s with %d pdiffs' % (base, len(patches)))
+        return True
+
+    def read_index(self, candidates):
+        """Decompressed contents of the first of candidates (paths to variants
+        of the same index, in order of preference) that exists"""
+        for path, decompress in candidates:
+            if os.path.exists(path):
+                with open(path, 'rb') as fp:
+                    return decompress(fp.read())
+        return None
+
+    def pool_entries(self, suite, indices, unchanged):
+        """Map the pool path of every file the new indices list to its sha256 and size"""
+        staging = self.staging_dir(suite)
+        distdir = self.distdir(suite)
+        entries = {}
+        for base in sorted(set(self.index_base(path) for path in indices)):
+            candidates = []
+            for suffix, decompress in DECOMPRESSORS:
+                if base + suffix in unchanged:
+                    candidates.append((os.path.join(distdir, base + suffix), decompress))
+                else:
+                    candidates.append((os.path.join(staging, base + suffix), decompress))
+            data = self.read_index(candidates)
+            if data is None:
+                raise DownloadFailed(self.suite_url(suite, base), status=404)
+            entries.update(pool_entries(base, data))
+
+            # Keep an uncompressed copy around to apply pdiffs to next time
+            uncompressed = os.path.join(staging, base)
+            if (base in indices and base not in unchanged and not os.path.exists(uncompressed) and
+                    hashlib.sha256(data).hexdigest() == indices[base]['sha256']):
+                with open(uncompressed, 'wb') as fp:
+                    fp.write(data)
+        return entries
+
+    def published_release(self, suite):
+        """Contents of the published Release (or InRelease) file of suite,
+        or None if suite has not been published"""
+        distdir = self.distdir(suite)
+        for name in ('Release', 'InRelease'):
+            if os.path.exists(os.path.join(distdir, name)):
+                with open(os.path.join(distdir, name), 'rb') as fp:
+                    return fp.read()
+        return None
+
+    def published_indices(self, suite, release_data):
+        """Yield (path, decompressed contents) of the published indices of
+        suite that release_data lists"""
+        distdir = self.distdir(suite)
+        release, files = parse_release(release_data)
+        for base in sorted(set(self.index_base(path) for path in self.wanted_indices(files))):
+            data = self.read_index([(os.path.join(distdir, base + suffix), decompress)
+                                    for suffix, decompress in DECOMPRESSORS])
+            if data is not None:
+                yield base, data
+
+    def published_pool_entries(self, suite):
+        """Map the pool path of every file the published indices of suite
+        list to its sha256 and size"""
+        release_data = self.published_release(suite)
+        if release_data is None:
+            return {}
+
+        entries = {}
+        for base, data in self.published_indices(suite, release_data):
+            entries.update(pool_entries(base, data))
+        return entries
+
+    def update_manifest(self, suite):
+        """Record the published indices of suite in the manifest, unless it
+        has them already. Returns the pool paths new to the manifest."""
+        if self.manifest is None:
+            return []
+
+        release_data = self.published_release(suite)
+        if release_data is None:
+            return []
+        release_sha256 = hashlib.sha256(release_data).hexdigest()
+        if self.manifest.is_current(suite, release_sha256):
+            return []
+
+        files, packages = {}, []
+        for base, data in self.published_indices(suite, release_data):
+            component = base.split('/')[0]
+            for path, info, package in index_files(base, data):
+                files[path] = info
+                packages.append(dict(package, path=path, component=component))
+        return self.manifest.update_suite(suite, release_sha256, files, packages)
+
+    def index_base(self, path):
+        """main/binary-amd64/Packages.gz -> main/binary-amd64/Packages"""
+        for suffix, _ in DECOMPRESSORS:
+            if suffix and path.endswith(suffix):
+                return path[:-len(suffix)]
+        return path
+
+    def fetch_pool(self, entries, published=None):
+        """Download the pool files in entries that we do not have yet
+
+        Files listed with the same checksum in published are known to be
+        present already, so they are not even looked at."""
+        published = published or {}
+        items = []
+        for path, info in sorted(entries.items()):
+            if published.get(path) == info:
+                continue
+            dest = os.path.join(self.destdir, path)
+            if os.path.exists(dest) and os.path.getsize(dest) == info['size']:
+                # Files from before we had a blob store have to be
+                # checked before they go into it
+                if (self.blob_store is not None and os.stat(dest).st_nlink == 1 and
+                        sha256_file(dest) == info['sha256']):
+                    self.blob_store.dedupe(dest, info['sha256'])
+                continue
+            if self.reuse_blob(dest, info):
+                continue
+            items.append(('%s/%s' % (self.url, path), dest, info['sha256'], info['size']))
+        self.download(items)
+
+        if self.blob_store is not None:
+            for url, dest, sha256, size in items:
+                self.blob_store.dedupe(dest, sha256)
+
+    def fetch_file(self, path, info):
+        """Fetch the pool file at path, listed with info, unless we have it
+        already. Returns where it is.
+
+        Concurrent calls for the same file wait for the first one rather
+        than download it again."""
+        dest = os.path.join(self.destdir, path)
+        if os.path.exists(dest):
+            return dest
+
+        lockpath = self.fetch_lock_path(path)
+        ensure_dir(os.path.dirname(lockpath))
+        with file_lock(lockpath):
+            # Whoever held the lock before us has fetched it, unless they failed
+            self.fetch_pool({path: info})
+        return dest
+
+    def fetch_lock_path(self, path):
+        return os.path.join(self.destdir, '.fetch-locks', path + '.lock')
+
+    def sweep_fetch_locks(self):
+        """Remove the fetch_file() locks of files that are in the pool
+
+        Nobody takes those any more, and anyone still waiting for one finds
+        the file in place once they get it. The locks of files not fetched
+        yet have to stay: if one went, a caller still waiting for it and a
+        newcomer creating it afresh would both think they held it."""
+        lockdir = os.path.join(self.destdir, '.fetch-locks')
+        for dirpath, dirnames, filenames in os.walk(lockdir):
+            for filename in filenames:
+                lockpath = os.path.join(dirpath, filename)
+                path = os.path.relpath(lockpath, lockdir)[:-len('.lock')]
+                if os.path.exists(os.path.join(self.destdir, path)):
+                    os.unlink(lockpath)
+
+    def reuse_blob(self, dest, info):
+        """Link dest to the blob store's copy of it, if there is one"""
+        if self.blob_store is None or info['sha256'] not in self.blob_store:
+            return False
+        try:
+            self.blob_store.link(info['sha256'], dest)
+        except OSError as e:
+            # Garbage collected in the meantime
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+        self.stats['reused'] += 1
+        self.stats['reused_bytes'] += info['size']
+        return True
+
+    def download(self, items, missing_ok=False):
+        downloaded, failed = self.downloader.fetch_many(items, missing_ok=missing_ok)
+        self.stats['files'] += len(items) - len(failed)
+        self.stats['bytes'] += downloaded
+        if failed:
+            raise DownloadFailed(failed[0][0], reason='%d of %d files failed to download' % (len(failed), len(items)))
+
+    def publish_suite(self, suite, release, indices, unchanged, release_files):
+        """Publish the new indices and Release files of suite
+
+        They are put in place in a hardlinked copy of the published suite,
+        which dists/<suite> is then switched to in a single rename, so
+        clients never see new indices listed by an old Release or vice
+        versa."""
+        staging = self.staging_dir(suite)
+        previous = self.published_release(suite)
+        newdir = os.path.join(ensure_dir(self.generations_dir(suite)), '%017.6f' % (time.time(),))
+        if os.path.isdir(self.distdir(suite)):
+            hardlink_tree(self.distdir(suite), newdir)
+        else:
+            ensure_dir(newdir)
+        by_hash = release.get('Acquire-By-Hash', 'no') == 'yes'
+
+        for path, info in sorted(indices.items()):
+            if path in unchanged:
+                continue
+            src = os.path.join(staging, path)
+            dest = os.path.join(newdir, path)
+            if not os.path.exists(src):
+                # Not available upstream, or superseded by a patched
+                # version of another variant. Either way, ours is stale.
+                if os.path.exists(dest):
+                    os.unlink(dest)
+                continue
+            ensure_dir(os.path.dirname(dest))
+            os.rename(src, dest)
+            if by_hash:
+                link = os.path.join(ensure_dir(os.path.join(os.path.dirname(dest), 'by-hash', 'SHA256')),
+                                    info['sha256'])
+                if not os.path.exists(link):
+                    os.link(dest, link)
+
+        for name in RELEASE_FILES:
+            if name in release_files:
+                # Never write to the file itself: it is a hardlink of
+                # the one currently published
+                tmppath = os.path.join(newdir, name + '.new')
+                with open(tmppath, 'wb') as fp:
+                    fp.write(release_files[name])
+                os.rename(tmppath, os.path.join(newdir, name))
+
+        # Clients that fetched the previous Release may still be
+        # fetching the indices it lists by hash
+        listed = set(info['sha256'] for info in indices.values())
+        if previous is not None:
+            listed.update(info['sha256'] for info in parse_release(previous)[1].values())
+        self.prune_by_hash(newdir, listed)
+
+        self.switch_dists(suite, newdir)
+        shutil.rmtree(staging, ignore_errors=True)
+
+    def prune_by_hash(self, distdir, listed):
+        """Remove by-hash links under distdir to hashes not in listed"""
+        for dirpath, dirnames, filenames in os.walk(distdir):
+            if os.path.basename(dirpath) == 'SHA256' and os.path.basename(os.path.dirname(dirpath)) == 'by-hash':
+                for filename in filenames:
+                    if filename not in listed:
+                        os.unlink(os.path.join(dirpath, filename))
+
+    def switch_dists(self, suite, newdir):
+        """Point dists/<suite> at newdir and remove all but the previous
+        of the older copies of suite"""
+        distdir = self.distdir(suite)
+        parent = ensure_dir(os.path.dirname(distdir))
+        generations = self.generations_dir(suite)
+        if os.path.isdir(distdir) and not os.path.islink(distdir):
+            # Published before dists/<suite> was switched atomically. There
+            # is no way around replacing it in two steps this once.
+            os.rename(distdir, os.path.join(generations, '%017.6f' % (time.time() - 1,)))
+        tmplink = os.path.join(parent, '.%s.new' % (os.path.basename(distdir),))
+        if os.path.lexists(tmplink):
+            os.unlink(tmplink)
+        os.symlink(os.path.relpath(newdir, parent), tmplink)
+        os.rename(tmplink, distdir)
+
+        older = sorted(name for name in os.listdir(generations) if name != os.path.basename(newdir))
+        for name in older[:-1]:
+            shutil.rmtree(os.path.join(generations, name), ignore_errors=True)
+
+    def queue_cleanup(self, paths):
+        """Schedule pool files that are no longer listed for removal"""
+        if not paths:
+            return
+        with open(self.cleanup_queue(), 'a') as fp:
+            for path in sorted(paths):
+                fp.write('%d %s\n' % (time.time(), path))
+        self.logger.info('Queued %d files for removal' % (len(paths),))
+
+    def cleanup(self):
+        """Remove the queued pool files that are due and still not listed by
+        any suite, and the locks of files fetched on demand"""
+        self.sweep_fetch_locks()
+        queue = self.cleanup_queue()
+        if not os.path.exists(queue):
+            return
+
+        with open(queue, 'r') as fp:
+            queued = [line.rstrip('\n').split(' ', 1) for line in fp if line.strip()]
+
+        cutoff = time.time() - self.cleanup_delay
+        due = set(path for queued_at, path in queued if int(queued_at) <= cutoff)
+        pending = [(queued_at, path) for queued_at, path in queued if path not in due]
+
+        if due:
+            listed = set()
+            for suite in self.suites:
+                listed.update(self.published_pool_entries(suite))
+            for path in sorted(due - listed):
+                fullpath = os.path.join(self.destdir, path)
+                if os.path.exists(fullpath):
+                    os.unlink(fullpath)
+                    self.stats['removed'] += 1
+            if self.manifest is not None:
+                self.manifest.remove_files(due - listed)
+
+        tmppath = queue + '.new'
+        with open(tmppath, 'w') as fp:
+            for queued_at, path in pending:
+                fp.write('%s %s\n' % (queued_at, path))
+        os.rename(tmppath, queue)
@@ -6,7 +6,8 @@ from aasemble.django.apps.mirrorsvc.models import Mirror, MirrorSet, Tags
 class MirrorDefinitionForm(ModelForm):
     class Meta:
         model = Mirror
-        fields = ['url', 'series', 'components', 'public']
+        fields = ['url', 'series', 'components', 'public', 'refresh_interval',
+                  'architectures', 'on_demand']
 
 
 class MirrorSetDefinitionForm(ModelForm):
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ...models import Mirror
+
+
+class Command(BaseCommand):
+    help = 'Checks the pool files of a mirror against its manifest'
+
+    def add_arguments(self, parser):
+        parser.add_argument('uuid')
+
+    def handle(self, *args, **options):
+        try:
+            mirror = Mirror.objects.get(uuid=options['uuid'])
+        except (Mirror.DoesNotExist, ValueError):
+            raise CommandError('No mirror with UUID %s' % (options['uuid'],))
+        if mirror.backing is None:
+            raise CommandError('%s has not been refreshed yet' % (mirror,))
+
+        bad = 0
+        for path in mirror.backing.manifest().verify():
+            self.stderr.write('Missing or corrupt: %s' % (path,))
+            bad += 1
+        if bad:
+            raise CommandError('%d pool files are missing or corrupt' % (bad,))
+        self.stdout.write('All pool files of %s are present and intact' % (mirror,))
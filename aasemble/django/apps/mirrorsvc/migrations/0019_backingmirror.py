@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.2 on 2026-10-18 09:12
+from __future__ import unicode_literals
+
+import uuid
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mirrorsvc', '0018_relative_symlinks'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BackingMirror',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('uuid', models.UUIDField(default=uuid.uuid4, editable=False, unique=True)),
+                ('url', models.URLField()),
+                ('series', models.CharField(max_length=1000)),
+                ('components', models.CharField(max_length=1000)),
+                ('refresh_in_progress', models.BooleanField(default=False)),
+                ('refresh_requested', models.BooleanField(default=False)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='mirror',
+            name='backing',
+            field=models.ForeignKey(blank=True, null=True, on_delete=models.SET_NULL, related_name='mirrors', to='mirrorsvc.BackingMirror'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.2 on 2026-10-18 11:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mirrorsvc', '0019_backingmirror'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='backingmirror',
+            name='bytes_downloaded',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='backingmirror',
+            name='bytes_saved',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='backingmirror',
+            name='bytes_shared',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.2 on 2026-10-18 13:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def mark_existing_snapshots_ready(apps, schema_editor):
+    # Until now, snapshots were taken as soon as they were created
+    Snapshot = apps.get_model("mirrorsvc", "Snapshot")
+    Snapshot.objects.all().update(state=3, progress=100)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mirrorsvc', '0020_backingmirror_stats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='snapshot',
+            name='progress',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='snapshot',
+            name='state',
+            field=models.SmallIntegerField(choices=[(1, 'Pending'), (2, 'In progress'), (3, 'Ready'), (4, 'Failed')], default=1),
+        ),
+        migrations.RunPython(mark_existing_snapshots_ready, migrations.RunPython.noop),
+    ]
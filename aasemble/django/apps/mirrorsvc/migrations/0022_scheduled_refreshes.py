@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.2 on 2026-10-18 15:21
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mirrorsvc', '0021_snapshot_state'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='backingmirror',
+            name='last_refreshed',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='backingmirror',
+            name='next_refresh',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='backingmirror',
+            name='refresh_started',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='mirror',
+            name='refresh_interval',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.2 on 2026-10-18 16:04
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mirrorsvc', '0022_scheduled_refreshes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='backingmirror',
+            name='architectures',
+            field=models.CharField(blank=True, default='amd64', max_length=200),
+        ),
+        migrations.AddField(
+            model_name='backingmirror',
+            name='include_source',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='backingmirror',
+            name='packages',
+            field=models.CharField(blank=True, max_length=1000),
+        ),
+        migrations.AddField(
+            model_name='backingmirror',
+            name='priorities',
+            field=models.CharField(blank=True, max_length=200),
+        ),
+        migrations.AddField(
+            model_name='mirror',
+            name='architectures',
+            field=models.ManyToManyField(blank=True, to='mirrorsvc.Architecture'),
+        ),
+        migrations.AddField(
+            model_name='mirror',
+            name='packages',
+            field=models.CharField(blank=True, max_length=1000),
+        ),
+        migrations.AddField(
+            model_name='mirror',
+            name='priorities',
+            field=models.CharField(blank=True, max_length=200),
+        ),
+    ]
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.2 on 2026-10-18 17:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mirrorsvc', '0023_mirror_filters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ManifestSuite',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=200)),
+                ('release_sha256', models.CharField(max_length=64)),
+                ('backing', models.ForeignKey(on_delete=models.CASCADE, related_name='manifest_suites', to='mirrorsvc.BackingMirror')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='PackageEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('component', models.CharField(max_length=100)),
+                ('package', models.CharField(max_length=200)),
+                ('version', models.CharField(max_length=200)),
+                ('architecture', models.CharField(max_length=50)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='PoolFile',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=500)),
+                ('size', models.BigIntegerField()),
+                ('sha256', models.CharField(db_index=True, max_length=64)),
+                ('backing', models.ForeignKey(on_delete=models.CASCADE, related_name='pool_files', to='mirrorsvc.BackingMirror')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='packageentry',
+            name='pool_file',
+            field=models.ForeignKey(on_delete=models.CASCADE, related_name='packages', to='mirrorsvc.PoolFile'),
+        ),
+        migrations.AddField(
+            model_name='packageentry',
+            name='suite',
+            field=models.ForeignKey(on_delete=models.CASCADE, related_name='packages', to='mirrorsvc.ManifestSuite'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='poolfile',
+            unique_together=set([('backing', 'path')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='manifestsuite',
+            unique_together=set([('backing', 'name')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='packageentry',
+            index_together=set([('suite', 'package')]),
+        ),
+    ]
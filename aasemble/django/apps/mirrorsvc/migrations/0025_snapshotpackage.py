@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.2 on 2026-10-18 18:03
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mirrorsvc', '0024_pool_manifest'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SnapshotPackage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('suite', models.CharField(max_length=200)),
+                ('component', models.CharField(max_length=100)),
+                ('package', models.CharField(max_length=200)),
+                ('version', models.CharField(max_length=200)),
+                ('architecture', models.CharField(max_length=50)),
+                ('snapshot', models.ForeignKey(on_delete=models.CASCADE, related_name='packages', to='mirrorsvc.Snapshot')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='snapshot',
+            name='packages_recorded',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AlterIndexTogether(
+            name='snapshotpackage',
+            index_together=set([('snapshot', 'package')]),
+        ),
+    ]
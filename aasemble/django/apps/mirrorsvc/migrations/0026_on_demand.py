@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.2 on 2026-10-18 18:47
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mirrorsvc', '0025_snapshotpackage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='backingmirror',
+            name='on_demand',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='mirror',
+            name='on_demand',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.2 on 2026-10-18 19:12
+from __future__ import unicode_literals
+
+import os
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def link_snapshots_to_backings(apps, schema_editor):
+    Snapshot = apps.get_model("mirrorsvc", "Snapshot")
+    for snapshot in Snapshot.objects.all():
+        snapshot.backings.set(set(mirror.backing_id for mirror in snapshot.mirrorset.mirrors.all()
+                                  if mirror.backing_id is not None))
+
+        # Pool links used to go through the mirror, which may be deleted
+        # before the snapshot. Point them at the backing mirror instead.
+        snapshot_dir = os.path.join(settings.MIRRORSVC_BASE_PATH, 'snapshots', str(snapshot.uuid))
+        for dirpath, dirnames, filenames in os.walk(snapshot_dir):
+            link = os.path.join(dirpath, 'pool')
+            if 'pool' in dirnames and os.path.islink(link) and os.path.isdir(link):
+                target = os.path.realpath(link)
+                os.unlink(link)
+                os.symlink(target, link)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mirrorsvc', '0026_on_demand'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='snapshot',
+            name='backings',
+            field=models.ManyToManyField(blank=True, related_name='snapshots', to='mirrorsvc.BackingMirror'),
+        ),
+        migrations.RunPython(link_snapshots_to_backings, reverse_code=migrations.RunPython.noop),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.2 on 2026-10-18 23:41
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+def clear_filters(apps, schema_editor):
+    # They only ever kept files out of the pool that the indices still list
+    Mirror = apps.get_model("mirrorsvc", "Mirror")
+    Mirror.objects.exclude(packages='', priorities='').update(packages='', priorities='')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mirrorsvc', '0027_snapshot_backings'),
+    ]
+
+    operations = [
+        migrations.RunPython(clear_filters, reverse_code=migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='backingmirror',
+            name='packages',
+        ),
+        migrations.RemoveField(
+            model_name='backingmirror',
+            name='priorities',
+        ),
+    ]
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.2 on 2026-10-18 23:58
+from __future__ import unicode_literals
+
+import os
+
+from django.conf import settings
+from django.db import migrations
+
+from aasemble.utils import hardlink_tree
+
+
+def hardlink_snapshot_pools(apps, schema_editor):
+    # Snapshots used to link to the pool of the backing mirror, which loses
+    # the files refreshes stop listing. Give them links of their own.
+    Snapshot = apps.get_model("mirrorsvc", "Snapshot")
+    for snapshot in Snapshot.objects.all():
+        snapshot_dir = os.path.join(settings.MIRRORSVC_BASE_PATH, 'snapshots', str(snapshot.uuid))
+        for dirpath, dirnames, filenames in os.walk(snapshot_dir):
+            link = os.path.join(dirpath, 'pool')
+            if 'pool' in dirnames and os.path.islink(link):
+                dirnames.remove('pool')
+                target = os.path.realpath(link)
+                os.unlink(link)
+                if os.path.isdir(target):
+                    hardlink_tree(target, link)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mirrorsvc', '0028_no_mirror_filters'),
+    ]
+
+    operations = [
+        migrations.RunPython(hardlink_snapshot_pools, reverse_code=migrations.RunPython.noop),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.2 on 2026-10-19 00:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mirrorsvc', '0029_snapshot_pool_links'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='backingmirror',
+            name='refresh_queued',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
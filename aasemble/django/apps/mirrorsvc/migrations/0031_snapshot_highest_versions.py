@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.2 on 2026-10-19 00:40
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+def rerecord_snapshot_packages(apps, schema_editor):
+    # Snapshots used to record every version their indices listed. They
+    # are recorded again, with only the highest ones, when first compared.
+    apps.get_model("mirrorsvc", "SnapshotPackage").objects.all().delete()
+    apps.get_model("mirrorsvc", "Snapshot").objects.update(packages_recorded=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mirrorsvc', '0030_backingmirror_refresh_queued'),
+    ]
+
+    operations = [
+        migrations.RunPython(rerecord_snapshot_packages, reverse_code=migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.2 on 2026-10-19 01:20
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mirrorsvc', '0031_snapshot_highest_versions'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='mirror',
+            name='packages',
+        ),
+        migrations.RemoveField(
+            model_name='mirror',
+            name='priorities',
+        ),
+    ]
@@ -1,21 +1,50 @@
+import contextlib
+import datetime
 import logging
 import os.path
+import random
+import shutil
 import uuid
+from multiprocessing.pool import ThreadPool
+
+from debian.debian_support import version_compare
 
 from django.conf import settings
 from django.contrib.auth import models as auth_models
 from django.core.urlresolvers import reverse
-from django.db import models
+from django.db import models, transaction
 from django.template.loader import render_to_string
 from django.utils.encoding import python_2_unicode_compatible
+from django.utils.timezone import now
 
 from six.moves.urllib.parse import urlparse
 
 from aasemble.django.apps.mirrorsvc import tasks
-from aasemble.utils import ensure_dir, run_cmd
+from aasemble.django.apps.mirrorsvc.backends import get_mirror_backend, max_concurrent_refreshes
+from aasemble.django.apps.mirrorsvc.engine import ArchiveSync, index_files, wanted_dists_entry
+from aasemble.utils import ensure_dir, file_lock, sha256_file
 
 LOG = logging.getLogger(__name__)
 
+# apt_mirror_prefix of the Architecture that stands for source packages
+SOURCE = 'src'
+
+
+def union(lists):
+    """The items of all of lists, in order of first appearance"""
+    rv = []
+    for items in lists:
+        rv += [item for item in items if item not in rv]
+    return rv
+
+
+def chunks(items, size=500):
+    """items in lists of at most size, to keep queries within the limits
+    some databases place on the number of parameters"""
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
 
 class MirrorSet(models.Model):
     uuid = models.UUIDField(unique=True, default=uuid.uuid4, editable=False)
@@ -42,44 +71,30 @@ class MirrorSet(models.Model):
     def sources_list(self):
         return '\n'.join([mirror.sources_list for mirror in self.mirrors.all()])
 
+    def can_be_snapshotted(self):
+        """Snapshots hardlink the pool files they list, but the pools of
+        mirrors fetched on demand only hold what clients asked for so far"""
+        return not self.mirrors.filter(on_demand=True).exists()
+
     def user_can_modify(self, user):
         return user == self.owner
 
 
-@python_2_unicode_compatible
-class Mirror(models.Model):
-    uuid = models.UUIDField(unique=True, default=uuid.uuid4, editable=False)
-    owner = models.ForeignKey(auth_models.User)
-    url = models.URLField(max_length=200)
-    series = models.CharField(max_length=200)
-    components = models.CharField(max_length=200)
-    public = models.BooleanField(default=False)
-    refresh_in_progress = models.BooleanField(default=False)
-    extra_admins = models.ManyToManyField(auth_models.Group)
-    visible_to_v1_api = models.BooleanField(default=False)
-
-    def __str__(self):
-        return '<Mirror of %s (owner=%s)>' % (self.url, self.owner)
+class ArchiveMixin(object):
+    """On disk layout of a mirrored archive under self.basepath"""
+    # Binary architectures mirrored unless others are selected
+    default_architectures = ['amd64']
 
     def series_list(self):
         return self.series.split(' ')
 
-    def get_config(self):
+    def get_config(self, **options):
         return render_to_string('buildsvc/apt-mirror.conf',
-                                {'mirror': self})
+                                dict(options, mirror=self))
 
-    def write_config(self):
+    def write_config(self, **options):
         with open('%s/mirror.conf' % (self.basepath,), 'w') as fp:
-            fp.write(self.get_config())
-
-    @property
-    def basepath(self):
-        d = os.path.join(settings.MIRRORSVC_BASE_PATH, 'mirrors', str(self.uuid))
-        if not os.path.isdir(d):
-            os.makedirs(d)
-            if self.visible_to_v1_api:
-                os.symlink(d, os.path.join(settings.MIRRORSVC_BASE_PATH, 'mirrors', str(self.id)))
-        return d
+            fp.write(self.get_config(**options))
 
     @property
     def archive_dir(self):
@@ -90,16 +105,6 @@ class Mirror(models.Model):
         parsed_url = urlparse(self.url)
         return os.path.join(parsed_url.netloc, parsed_url.path[1:])
 
-    @property
-    def sources_list(self):
-        rv = ''
-        parsed_url = urlparse(self.url)
-        url = '%s/%s/%s%s' % (settings.MIRRORSVC_BASE_URL, self.uuid, parsed_url.netloc, parsed_url.path)
-        for series in self.series_list():
-            rv += 'deb %s %s %s\n' % (url, series, self.components)
-            rv += 'deb-src %s %s %s\n' % (url, series, self.components)
-        return rv
-
     @property
     def dists(self):
         return os.path.join(self.archive_dir, 'dists')
@@ -108,32 +113,6 @@ class Mirror(models.Model):
     def pool(self):
         return os.path.join(self.archive_dir, 'pool')
 
-    @classmethod
-    def lookup_by_user(cls, user):
-        if not user.is_active:
-            return cls.objects.none()
-        if user.is_superuser:
-            return cls.objects.all()
-        return cls.objects.filter(owner=user) | cls.objects.filter(extra_admins=user.groups.all())
-
-    def schedule_update_mirror(self):
-        if Mirror.objects.filter(id=self.id, refresh_in_progress=False).update(refresh_in_progress=True) > 0:
-            tasks.refresh_mirror.delay(self.id)
-            return True
-        else:
-            # Update already scheduled
-            return False
-
-    def update_mirror(self):
-        self.write_config()
-        try:
-            run_cmd(['apt-mirror', 'mirror.conf'], cwd=self.basepath, logger=self.logger)
-        finally:
-            Mirror.objects.filter(id=self.id).update(refresh_in_progress=False)
-
-    def user_can_modify(self, user):
-        return user == self.owner
-
     @property
     def logger(self):
         logpath = self.logpath()
@@ -164,6 +143,560 @@ class Mirror(models.Model):
 
         return path
 
+
+@python_2_unicode_compatible
+class BackingMirror(ArchiveMixin, models.Model):
+    """The actual mirror of an upstream archive
+
+    Mirrors of the same upstream archive are views on a single
+    BackingMirror, which covers the series and components of all of them,
+    so the archive is only downloaded, stored and refreshed once."""
+    uuid = models.UUIDField(unique=True, default=uuid.uuid4, editable=False)
+    url = models.URLField(max_length=200)
+    series = models.CharField(max_length=1000)
+    components = models.CharField(max_length=1000)
+    refresh_in_progress = models.BooleanField(default=False)
+    refresh_requested = models.BooleanField(default=False)
+    bytes_downloaded = models.BigIntegerField(default=0)
+    bytes_saved = models.BigIntegerField(default=0)
+    bytes_shared = models.BigIntegerField(default=0)
+    refresh_queued = models.DateTimeField(null=True, blank=True)
+    refresh_started = models.DateTimeField(null=True, blank=True)
+    last_refreshed = models.DateTimeField(null=True, blank=True)
+    next_refresh = models.DateTimeField(null=True, blank=True)
+    architectures = models.CharField(max_length=200, default='amd64', blank=True)
+    include_source = models.BooleanField(default=False)
+    on_demand = models.BooleanField(default=False)
+
+    # Seconds before a refresh that found no free slot tries again
+    slot_retry_delay = 10
+
+    def __str__(self):
+        return '<Backing mirror of %s>' % (self.url,)
+
+    @staticmethod
+    def normalise_url(url):
+        return url.rstrip('/') + '/'
+
+    @classmethod
+    def for_mirror(cls, mirror):
+        url = cls.normalise_url(mirror.url)
+        if mirror.backing is not None and mirror.backing.url == url:
+            backing = mirror.backing
+        else:
+            old_backing = mirror.backing
+            backing = cls.objects.filter(url=url).order_by('id').first()
+            if backing is None:
+                backing = cls.objects.create(url=url, series=mirror.series, components=mirror.components)
+            mirror.backing = backing
+            Mirror.objects.filter(id=mirror.id).update(backing=backing)
+            if old_backing is not None:
+                old_backing.release()
+        backing.update_definition()
+        return backing
+
+    def update_definition(self):
+        """Cover the series, components and architectures of all the
+        mirrors backed by this"""
+        mirrors = list(self.mirrors.all())
+        if mirrors:
+            definition = {'series': ' '.join(union(m.series_list() for m in mirrors)),
+                          'components': ' '.join(union(m.components.split(' ') for m in mirrors)),
+                          'architectures': ' '.join(union(m.architecture_list() for m in mirrors)),
+                          'include_source': any(m.include_source for m in mirrors),
+                          # One mirror wanting the whole pool gets it for all
+                          'on_demand': all(m.on_demand for m in mirrors)}
+            if any(getattr(self, field) != value for field, value in definition.items()):
+                for field, value in definition.items():
+                    setattr(self, field, value)
+                BackingMirror.objects.filter(id=self.id).update(**definition)
+
+        # Let the scheduler pick a new time if the interval was shortened
+        # or dropped
+        interval = self.refresh_interval()
+        if self.next_refresh is not None and (interval is None or
+                                              self.next_refresh > now() + datetime.timedelta(seconds=interval)):
+            self.next_refresh = None
+            BackingMirror.objects.filter(id=self.id).update(next_refresh=None)
+
+    def architecture_list(self):
+        return self.architectures.split()
+
+    def refresh_interval(self):
+        """The shortest refresh interval of the mirrors backed by this one"""
+        return self.mirrors.aggregate(models.Min('refresh_interval'))['refresh_interval__min']
+
+    def release(self):
+        """Called when a mirror stops being backed by this one, or a
+        snapshot of one is deleted
+
+        It stays for as long as any snapshot taken of its mirrors does,
+        even once no mirror is backed by this any more."""
+        if self.mirrors.exists():
+            self.update_definition()
+        elif not self.snapshots.exists():
+            self.delete()
+
+    @property
+    def basepath(self):
+        return ensure_dir(os.path.join(settings.MIRRORSVC_BASE_PATH, 'backing', str(self.uuid)))
+
+    def schedule_update(self, mirror):
+        """Refresh on behalf of mirror, unless a refresh is already under way
+
+        If one is, it runs once more when done, so the refresh mirror asked
+        for is not lost, no matter how many of the mirrors backed by this
+        one ask in the meantime."""
+        self.mirrors.update(refresh_in_progress=True)
+        if BackingMirror.objects.filter(id=self.id, refresh_in_progress=False).update(refresh_in_progress=True,
+                                                                                      refresh_requested=False,
+                                                                                      refresh_queued=now(),
+                                                                                      refresh_started=None) > 0:
+            tasks.refresh_mirror.delay(mirror.id)
+            return True
+        else:
+            BackingMirror.objects.filter(id=self.id).update(refresh_requested=True)
+            return False
+
+    @property
+    def refresh_lock_path(self):
+        return os.path.join(self.basepath, '.refresh.lock')
+
+    @contextlib.contextmanager
+    def refresh_slot(self):
+        """Hold one of the MIRRORSVC_MAX_CONCURRENT_REFRESHES refresh slots
+        for the duration of the block, if one is free
+
+        Yields whether one was."""
+        slotdir = ensure_dir(os.path.join(settings.MIRRORSVC_BASE_PATH, '.refresh-slots'))
+        for slot in range(max_concurrent_refreshes()):
+            with file_lock(os.path.join(slotdir, 'slot-%d' % (slot,)), blocking=False) as acquired:
+                if acquired:
+                    yield True
+                    return
+        yield False
+
+    def update(self):
+        """Refresh, unless all refresh slots are taken
+
+        Returns whether it did. If not, the refresh is still pending and
+        should be tried again later."""
+        with self.refresh_slot() as acquired:
+            if not acquired:
+                # Tells recover_stuck_refreshes() the refresh is still queued
+                BackingMirror.objects.filter(id=self.id).update(refresh_queued=now())
+                return False
+            done = False
+            try:
+                # The refresh lock tells recover_stuck_refreshes() we are
+                # alive. Until we have it, the refresh does not count as
+                # started.
+                with file_lock(self.refresh_lock_path):
+                    BackingMirror.objects.filter(id=self.id).update(refresh_started=now())
+                    while not done:
+                        BackingMirror.objects.filter(id=self.id).update(refresh_requested=False)
+                        self.refresh_from_db()
+                        self.record_stats(get_mirror_backend(self).update() or {})
+                        # Unless someone asked for another refresh in the
+                        # meantime, we are done
+                        done = BackingMirror.objects.filter(id=self.id,
+                                                            refresh_requested=False).update(refresh_in_progress=False,
+                                                                                            last_refreshed=now()) > 0
+            finally:
+                if not done:
+                    BackingMirror.objects.filter(id=self.id).update(refresh_in_progress=False)
+                self.mirrors.update(refresh_in_progress=False)
+                self.schedule_next_refresh()
+        return True
+
+    def schedule_next_refresh(self):
+        interval = self.refresh_interval()
+        if interval is None:
+            next_refresh = None
+        else:
+            # Jitter keeps mirrors refreshed at the same time once from
+            # being refreshed at the same time forever
+            jitter = getattr(settings, 'MIRRORSVC_REFRESH_JITTER', 0.1)
+            next_refresh = now() + datetime.timedelta(seconds=interval * random.uniform(1 - jitter, 1 + jitter))
+        BackingMirror.objects.filter(id=self.id).update(next_refresh=next_refresh)
+
+    @classmethod
+    def recover_stuck_refreshes(cls):
+        """Clear refresh_in_progress of refreshes whose worker died
+
+        Refreshes that started more than MIRRORSVC_REFRESH_TIMEOUT seconds
+        ago are only considered stuck if nobody holds their refresh lock.
+        Refreshes still waiting for a slot try again every slot_retry_delay
+        seconds, so they are only stuck if they have not done so for as
+        long, e.g. because the task retrying them was lost."""
+        cutoff = now() - datetime.timedelta(seconds=getattr(settings, 'MIRRORSVC_REFRESH_TIMEOUT', 3600))
+        stuck = (models.Q(refresh_started__lt=cutoff) |
+                 models.Q(refresh_started=None, refresh_queued__lt=cutoff))
+        for backing in cls.objects.filter(stuck, refresh_in_progress=True):
+            with file_lock(backing.refresh_lock_path, blocking=False) as acquired:
+                if not acquired:
+                    continue
+                LOG.warning('Refresh of %s (queued at %s, started at %s) is stuck. Resetting it.' %
+                            (backing, backing.refresh_queued, backing.refresh_started))
+                cls.objects.filter(id=backing.id).update(refresh_in_progress=False, refresh_requested=False)
+                backing.mirrors.update(refresh_in_progress=False)
+
+        # Scheduled before mirrors had backing mirrors
+        Mirror.objects.filter(backing=None, refresh_in_progress=True).update(refresh_in_progress=False)
+
+    @classmethod
+    def schedule_due_refreshes(cls):
+        """Start the refreshes that are due, as long as there are free slots"""
+        cls.recover_stuck_refreshes()
+
+        for mirror in Mirror.objects.filter(backing=None, refresh_interval__isnull=False):
+            cls.for_mirror(mirror)
+
+        # Rather than refreshing everything with a new interval at once,
+        # spread the first refreshes out over the interval
+        current = now()
+        for backing in cls.objects.filter(next_refresh=None, mirrors__refresh_interval__isnull=False).distinct():
+            delay = random.uniform(0, backing.refresh_interval())
+            cls.objects.filter(id=backing.id).update(next_refresh=current + datetime.timedelta(seconds=delay))
+
+        free = max_concurrent_refreshes() - cls.objects.filter(refresh_in_progress=True).count()
+        if free <= 0:
+            return
+        for backing in cls.objects.filter(refresh_in_progress=False, next_refresh__lte=current).order_by('next_refresh')[:free]:
+            mirror = backing.mirrors.first()
+            if mirror is not None:
+                backing.schedule_update(mirror)
+
+    def record_stats(self, stats):
+        """Account for the bandwidth and disk space a refresh used and saved
+
+        bytes_saved counts the downloads the blob store made unnecessary,
+        bytes_shared how much of the pool is stored only once because
+        another mirror carries the same files."""
+        downloaded = int(stats.get('bytes', 0))
+        saved = int(stats.get('reused_bytes', 0)) + int(stats.get('deduplicated_bytes', 0))
+        BackingMirror.objects.filter(id=self.id).update(bytes_downloaded=models.F('bytes_downloaded') + downloaded,
+                                                        bytes_saved=models.F('bytes_saved') + saved,
+                                                        bytes_shared=self.manifest().shared_bytes())
+
+    def manifest(self):
+        return PoolManifest(self)
+
+    def fetch_on_demand(self, path):
+        """Fetch the pool file at path (relative to archive_dir) from upstream,
+        unless we have it already. Returns where it is, or None if none of
+        the published indices list it."""
+        pool_file = self.manifest().pool_files().filter(path=path).first()
+        if pool_file is None:
+            return None
+        dest, stats = get_mirror_backend(self).fetch_file(path, {'sha256': pool_file.sha256,
+                                                                 'size': pool_file.size})
+        if stats['bytes'] or stats['reused_bytes']:
+            self.record_stats(stats)
+        return dest
+
+    def delete_on_filesystem(self):
+        path = os.path.join(settings.MIRRORSVC_BASE_PATH, 'backing', str(self.uuid))
+        if os.path.exists(path):
+            shutil.rmtree(path)
+
+
+class PoolFile(models.Model):
+    """A file in the pool of a backing mirror"""
+    backing = models.ForeignKey(BackingMirror, related_name='pool_files', on_delete=models.CASCADE)
+    path = models.CharField(max_length=500)
+    size = models.BigIntegerField()
+    sha256 = models.CharField(max_length=64, db_index=True)
+
+    class Meta:
+        unique_together = ('backing', 'path')
+
+
+class ManifestSuite(models.Model):
+    """A suite of a backing mirror, as of the Release file with release_sha256"""
+    backing = models.ForeignKey(BackingMirror, related_name='manifest_suites', on_delete=models.CASCADE)
+    name = models.CharField(max_length=200)
+    release_sha256 = models.CharField(max_length=64)
+
+    class Meta:
+        unique_together = ('backing', 'name')
+
+
+class PackageEntry(models.Model):
+    """A package in a suite, and one of the pool files it is made of"""
+    suite = models.ForeignKey(ManifestSuite, related_name='packages', on_delete=models.CASCADE)
+    pool_file = models.ForeignKey(PoolFile, related_name='packages', on_delete=models.CASCADE)
+    component = models.CharField(max_length=100)
+    package = models.CharField(max_length=200)
+    version = models.CharField(max_length=200)
+    architecture = models.CharField(max_length=50)
+
+    class Meta:
+        index_together = ('suite', 'package')
+
+
+class PoolManifest(object):
+    """Index of the pool of a backing mirror and of the packages its suites
+    list, so questions about its contents are answered by queries rather
+    than by walking the pool or parsing indices
+
+    This is the manifest engine.ArchiveSync keeps up to date. Suites are
+    only recorded again when their Release file changes, and then only
+    the differences are written."""
+    def __init__(self, backing):
+        self.backing = backing
+
+    def pool_files(self):
+        return PoolFile.objects.filter(backing=self.backing)
+
+    def is_current(self, suite, release_sha256):
+        return ManifestSuite.objects.filter(backing=self.backing, name=suite, release_sha256=release_sha256).exists()
+
+    @transaction.atomic
+    def update_suite(self, suite, release_sha256, files, packages):
+        known = dict((path, (sha256, size)) for path, sha256, size in
+                     self.pool_files().values_list('path', 'sha256', 'size'))
+        new = [path for path in files if path not in known]
+        PoolFile.objects.bulk_create([PoolFile(backing=self.backing, path=path, **files[path]) for path in new],
+                                     batch_size=500)
+        for path, info in files.items():
+            if path in known and known[path] != (info['sha256'], info['size']):
+                self.pool_files().filter(path=path).update(**info)
+
+        manifest_suite, created = ManifestSuite.objects.get_or_create(backing=self.backing, name=suite,
+                                                                      defaults={'release_sha256': release_sha256})
+        fields = ('component', 'package', 'version', 'architecture')
+        recorded = dict((entry[:-1], entry[-1]) for entry in
+                        manifest_suite.packages.values_list(*(('pool_file__path',) + fields + ('id',))))
+        listed = set((package['path'],) + tuple(package[field] for field in fields) for package in packages)
+
+        for ids in chunks(entry_id for entry, entry_id in recorded.items() if entry not in listed):
+            PackageEntry.objects.filter(id__in=ids).delete()
+
+        pool_file_ids = dict(self.pool_files().values_list('path', 'id'))
+        PackageEntry.objects.bulk_create([PackageEntry(suite=manifest_suite, pool_file_id=pool_file_ids[entry[0]],
+                                                       **dict(zip(fields, entry[1:])))
+                                          for entry in listed if entry not in recorded],
+                                         batch_size=500)
+
+        ManifestSuite.objects.filter(id=manifest_suite.id).update(release_sha256=release_sha256)
+        return new
+
+    def remove_files(self, paths):
+        for batch in chunks(paths):
+            self.pool_files().filter(path__in=batch).delete()
+
+    def prune(self):
+        """Forget suites no longer mirrored and pool files that are neither
+        listed by any suite nor on disk any more"""
+        ManifestSuite.objects.filter(backing=self.backing).exclude(name__in=self.backing.series_list()).delete()
+        archive_dir = self.backing.archive_dir
+        gone = [path for path in self.pool_files().filter(packages=None).values_list('path', flat=True)
+                if not os.path.exists(os.path.join(archive_dir, path))]
+        self.remove_files(gone)
+
+    def size(self):
+        """Bytes stored in the pool"""
+        return self.pool_files().aggregate(models.Sum('size'))['size__sum'] or 0
+
+    def shared_bytes(self):
+        """Bytes of the pool that other backing mirrors carry as well, and
+        hence are stored only once, thanks to the blob store"""
+        shared = self.pool_files().filter(sha256__in=PoolFile.objects.exclude(backing=self.backing).values('sha256'))
+        return shared.aggregate(models.Sum('size'))['size__sum'] or 0
+
+    def verify(self):
+        """Yield the paths of pool files that are missing or do not match
+        their recorded size and sha256"""
+        archive_dir = self.backing.archive_dir
+        for pool_file in self.pool_files().iterator():
+            path = os.path.join(archive_dir, pool_file.path)
+            if (not os.path.exists(path) or os.path.getsize(path) != pool_file.size or
+                    sha256_file(path) != pool_file.sha256):
+                yield pool_file.path
+
+
+@python_2_unicode_compatible
+class Mirror(ArchiveMixin, models.Model):
+    uuid = models.UUIDField(unique=True, default=uuid.uuid4, editable=False)
+    owner = models.ForeignKey(auth_models.User)
+    url = models.URLField(max_length=200)
+    series = models.CharField(max_length=200)
+    components = models.CharField(max_length=200)
+    public = models.BooleanField(default=False)
+    refresh_in_progress = models.BooleanField(default=False)
+    extra_admins = models.ManyToManyField(auth_models.Group)
+    visible_to_v1_api = models.BooleanField(default=False)
+    backing = models.ForeignKey(BackingMirror, null=True, blank=True, related_name='mirrors',
+                                on_delete=models.SET_NULL)
+    refresh_interval = models.PositiveIntegerField(null=True, blank=True)
+    architectures = models.ManyToManyField('Architecture', blank=True)
+    on_demand = models.BooleanField(default=False)
+
+    def __str__(self):
+        return '<Mirror of %s (owner=%s)>' % (self.url, self.owner)
+
+    def selected_architectures(self):
+        return [arch.apt_mirror_prefix for arch in self.architectures.all()]
+
+    def architecture_list(self):
+        """The binary architectures to mirror"""
+        selected = self.selected_architectures()
+        if not selected:
+            return self.default_architectures
+        return [arch for arch in selected if arch != SOURCE]
+
+    @property
+    def include_source(self):
+        return SOURCE in self.selected_architectures()
+
+    def selects(self, path):
+        """Whether path (relative to the archive directory of the backing
+        mirror) is part of the series, components and architectures this
+        mirror selected
+
+        The backing mirror may carry more than that on behalf of other
+        mirrors."""
+        components = self.components.split(' ')
+        architectures = self.architecture_list()
+        parts = path.split('/')
+        if parts[0] == 'dists':
+            for series in self.series_list():
+                prefix = 'dists/%s/' % (series,)
+                if path.startswith(prefix):
+                    rest = path[len(prefix):].split('/')
+                    if len(rest) > 1 and rest[0] not in components:
+                        return False
+                    return all(wanted_dists_entry(name, architectures, self.include_source) for name in rest)
+            return False
+        if parts[0] == 'pool' and self.backing is not None:
+            wanted = architectures + ['all'] + (['source'] if self.include_source else [])
+            return self.backing.manifest().pool_files().filter(path=path,
+                                                               packages__suite__name__in=self.series_list(),
+                                                               packages__component__in=components,
+                                                               packages__architecture__in=wanted).exists()
+        return False
+
+    def backing_mirror(self):
+        """The BackingMirror this is a view on, updated to cover this mirror"""
+        backing = BackingMirror.for_mirror(self)
+        self.link_to_backing(backing)
+        return backing
+
+    @property
+    def linkpath(self):
+        return os.path.join(settings.MIRRORSVC_BASE_PATH, 'mirrors', str(self.uuid))
+
+    def link_to_backing(self, backing):
+        """Make basepath a symlink to the directory of backing"""
+        linkpath = self.linkpath
+        backing_dir = backing.basepath
+        target = os.path.relpath(backing_dir, os.path.dirname(linkpath))
+        ensure_dir(os.path.dirname(linkpath))
+
+        if os.path.islink(linkpath):
+            if os.readlink(linkpath) == target:
+                return
+            os.unlink(linkpath)
+        elif os.path.isdir(linkpath):
+            # Mirrored before mirrors were backed by BackingMirrors
+            if not os.listdir(backing_dir):
+                os.rmdir(backing_dir)
+                os.rename(linkpath, backing_dir)
+            else:
+                LOG.info('Replacing %s with a link to %s' % (linkpath, backing_dir))
+                shutil.rmtree(linkpath)
+
+        os.symlink(target, linkpath)
+        if self.visible_to_v1_api:
+            v1_path = os.path.join(settings.MIRRORSVC_BASE_PATH, 'mirrors', str(self.id))
+            if not os.path.lexists(v1_path):
+                os.symlink(str(self.uuid), v1_path)
+
+    @property
+    def basepath(self):
+        if not os.path.exists(self.linkpath):
+            self.backing_mirror()
+        return self.linkpath
+
+    @property
+    def base_url(self):
+        """Where the mirrors are served. Pool files of on demand mirrors are
+        only fetched when asked for, so those need a web server that hands
+        requests for files it does not have to the mirror_file view."""
+        if self.on_demand:
+            return getattr(settings, 'MIRRORSVC_ON_DEMAND_BASE_URL', settings.MIRRORSVC_BASE_URL)
+        return settings.MIRRORSVC_BASE_URL
+
+    @property
+    def sources_list(self):
+        rv = ''
+        parsed_url = urlparse(self.url)
+        url = '%s/%s/%s%s' % (self.base_url, self.uuid, parsed_url.netloc, parsed_url.path)
+        if not self.selected_architectures():
+            # As before architectures could be selected
+            for series in self.series_list():
+                rv += 'deb %s %s %s\n' % (url, series, self.components)
+                rv += 'deb-src %s %s %s\n' % (url, series, self.components)
+            return rv
+
+        architectures = self.architecture_list()
+        for series in self.series_list():
+            if architectures:
+                rv += 'deb [arch=%s] %s %s %s\n' % (','.join(architectures), url, series, self.components)
+            if self.include_source:
+                rv += 'deb-src %s %s %s\n' % (url, series, self.components)
+        return rv
+
+    @classmethod
+    def lookup_by_user(cls, user):
+        if not user.is_active:
+            return cls.objects.none()
+        if user.is_superuser:
+            return cls.objects.all()
+        return cls.objects.filter(owner=user) | cls.objects.filter(extra_admins=user.groups.all())
+
+    def user_can_view(self, user):
+        return self.public or Mirror.lookup_by_user(user).filter(id=self.id).exists()
+
+    def schedule_update_mirror(self):
+        return BackingMirror.for_mirror(self).schedule_update(self)
+
+    def update_mirror(self):
+        """Returns False if no refresh slot was free, see BackingMirror.update()"""
+        done = True
+        try:
+            done = self.backing_mirror().update()
+            return done
+        finally:
+            if done:
+                Mirror.objects.filter(id=self.id).update(refresh_in_progress=False)
+
+    def delete_on_filesystem(self):
+        for path in (self.linkpath, os.path.join(settings.MIRRORSVC_BASE_PATH, 'mirrors', str(self.id))):
+            if os.path.islink(path):
+                os.unlink(path)
+
+    def user_can_modify(self, user):
+        return user == self.owner
+
+    @property
+    def bytes_downloaded(self):
+        return self.backing.bytes_downloaded if self.backing is not None else 0
+
+    @property
+    def bytes_saved(self):
+        return self.backing.bytes_saved if self.backing is not None else 0
+
+    @property
+    def bytes_shared(self):
+        return self.backing.bytes_shared if self.backing is not None else 0
+
+    def logfilename(self):
+        if self.backing is not None:
+            return self.backing.logfilename()
+        return super(Mirror, self).logfilename()
+
     def log_url(self):
         return '%s/%s/%s' % (settings.MIRRORSVC_BASE_URL, self.uuid, self.logpath())
 
@@ -178,10 +711,26 @@ class Architecture(models.Model):
 
 
 class Snapshot(models.Model):
+    PENDING = 1
+    IN_PROGRESS = 2
+    READY = 3
+    FAILED = 4
+
+    SNAPSHOT_STATES = (
+        (PENDING, 'Pending'),
+        (IN_PROGRESS, 'In progress'),
+        (READY, 'Ready'),
+        (FAILED, 'Failed'),
+    )
+
     uuid = models.UUIDField(unique=True, default=uuid.uuid4, editable=False)
     timestamp = models.DateTimeField(auto_now_add=True)
     mirrorset = models.ForeignKey(MirrorSet)
     visible_to_v1_api = models.BooleanField(default=False)
+    state = models.SmallIntegerField(default=PENDING, choices=SNAPSHOT_STATES)
+    progress = models.PositiveSmallIntegerField(default=0)
+    packages_recorded = models.BooleanField(default=False)
+    backings = models.ManyToManyField(BackingMirror, blank=True, related_name='snapshots')
 
     @property
     def basepath(self):
@@ -192,18 +741,101 @@ class Snapshot(models.Model):
                 os.symlink(d, os.path.join(settings.MIRRORSVC_BASE_PATH, 'snapshots', str(self.id)))
         return d
 
-    def sync_dists(self):
+    @property
+    def parallel(self):
+        return getattr(settings, 'MIRRORSVC_SNAPSHOT_PARALLEL', 8)
+
+    def dists_files(self):
+        """(source, destination) of every file to copy into the snapshot
+
+        Only the indices of the series, architectures and sources each
+        mirror selected are copied, not everything its backing mirror has."""
         for mirror in self.mirrorset.mirrors.all():
-            destdir = os.path.join(self.basepath, mirror.archive_subpath)
-            if not os.path.exists(destdir):
-                os.makedirs(destdir)
-            run_cmd(['rsync', '-aHAPvi', '--exclude=**/i18n', mirror.dists, destdir])
+            destdir = os.path.join(self.basepath, mirror.archive_subpath, 'dists')
+            series = mirror.series_list()
+            components = mirror.components.split(' ')
+            architectures = mirror.architecture_list()
+            for dirpath, dirnames, filenames in os.walk(mirror.dists, followlinks=True):
+                relpath = os.path.relpath(dirpath, mirror.dists)
+                if relpath == '.':
+                    dirnames[:] = [d for d in dirnames if d in series]
+                    continue
+                if os.path.dirname(relpath) == '':
+                    dirnames[:] = [d for d in dirnames if d in components]
+                dirnames[:] = [d for d in dirnames
+                               if d != 'i18n' and wanted_dists_entry(d, architectures, mirror.include_source)]
+                for filename in filenames:
+                    if wanted_dists_entry(filename, architectures, mirror.include_source):
+                        yield (os.path.join(dirpath, filename), os.path.join(destdir, relpath, filename))
+
+    def link_files(self, files):
+        """Hardlink each of files, a list of (source, destination), with
+        parallel threads, reporting progress along the way"""
+        for dirname in sorted(set(os.path.dirname(dst) for src, dst in files)):
+            ensure_dir(dirname)
+
+        def link(item):
+            src, dst = item
+            if os.path.lexists(dst):
+                # Another mirror of the set shares this archive
+                return
+            if os.path.islink(src):
+                os.symlink(os.readlink(src), dst)
+            else:
+                os.link(src, dst)
+
+        pool = ThreadPool(self.parallel)
+        try:
+            progress = 0
+            for done, _ in enumerate(pool.imap_unordered(link, files), 1):
+                if done * 100 // len(files) > progress:
+                    progress = done * 100 // len(files)
+                    Snapshot.objects.filter(id=self.id).update(progress=progress)
+        finally:
+            pool.close()
 
-    def symlink_pool(self):
+    def sync_dists(self):
+        """Hardlink the dists/ of every mirror into the snapshot
+
+        Mirrors only ever replace files in dists/, never modify them in
+        place, so this is as good as a copy."""
+        self.link_files(list(self.dists_files()))
+
+    def indexed_files(self, mirror):
+        """Yield (suite, component, pool path, package) for every file the
+        snapshot's own copies of the indices of mirror list"""
+        archive = ArchiveSync(mirror.url, os.path.join(self.basepath, mirror.archive_subpath),
+                              suites=mirror.series_list(), components=mirror.components.split(' '),
+                              architectures=mirror.architecture_list(), include_source=mirror.include_source)
+        for suite in mirror.series_list():
+            release_data = archive.published_release(suite)
+            if release_data is None:
+                continue
+            for base, data in archive.published_indices(suite, release_data):
+                component = base.split('/')[0]
+                for path, info, package in index_files(base, data):
+                    yield suite, component, path, package
+
+    def link_pool(self):
+        """Hardlink the pool files the indices of the snapshot list into it
+
+        Refreshes remove the pool files their mirror no longer lists, so
+        the snapshot cannot simply point at the pool of the backing mirror.
+        The backing mirrors are recorded in backings all the same."""
+        backings = []
+        files = set()
         for mirror in self.mirrorset.mirrors.all():
-            destdir = os.path.join(self.basepath, mirror.archive_subpath, 'pool')
-            if not os.path.exists(destdir):
-                os.symlink(mirror.pool, destdir)
+            backing = mirror.backing_mirror()
+            backings.append(backing)
+            destdir = os.path.join(self.basepath, mirror.archive_subpath)
+            for suite, component, path, package in self.indexed_files(mirror):
+                src = os.path.join(backing.archive_dir, path)
+                if not os.path.exists(src):
+                    LOG.warning('%s is listed by %s, but missing from its pool' % (path, mirror))
+                    continue
+                files.add((src, os.path.join(destdir, path)))
+        self.link_files(sorted(files))
+        self.backings.set(backings)
 
     def save(self, *args, **kwargs):
         perform_snapshot = False
@@ -217,13 +849,124 @@ class Snapshot(models.Model):
             tasks.perform_snapshot.apply_async((self.id,), countdown=5)
 
     def perform_snapshot(self):
-        self.sync_dists()
-        self.symlink_pool()
+        started = Snapshot.objects.filter(id=self.id).exclude(state=Snapshot.READY).update(state=Snapshot.IN_PROGRESS,
+                                                                                           progress=0)
+        if not started:
+            # Snapshots are immutable
+            return
+
+        if not self.mirrorset.can_be_snapshotted():
+            Snapshot.objects.filter(id=self.id).update(state=Snapshot.FAILED)
+            return
+
+        try:
+            self.sync_dists()
+            self.link_pool()
+            self.record_packages()
+        except Exception:
+            Snapshot.objects.filter(id=self.id).update(state=Snapshot.FAILED)
+            raise
+
+        Snapshot.objects.filter(id=self.id).update(state=Snapshot.READY, progress=100)
+
+    def record_packages(self):
+        """Record the highest version of each package the indices of the
+        snapshot list in SnapshotPackage
+
+        That is the version apt installs, and with only one version per
+        package the database can tell on its own which packages differ
+        between snapshots."""
+        highest = {}
+        for mirror in self.mirrorset.mirrors.all():
+            for suite, component, path, package in self.indexed_files(mirror):
+                key = (suite, package['package'], package['architecture'])
+                if key not in highest or version_compare(package['version'], highest[key][1]) > 0:
+                    highest[key] = (component, package['version'])
+
+        with transaction.atomic():
+            SnapshotPackage.objects.filter(snapshot=self).delete()
+            SnapshotPackage.objects.bulk_create([SnapshotPackage(snapshot=self, suite=suite, component=component,
+                                                                 package=package, version=version,
+                                                                 architecture=architecture)
+                                                 for (suite, package, architecture), (component, version)
+                                                 in highest.items()],
+                                                batch_size=500)
+            Snapshot.objects.filter(id=self.id).update(packages_recorded=True)
+        self.packages_recorded = True
+
+    def diff(self, other):
+        """The packages added, removed, upgraded or downgraded since the
+        snapshot other, sorted by package name
+
+        Both must have their packages recorded."""
+        return SnapshotDiff(other, self)
 
     def user_can_modify(self, user):
         return user == self.mirrorset.owner
 
 
+class SnapshotPackage(models.Model):
+    """The highest version of a package listed by the indices of a snapshot"""
+    snapshot = models.ForeignKey(Snapshot, related_name='packages', on_delete=models.CASCADE)
+    suite = models.CharField(max_length=200)
+    component = models.CharField(max_length=100)
+    package = models.CharField(max_length=200)
+    version = models.CharField(max_length=200)
+    architecture = models.CharField(max_length=50)
+
+    class Meta:
+        index_together = ('snapshot', 'package')
+
+
+class SnapshotDiff(object):
+    """The changes between the packages of two snapshots, as a sequence
+    that can be sliced (and so paginated)
+
+    The database works out which packages differ, a slice at a time, so
+    neither snapshot is ever loaded as a whole. Only telling upgrades
+    from downgrades takes Debian version ordering, which is done for the
+    slice asked for."""
+    def __init__(self, old, new):
+        self.old = old
+        self.new = new
+
+        def version_in(snapshot):
+            # Snapshots record one version of each package
+            return models.Max(models.Case(models.When(snapshot=snapshot.id, then='version')))
+
+        self.changed = (SnapshotPackage.objects.filter(snapshot__in=[old.id, new.id])
+                        .values('package', 'architecture', 'suite')
+                        .annotate(old_version=version_in(old), new_version=version_in(new),
+                                  snapshots=models.Count('snapshot'))
+                        .exclude(snapshots=2, old_version=models.F('new_version'))
+                        .order_by('package', 'architecture', 'suite'))
+
+    def count(self):
+        return self.changed.count()
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self[index:index + 1][0]
+
+        changes = []
+        for row in self.changed[index]:
+            old_version, new_version = row['old_version'], row['new_version']
+            if old_version is None:
+                change = 'added'
+            elif new_version is None:
+                change = 'removed'
+            elif version_compare(new_version, old_version) > 0:
+                change = 'upgraded'
+            else:
+                change = 'downgraded'
+            changes.append({'package': row['package'], 'architecture': row['architecture'], 'suite': row['suite'],
+                            'old_version': old_version, 'new_version': new_version, 'change': change})
+        return changes
+
+
 class Tags(models.Model):
     snapshot = models.ForeignKey(Snapshot, related_name='tags')
     tag = models.CharField(max_length=200)
@@ -0,0 +1,43 @@
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from . import models
+
+
+@receiver(post_save, sender=models.Mirror)
+def mirror_post_save_handler(sender, instance, raw=False, **kwargs):
+    # Mirrors are only attached to a backing mirror once they are
+    # refreshed. After that, keep the backing mirror in line with them.
+    if not raw and instance.backing_id is not None:
+        instance.backing_mirror()
+
+
+@receiver(m2m_changed, sender=models.Mirror.architectures.through)
+def mirror_architectures_changed_handler(sender, instance, action, reverse=False, **kwargs):
+    if not reverse and action.startswith('post_') and instance.backing_id is not None:
+        instance.backing_mirror()
+
+
+@receiver(post_delete, sender=models.Mirror)
+def mirror_post_delete_handler(sender, instance, **kwargs):
+    instance.delete_on_filesystem()
+    backing = models.BackingMirror.objects.filter(id=instance.backing_id).first()
+    if backing is not None:
+        backing.release()
+
+
+@receiver(post_delete, sender=models.BackingMirror)
+def backing_mirror_post_delete_handler(sender, instance, **kwargs):
+    instance.delete_on_filesystem()
+
+
+@receiver(pre_delete, sender=models.Snapshot)
+def snapshot_pre_delete_handler(sender, instance, **kwargs):
+    # The links to them are gone by the time post_delete is sent
+    instance.released_backings = list(instance.backings.all())
+
+
+@receiver(post_delete, sender=models.Snapshot)
+def snapshot_post_delete_handler(sender, instance, **kwargs):
+    for backing in getattr(instance, 'released_backings', []):
+        backing.release()
@@ -1,11 +1,14 @@
 from celery import shared_task
 
 
-@shared_task(ignore_result=True)
-def refresh_mirror(mirror_id):
-    from .models import Mirror
+@shared_task(bind=True, ignore_result=True, max_retries=None)
+def refresh_mirror(self, mirror_id):
+    from .models import BackingMirror, Mirror
     ps = Mirror.objects.get(id=mirror_id)
-    ps.update_mirror()
+    if not ps.update_mirror():
+        # All refresh slots are taken. Rather than tie up the worker
+        # waiting for one, come back later.
+        raise self.retry(countdown=BackingMirror.slot_retry_delay)
 
 
 @shared_task(ignore_result=True)
@@ -13,3 +16,16 @@ def perform_snapshot(snapshot_id):
     from .models import Snapshot
     s = Snapshot.objects.get(id=snapshot_id)
     s.perform_snapshot()
+
+
+@shared_task(ignore_result=True)
+def record_snapshot_packages(snapshot_id):
+    from .models import Snapshot
+    s = Snapshot.objects.get(id=snapshot_id)
+    s.record_packages()
+
+
+@shared_task(ignore_result=True)
+def schedule_refreshes():
+    from .models import BackingMirror
+    BackingMirror.schedule_due_refreshes()
@@ -1,12 +1,355 @@
+import datetime
+import gzip
+import hashlib
+import io
+import os.path
+import shutil
+import tempfile
+import threading
+
+from celery.exceptions import Retry
+
 from django.conf import settings
 from django.contrib.auth import models as auth_models
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.core.urlresolvers import reverse
+from django.test import override_settings
+from django.utils.timezone import now
 
 
 import mock
 
+from six.moves import socketserver
+from six.moves.SimpleHTTPServer import SimpleHTTPRequestHandler
+from six.moves.urllib.parse import urlparse
+
 from aasemble.django.tests import AasembleTestCase as TestCase
+from aasemble.utils import BlobStore, ensure_dir, file_lock, sha256_file
+from aasemble.utils.exceptions import DownloadFailed
+
+from . import engine
+from .models import (Architecture, BackingMirror, Mirror, MirrorSet, PackageEntry, PoolFile, Snapshot, SnapshotPackage,
+                     Tags)
+
+
+def gzip_data(data):
+    buf = io.BytesIO()
+    with gzip.GzipFile(filename='', mode='wb', fileobj=buf) as fp:
+        fp.write(data)
+    return buf.getvalue()
+
+
+def checksum_line(data):
+    return '%s %d' % (hashlib.sha256(data).hexdigest(), len(data))
+
+
+class StandInArchive(object):
+    """A tiny apt archive, served over HTTP from a temporary directory"""
+    def __init__(self):
+        self.root = tempfile.mkdtemp()
+        self.packages = []
+        self.published = None
+
+        root = self.root
+
+        class Handler(SimpleHTTPRequestHandler):
+            def translate_path(self, path):
+                return os.path.join(root, urlparse(path).path.lstrip('/'))
+
+            def log_message(self, *args):
+                pass
+
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        self.server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/ubuntu' % (self.server.server_address[1],)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.root)
+
+    def write(self, path, data):
+        path = os.path.join(self.root, 'ubuntu', path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as fp:
+            fp.write(data)
+
+    def add_package(self, name, version):
+        data = ('%s %s' % (name, version)).encode('utf-8')
+        filename = 'pool/main/%s/%s/%s_%s_amd64.deb' % (name[0], name, name, version)
+        self.write(filename, data)
+        self.packages.append('Package: %s\nVersion: %s\nArchitecture: amd64\nFilename: %s\nSize: %d\nSHA256: %s\n' %
+                             (name, version, filename, len(data), hashlib.sha256(data).hexdigest()))
+        return filename
+
+    def remove_package(self, name):
+        self.packages = [p for p in self.packages if not p.startswith('Package: %s\n' % (name,))]
+
+    def publish(self, suite='trusty', pdiff=False):
+        packages = '\n'.join(self.packages).encode('utf-8')
+        indices = {'main/binary-amd64/Packages': packages,
+                   'main/binary-amd64/Packages.gz': gzip_data(packages)}
+
+        previous = self.published
+        if pdiff and previous and packages.startswith(previous):
+            # Only additions at the end, which makes for a simple ed script
+            script = b'%da\n' % (len(previous.splitlines()),) + packages[len(previous):] + b'.\n'
+            compressed = gzip_data(script)
+            self.write('dists/%s/main/binary-amd64/Packages.diff/T-1-F-1.gz' % (suite,), compressed)
+            indices['main/binary-amd64/Packages.diff/Index'] = (
+                'SHA256-Current: %s\n' % (checksum_line(packages),) +
+                'SHA256-History:\n %s T-1-F-1\n' % (checksum_line(previous),) +
+                'SHA256-Patches:\n %s T-1-F-1\n' % (checksum_line(script),) +
+                'SHA256-Download:\n %s T-1-F-1.gz\n' % (checksum_line(compressed),)).encode('utf-8')
+        self.published = packages
+
+        release = 'Suite: %s\nAcquire-By-Hash: yes\nSHA256:\n' % (suite,)
+        for path, data in sorted(indices.items()):
+            self.write('dists/%s/%s' % (suite, path), data)
+            release += ' %s %s\n' % (checksum_line(data), path)
+        self.write('dists/%s/Release' % (suite,), release.encode('utf-8'))
+
+
+class ArchiveSyncTestCase(TestCase):
+    def setUp(self):
+        super(ArchiveSyncTestCase, self).setUp()
+        self.archive = StandInArchive()
+        self.addCleanup(self.archive.close)
+        self.destdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.destdir)
+
+    def archive_sync(self):
+        return engine.ArchiveSync(self.archive.url, self.destdir, ['trusty'], ['main'],
+                                  downloader=engine.Downloader(parallel=2))
+
+    def test_sync(self):
+        filename = self.archive.add_package('foo', '1.0')
+        self.archive.publish()
+
+        stats = self.archive_sync().run()
+
+        self.assertTrue(os.path.exists(os.path.join(self.destdir, filename)))
+        self.assertTrue(os.path.exists(os.path.join(self.destdir, 'dists/trusty/Release')))
+        packages = os.path.join(self.destdir, 'dists/trusty/main/binary-amd64/Packages')
+        with open(packages, 'rb') as fp:
+            sha256 = hashlib.sha256(fp.read()).hexdigest()
+        self.assertTrue(os.path.samefile(packages, os.path.join(os.path.dirname(packages), 'by-hash', 'SHA256', sha256)))
+        self.assertEquals(stats['files'], 3)
+
+        # Nothing new upstream, so nothing to download
+        stats = self.archive_sync().run()
+        self.assertEquals(stats['files'], 0)
+
+    def test_refresh_only_fetches_changes(self):
+        foo = self.archive.add_package('foo', '1.0')
+        self.archive.publish()
+        self.archive_sync().run()
+
+        bar = self.archive.add_package('bar', '1.0')
+        self.archive.publish(pdiff=True)
+        archive_sync = self.archive_sync()
+        with mock.patch.object(archive_sync.downloader, 'fetch', wraps=archive_sync.downloader.fetch) as fetch:
+            archive_sync.run()
+
+        # The index was patched, so the only thing fetched in full is bar
+        self.assertEquals([c[0][0] for c in fetch.call_args_list], ['%s/%s' % (self.archive.url, bar)])
+        distdir = os.path.join(self.destdir, 'dists', 'trusty', 'main', 'binary-amd64')
+        with open(os.path.join(distdir, 'Packages'), 'rb') as fp:
+            self.assertEquals(fp.read(), self.archive.published)
+        self.assertFalse(os.path.exists(os.path.join(distdir, 'Packages.gz')))
+
+        self.archive.remove_package('foo')
+        self.archive.publish()
+        self.archive_sync().run()
+
+        # Removal is deferred
+        self.assertTrue(os.path.exists(os.path.join(self.destdir, foo)))
+        archive_sync = self.archive_sync()
+        archive_sync.cleanup_delay = 0
+        self.assertEquals(archive_sync.run()['removed'], 1)
+        self.assertFalse(os.path.exists(os.path.join(self.destdir, foo)))
+        self.assertTrue(os.path.exists(os.path.join(self.destdir, bar)))
+
+    def test_publish_switches_suite_atomically(self):
+        distdir = os.path.join(self.destdir, 'dists', 'trusty')
+        indexdir = os.path.join(distdir, 'main', 'binary-amd64')
+        generations = []
+        hashes = []
+        for name in ['foo', 'bar', 'baz']:
+            self.archive.add_package(name, '1.0')
+            self.archive.publish()
+            self.archive_sync().run()
+            generations.append(os.path.realpath(distdir))
+            hashes.append(set(sha256_file(os.path.join(indexdir, index)) for index in ['Packages', 'Packages.gz']))
+
+        self.assertTrue(os.path.islink(distdir))
+        self.assertEquals(len(set(generations)), 3)
+
+        # Only the copy published before the current one is kept
+        self.assertFalse(os.path.exists(generations[0]))
+        with open(os.path.join(generations[1], 'main', 'binary-amd64', 'Packages'), 'rb') as fp:
+            self.assertNotIn(b'Package: baz', fp.read())
+
+        # ..and so are the by-hash links to its indices
+        self.assertEquals(set(os.listdir(os.path.join(indexdir, 'by-hash', 'SHA256'))), hashes[1] | hashes[2])
+
+    def test_apply_ed_script(self):
+        data = b'a\nb\nc\nd\n'
+        script = b'4a\ne\n.\n3c\nC\n.\n1,2d\n'
+        self.assertEquals(engine.apply_ed_script(data, script), b'C\nd\ne\n')
+        self.assertRaises(engine.PatchFailed, engine.apply_ed_script, data, b'1x\n')
+
+    def test_sync_leaves_mirror_untouched_on_checksum_mismatch(self):
+        filename = self.archive.add_package('foo', '1.0')
+        self.archive.publish()
+        self.archive.write(filename, b'bar 1.0')
+
+        self.assertRaises(DownloadFailed, self.archive_sync().run)
+
+        self.assertFalse(os.path.exists(os.path.join(self.destdir, filename)))
+        self.assertFalse(os.path.exists(os.path.join(self.destdir, filename + '.partial')))
+        self.assertFalse(os.path.exists(os.path.join(self.destdir, 'dists/trusty/Release')))
+
+    def test_fetch_discards_partial_download_if_server_ignores_range(self):
+        filename = self.archive.add_package('foo', '1.0')
+        dest = os.path.join(self.destdir, 'foo.deb')
+        with open(dest + '.partial', 'wb') as fp:
+            fp.write(b'xyz')
+
+        downloaded = engine.Downloader().fetch('%s/%s' % (self.archive.url, filename), dest,
+                                               hashlib.sha256(b'foo 1.0').hexdigest(), 7)
+
+        self.assertEquals(downloaded, 7)
+        with open(dest, 'rb') as fp:
+            self.assertEquals(fp.read(), b'foo 1.0')
+
+    def test_blob_store_shares_pool_files(self):
+        filename = self.archive.add_package('foo', '1.0')
+        self.archive.publish()
+        blob_store = BlobStore(os.path.join(self.destdir, 'blobs'))
+
+        syncs = [engine.ArchiveSync(self.archive.url, os.path.join(self.destdir, name), ['trusty'], ['main'],
+                                    downloader=engine.Downloader(parallel=2), blob_store=blob_store)
+                 for name in ('mirror1', 'mirror2')]
+        with mock.patch.object(syncs[1].downloader, 'fetch', wraps=syncs[1].downloader.fetch) as fetch:
+            syncs[0].run()
+            stats = syncs[1].run()
+            self.assertNotIn(os.path.join(self.destdir, 'mirror2', filename),
+                             [call[0][1] for call in fetch.call_args_list])
+
+        self.assertEquals(stats['reused'], 1)
+        self.assertEquals(stats['reused_bytes'], 7)
+        pool_file = os.path.join(self.destdir, 'mirror1', filename)
+        self.assertTrue(os.path.samefile(pool_file, os.path.join(self.destdir, 'mirror2', filename)))
+        self.assertTrue(os.path.samefile(pool_file, blob_store.path(hashlib.sha256(b'foo 1.0').hexdigest())))
 
-from .models import Mirror, MirrorSet, Snapshot, Tags
+    def test_sync_updates_manifest(self):
+        foo = self.archive.add_package('foo', '1.0')
+        self.archive.publish()
+        manifest = mock.Mock()
+        manifest.is_current.return_value = False
+        manifest.update_suite.return_value = [foo]
+
+        engine.ArchiveSync(self.archive.url, self.destdir, ['trusty'], ['main'], manifest=manifest,
+                           downloader=engine.Downloader(parallel=2)).run()
+
+        suite, release_sha256, files, packages = manifest.update_suite.call_args[0]
+        self.assertEquals(suite, 'trusty')
+        self.assertEquals(files, {foo: {'sha256': hashlib.sha256(b'foo 1.0').hexdigest(), 'size': 7}})
+        self.assertEquals(packages, [{'path': foo, 'component': 'main', 'package': 'foo',
+                                      'version': '1.0', 'architecture': 'amd64'}])
+
+        manifest.reset_mock()
+        manifest.is_current.return_value = True
+        engine.ArchiveSync(self.archive.url, self.destdir, ['trusty'], ['main'], manifest=manifest,
+                           downloader=engine.Downloader(parallel=2)).run()
+        self.assertFalse(manifest.update_suite.called)
+
+    def test_on_demand_sync_fetches_pool_files_when_asked(self):
+        foo = self.archive.add_package('foo', '1.0')
+        self.archive.publish()
+        archive_sync = engine.ArchiveSync(self.archive.url, self.destdir, ['trusty'], ['main'], on_demand=True,
+                                          downloader=engine.Downloader(parallel=2))
+
+        stats = archive_sync.run()
+
+        self.assertEquals(stats['files'], 2)
+        self.assertTrue(os.path.exists(os.path.join(self.destdir, 'dists/trusty/Release')))
+        self.assertFalse(os.path.exists(os.path.join(self.destdir, foo)))
+
+        info = {'sha256': hashlib.sha256(b'foo 1.0').hexdigest(), 'size': 7}
+        threads = [threading.Thread(target=archive_sync.fetch_file, args=(foo, info)) for i in range(4)]
+        with mock.patch.object(archive_sync.downloader, 'fetch', wraps=archive_sync.downloader.fetch) as fetch:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        # Concurrent requests for the same file only fetch it once
+        self.assertEquals(fetch.call_count, 1)
+        with open(archive_sync.fetch_file(foo, info), 'rb') as fp:
+            self.assertEquals(fp.read(), b'foo 1.0')
+
+        # The lock stays until cleanup, which finds the file in place
+        self.assertTrue(os.path.exists(archive_sync.fetch_lock_path(foo)))
+        archive_sync.cleanup()
+        self.assertFalse(os.path.exists(archive_sync.fetch_lock_path(foo)))
+
+    def test_full_sync_after_on_demand_fills_in_pool(self):
+        foo = self.archive.add_package('foo', '1.0')
+        bar = self.archive.add_package('bar', '1.0')
+        self.archive.publish()
+        engine.ArchiveSync(self.archive.url, self.destdir, ['trusty'], ['main'], on_demand=True,
+                           downloader=engine.Downloader(parallel=2)).run()
+
+        # Unchanged upstream, but the pool is incomplete
+        self.assertEquals(self.archive_sync().run()['files'], 2)
+        self.assertTrue(os.path.exists(os.path.join(self.destdir, foo)))
+        self.assertTrue(os.path.exists(os.path.join(self.destdir, bar)))
+
+        self.assertEquals(self.archive_sync().run()['files'], 0)
+
+    def test_native_backend(self):
+        filename = self.archive.add_package('foo', '1.0')
+        self.archive.publish()
+
+        with override_settings(MIRRORSVC_BASE_PATH=self.destdir,
+                               MIRRORSVC_BACKEND='aasemble.django.apps.mirrorsvc.backends.NativeBackend'):
+            user = auth_models.User.objects.create(username='testuser')
+            mirror = Mirror.objects.create(owner=user, url=self.archive.url, series='trusty', components='main')
+            Mirror.objects.filter(id=mirror.id).update(refresh_in_progress=True)
+            mirror.update_mirror()
+
+            self.assertTrue(os.path.exists(os.path.join(mirror.archive_dir, filename)))
+            mirror = Mirror.objects.get(id=mirror.id)
+            self.assertFalse(mirror.refresh_in_progress)
+            self.assertTrue(mirror.bytes_downloaded > 0)
+            self.assertEquals(mirror.bytes_shared, 0)
+            self.assertEquals(list(PackageEntry.objects.filter(pool_file__backing=mirror.backing)
+                                   .values_list('package', 'version', 'pool_file__path')),
+                              [('foo', '1.0', filename)])
+
+
+class TokenBucketTestCase(TestCase):
+    @mock.patch('aasemble.django.apps.mirrorsvc.engine.time')
+    def test_consume_sleeps_off_deficit(self, time):
+        time.time.return_value = 100.0
+        bucket = engine.TokenBucket(1000)
+
+        bucket.consume(1000)
+        self.assertFalse(time.sleep.called)
+
+        bucket.consume(500)
+        time.sleep.assert_called_once_with(0.5)
 
 
 class MirrorTestCase(TestCase):
@@ -17,6 +360,436 @@ class MirrorTestCase(TestCase):
                           ('deb {0} trusty main\n'
                            'deb-src {0} trusty main\n').format(url))
 
+    @override_settings(MIRRORSVC_ON_DEMAND_BASE_URL='http://127.0.0.1:8000/mirrorsvc/files')
+    def test_sources_list_on_demand(self):
+        mirror = Mirror.objects.get(id=2)
+        mirror.on_demand = True
+        self.assertIn('deb http://127.0.0.1:8000/mirrorsvc/files/829bd2cd-eaaf-4244-a6a6-569cab027a6c/2.example.com/ '
+                      'trusty main\n', mirror.sources_list)
+
+
+class BackingMirrorTestCase(TestCase):
+    def setUp(self):
+        super(BackingMirrorTestCase, self).setUp()
+        self.basedir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.basedir)
+        settings_override = override_settings(MIRRORSVC_BASE_PATH=self.basedir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.user = auth_models.User.objects.create(username='testuser')
+
+    def create_mirror(self, url='http://example.com/ubuntu', series='trusty', components='main'):
+        return Mirror.objects.create(owner=self.user, url=url, series=series, components=components)
+
+    def test_identical_mirrors_share_backing_mirror(self):
+        mirror1 = self.create_mirror()
+        mirror2 = self.create_mirror(url='http://example.com/ubuntu/', series='trusty xenial')
+        mirror3 = self.create_mirror(url='http://example.org/ubuntu')
+
+        backing = mirror1.backing_mirror()
+        self.assertEquals(mirror2.backing_mirror(), backing)
+        self.assertNotEqual(mirror3.backing_mirror(), backing)
+
+        backing = BackingMirror.objects.get(id=backing.id)
+        self.assertEquals(backing.series, 'trusty xenial')
+        self.assertEquals(os.path.realpath(mirror1.basepath), os.path.realpath(backing.basepath))
+        self.assertEquals(os.path.realpath(mirror2.archive_dir), os.path.realpath(backing.archive_dir))
+        self.assertNotEqual(mirror1.sources_list, mirror2.sources_list)
+
+    def test_backing_mirror_covers_architectures_of_all_mirrors(self):
+        mirror1 = self.create_mirror()
+        mirror1.architectures.add(Architecture.objects.get(apt_mirror_prefix='i386'))
+        mirror2 = self.create_mirror()
+        mirror2.architectures.add(*Architecture.objects.filter(apt_mirror_prefix__in=['amd64', 'src']))
+
+        mirror1.backing_mirror()
+        backing = Mirror.objects.get(id=mirror2.id).backing_mirror()
+
+        self.assertEquals(set(backing.architecture_list()), set(['i386', 'amd64']))
+        self.assertTrue(backing.include_source)
+        self.assertIn('deb-src %s trusty main' % (backing.url,), backing.get_config())
+        self.assertIn('deb-i386 %s trusty main' % (backing.url,), backing.get_config())
+
+    def test_backing_mirror_is_on_demand_if_all_mirrors_are(self):
+        mirror1 = Mirror.objects.create(owner=self.user, url='http://example.com/ubuntu', series='trusty',
+                                        components='main', on_demand=True)
+        self.assertTrue(mirror1.backing_mirror().on_demand)
+
+        mirror2 = self.create_mirror()
+        self.assertFalse(mirror2.backing_mirror().on_demand)
+
+    @mock.patch('aasemble.django.apps.mirrorsvc.models.BackingMirror.fetch_on_demand')
+    def test_mirror_file_fetches_pool_files_of_on_demand_mirrors(self, fetch_on_demand):
+        mirror = Mirror.objects.create(owner=self.user, url='http://example.com/ubuntu', series='trusty',
+                                       components='main', on_demand=True, public=True)
+        backing = mirror.backing_mirror()
+        packages = []
+        for name in ['foo', 'bar']:
+            packages.append({'path': 'pool/%s_1.0.deb' % (name,), 'component': 'main', 'package': name,
+                             'version': '1.0', 'architecture': 'amd64'})
+        backing.manifest().update_suite('trusty', 'a' * 64,
+                                        dict((package['path'], {'sha256': 'b' * 64, 'size': 7}) for package in packages),
+                                        packages)
+
+        def fetch(path):
+            fullpath = os.path.join(ensure_dir(os.path.join(backing.archive_dir, 'pool')), 'foo_1.0.deb')
+            with open(fullpath, 'wb') as fp:
+                fp.write(b'foo 1.0')
+            return fullpath
+        fetch_on_demand.side_effect = fetch
+
+        def url(path):
+            return reverse('mirrorsvc:mirror_file', kwargs={'mirror_uuid': mirror.uuid, 'path': path})
+
+        for i in range(2):
+            response = self.client.get(url('example.com/ubuntu/pool/foo_1.0.deb'))
+            self.assertEquals(response.status_code, 200)
+            self.assertEquals(b''.join(response.streaming_content), b'foo 1.0')
+        # Served locally the second time
+        fetch_on_demand.assert_called_once_with('pool/foo_1.0.deb')
+
+        # Not listed in the indices
+        fetch_on_demand.side_effect = None
+        fetch_on_demand.return_value = None
+        self.assertEquals(self.client.get(url('example.com/ubuntu/pool/bar_1.0.deb')).status_code, 404)
+
+        fetch_on_demand.side_effect = DownloadFailed('http://example.com/ubuntu/pool/bar_1.0.deb', status=404)
+        self.assertEquals(self.client.get(url('example.com/ubuntu/pool/bar_1.0.deb')).status_code, 502)
+
+        self.assertEquals(self.client.get(url('example.com/ubuntu/../../etc/passwd')).status_code, 404)
+
+    @mock.patch('aasemble.django.apps.mirrorsvc.models.BackingMirror.fetch_on_demand')
+    def test_mirror_file_serves_only_what_the_mirror_selected(self, fetch_on_demand):
+        mirror = Mirror.objects.create(owner=self.user, url='http://example.com/ubuntu', series='trusty',
+                                       components='main', on_demand=True, public=True)
+        other = Mirror.objects.create(owner=self.user, url='http://example.com/ubuntu', series='trusty xenial',
+                                      components='main universe', on_demand=True)
+        backing = mirror.backing_mirror()
+        other.backing_mirror()
+        backing.manifest().update_suite('xenial', 'a' * 64, {'pool/foo_1.0.deb': {'sha256': 'b' * 64, 'size': 7}},
+                                        [{'path': 'pool/foo_1.0.deb', 'component': 'main', 'package': 'foo',
+                                          'version': '1.0', 'architecture': 'amd64'}])
+        for path in ['dists/trusty/Release', 'dists/trusty/universe/binary-amd64/Packages',
+                     'dists/trusty/main/binary-i386/Packages', 'dists/xenial/Release']:
+            with open(os.path.join(ensure_dir(os.path.dirname(os.path.join(backing.archive_dir, path))),
+                                   os.path.basename(path)), 'wb') as fp:
+                fp.write(b'data')
+
+        def get(path):
+            return self.client.get(reverse('mirrorsvc:mirror_file',
+                                           kwargs={'mirror_uuid': mirror.uuid, 'path': 'example.com/ubuntu/' + path}))
+
+        self.assertEquals(get('dists/trusty/Release').status_code, 200)
+        self.assertEquals(get('dists/trusty/universe/binary-amd64/Packages').status_code, 404)
+        self.assertEquals(get('dists/trusty/main/binary-i386/Packages').status_code, 404)
+        self.assertEquals(get('dists/xenial/Release').status_code, 404)
+        self.assertEquals(get('pool/foo_1.0.deb').status_code, 404)
+        self.assertFalse(fetch_on_demand.called)
+
+    def test_mirror_file_of_private_mirror(self):
+        mirror = self.create_mirror()
+        backing = mirror.backing_mirror()
+        with open(os.path.join(ensure_dir(os.path.join(backing.archive_dir, 'dists/trusty')), 'Release'), 'wb') as fp:
+            fp.write(b'data')
+        url = reverse('mirrorsvc:mirror_file', kwargs={'mirror_uuid': mirror.uuid,
+                                                       'path': 'example.com/ubuntu/dists/trusty/Release'})
+
+        self.assertEquals(self.client.get(url).status_code, 404)
+        self.client.force_login(self.user)
+        self.assertEquals(self.client.get(url).status_code, 200)
+
+    @mock.patch('aasemble.django.apps.mirrorsvc.tasks.refresh_mirror')
+    def test_schedule_update_mirror_coalesces(self, refresh_mirror):
+        mirror1 = self.create_mirror()
+        mirror2 = self.create_mirror()
+
+        self.assertTrue(mirror1.schedule_update_mirror())
+        self.assertFalse(mirror2.schedule_update_mirror())
+        self.assertFalse(mirror1.schedule_update_mirror())
+
+        refresh_mirror.delay.assert_called_once_with(mirror1.id)
+        self.assertTrue(BackingMirror.objects.get(id=mirror1.backing_id).refresh_requested)
+        self.assertTrue(Mirror.objects.get(id=mirror2.id).refresh_in_progress)
+
+    @mock.patch('aasemble.django.apps.mirrorsvc.models.get_mirror_backend')
+    def test_update_runs_again_if_requested_meanwhile(self, get_mirror_backend):
+        mirror1 = self.create_mirror()
+        mirror2 = self.create_mirror()
+        backing = mirror1.backing_mirror()
+
+        def request_refresh():
+            if get_mirror_backend.return_value.update.call_count == 1:
+                with mock.patch('aasemble.django.apps.mirrorsvc.tasks.refresh_mirror'):
+                    mirror2.schedule_update_mirror()
+
+        get_mirror_backend.return_value.update.side_effect = request_refresh
+        BackingMirror.objects.filter(id=backing.id).update(refresh_in_progress=True)
+        mirror1.update_mirror()
+
+        self.assertEquals(get_mirror_backend.return_value.update.call_count, 2)
+        self.assertFalse(BackingMirror.objects.get(id=backing.id).refresh_in_progress)
+        self.assertFalse(Mirror.objects.get(id=mirror2.id).refresh_in_progress)
+
+    @mock.patch('aasemble.django.apps.mirrorsvc.models.get_mirror_backend')
+    def test_update_schedules_next_refresh(self, get_mirror_backend):
+        mirror = Mirror.objects.create(owner=self.user, url='http://example.com/ubuntu', series='trusty',
+                                       components='main', refresh_interval=1000)
+        backing = mirror.backing_mirror()
+        get_mirror_backend.return_value.update.return_value = {}
+
+        before = now()
+        mirror.update_mirror()
+
+        backing = BackingMirror.objects.get(id=backing.id)
+        self.assertIsNotNone(backing.last_refreshed)
+        self.assertGreaterEqual(backing.next_refresh, before + datetime.timedelta(seconds=900))
+        self.assertLessEqual(backing.next_refresh, now() + datetime.timedelta(seconds=1100))
+
+    @override_settings(MIRRORSVC_MAX_CONCURRENT_REFRESHES=2)
+    @mock.patch('aasemble.django.apps.mirrorsvc.tasks.refresh_mirror')
+    def test_schedule_due_refreshes(self, refresh_mirror):
+        due = [self.create_mirror(url='http://example.com/%d' % (i,)) for i in range(3)]
+        for mirror in due:
+            Mirror.objects.filter(id=mirror.id).update(refresh_interval=3600)
+        unscheduled = self.create_mirror(url='http://example.org/ubuntu')
+        Mirror.objects.filter(id=unscheduled.id).update(refresh_interval=3600)
+        for i, mirror in enumerate(due):
+            BackingMirror.objects.filter(id=mirror.backing_mirror().id).update(next_refresh=now() - datetime.timedelta(seconds=10 - i))
+
+        BackingMirror.schedule_due_refreshes()
+
+        # Only as many as there are slots, most overdue first
+        self.assertEquals(refresh_mirror.delay.call_count, 2)
+        refresh_mirror.delay.assert_any_call(due[0].id)
+        refresh_mirror.delay.assert_any_call(due[1].id)
+
+        # The new one gets a backing mirror and is spread over its interval
+        backing = BackingMirror.objects.get(mirrors=unscheduled)
+        self.assertFalse(backing.refresh_in_progress)
+        self.assertLessEqual(backing.next_refresh, now() + datetime.timedelta(seconds=3600))
+
+    def test_recover_stuck_refreshes(self):
+        mirror = self.create_mirror()
+        backing = mirror.backing_mirror()
+        BackingMirror.objects.filter(id=backing.id).update(refresh_in_progress=True,
+                                                           refresh_started=now() - datetime.timedelta(days=1))
+        Mirror.objects.filter(id=mirror.id).update(refresh_in_progress=True)
+
+        BackingMirror.recover_stuck_refreshes()
+
+        self.assertFalse(BackingMirror.objects.get(id=backing.id).refresh_in_progress)
+        self.assertFalse(Mirror.objects.get(id=mirror.id).refresh_in_progress)
+
+    def test_recover_stuck_refreshes_leaves_running_refreshes(self):
+        mirror = self.create_mirror()
+        backing = mirror.backing_mirror()
+        BackingMirror.objects.filter(id=backing.id).update(refresh_in_progress=True,
+                                                           refresh_started=now() - datetime.timedelta(days=1))
+
+        with file_lock(backing.refresh_lock_path):
+            BackingMirror.recover_stuck_refreshes()
+
+        self.assertTrue(BackingMirror.objects.get(id=backing.id).refresh_in_progress)
+
+    @override_settings(MIRRORSVC_MAX_CONCURRENT_REFRESHES=1)
+    @mock.patch('aasemble.django.apps.mirrorsvc.tasks.refresh_mirror')
+    @mock.patch('aasemble.django.apps.mirrorsvc.models.get_mirror_backend')
+    def test_refresh_waiting_for_slot_is_not_stuck(self, get_mirror_backend, refresh_mirror):
+        mirror = self.create_mirror()
+        backing = mirror.backing_mirror()
+        get_mirror_backend.return_value.update.return_value = {}
+        mirror.schedule_update_mirror()
+        BackingMirror.objects.filter(id=backing.id).update(refresh_queued=now() - datetime.timedelta(days=1))
+        slot = os.path.join(ensure_dir(os.path.join(settings.MIRRORSVC_BASE_PATH, '.refresh-slots')), 'slot-0')
+
+        with file_lock(slot):
+            # Queued long ago, but still trying
+            self.assertFalse(mirror.update_mirror())
+            BackingMirror.recover_stuck_refreshes()
+
+        self.assertFalse(get_mirror_backend.return_value.update.called)
+        self.assertTrue(BackingMirror.objects.get(id=backing.id).refresh_in_progress)
+        self.assertTrue(Mirror.objects.get(id=mirror.id).refresh_in_progress)
+
+        self.assertTrue(mirror.update_mirror())
+        self.assertTrue(get_mirror_backend.return_value.update.called)
+        self.assertFalse(BackingMirror.objects.get(id=backing.id).refresh_in_progress)
+
+    @mock.patch('aasemble.django.apps.mirrorsvc.tasks.refresh_mirror')
+    def test_recover_lost_queued_refresh(self, refresh_mirror):
+        mirror = self.create_mirror()
+        backing = mirror.backing_mirror()
+        mirror.schedule_update_mirror()
+        self.assertTrue(BackingMirror.objects.get(id=backing.id).refresh_in_progress)
+
+        # The task retrying it was lost a day ago
+        BackingMirror.objects.filter(id=backing.id).update(refresh_queued=now() - datetime.timedelta(days=1))
+        BackingMirror.recover_stuck_refreshes()
+
+        self.assertFalse(BackingMirror.objects.get(id=backing.id).refresh_in_progress)
+        self.assertFalse(Mirror.objects.get(id=mirror.id).refresh_in_progress)
+
+    def test_backing_mirror_deleted_with_last_mirror(self):
+        mirror1 = self.create_mirror()
+        mirror2 = self.create_mirror()
+        backing = mirror1.backing_mirror()
+        mirror2.backing_mirror()
+        backing_dir = backing.basepath
+
+        mirror1.delete()
+        self.assertTrue(BackingMirror.objects.filter(id=backing.id).exists())
+        self.assertTrue(os.path.isdir(backing_dir))
+
+        mirror2.delete()
+        self.assertFalse(BackingMirror.objects.filter(id=backing.id).exists())
+        self.assertFalse(os.path.exists(backing_dir))
+
+    def test_legacy_mirror_directory_is_adopted(self):
+        mirror = self.create_mirror()
+        legacy_dir = os.path.join(self.basedir, 'mirrors', str(mirror.uuid))
+        os.makedirs(legacy_dir)
+        with open(os.path.join(legacy_dir, 'mirror.conf'), 'w') as fp:
+            fp.write('legacy')
+
+        backing = mirror.backing_mirror()
+
+        self.assertTrue(os.path.islink(legacy_dir))
+        self.assertTrue(os.path.exists(os.path.join(backing.basepath, 'mirror.conf')))
+
+
+class SnapshotDiffTestCase(TestCase):
+    def setUp(self):
+        super(SnapshotDiffTestCase, self).setUp()
+        patcher = mock.patch('aasemble.django.apps.mirrorsvc.tasks.perform_snapshot')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        user = auth_models.User.objects.create(username='testuser')
+        mirrorset = MirrorSet.objects.create(name='ms1', owner=user)
+        self.old = Snapshot.objects.create(mirrorset=mirrorset, packages_recorded=True)
+        self.new = Snapshot.objects.create(mirrorset=mirrorset, packages_recorded=True)
+
+    def add_packages(self, snapshot, packages):
+        for package, version, architecture in packages:
+            SnapshotPackage.objects.create(snapshot=snapshot, suite='trusty', component='main',
+                                           package=package, version=version, architecture=architecture)
+
+    def test_diff_compares_debian_versions(self):
+        self.add_packages(self.old, [('foo', '1.9', 'amd64'), ('foo', '1.9', 'i386'), ('bar', '1:0.1', 'amd64')])
+        self.add_packages(self.new, [('foo', '1.10', 'amd64'), ('bar', '2.0', 'amd64')])
+
+        self.assertEquals(self.new.diff(self.old)[:],
+                          [{'package': 'bar', 'architecture': 'amd64', 'suite': 'trusty',
+                            'old_version': '1:0.1', 'new_version': '2.0', 'change': 'downgraded'},
+                           {'package': 'foo', 'architecture': 'amd64', 'suite': 'trusty',
+                            'old_version': '1.9', 'new_version': '1.10', 'change': 'upgraded'},
+                           {'package': 'foo', 'architecture': 'i386', 'suite': 'trusty',
+                            'old_version': '1.9', 'new_version': None, 'change': 'removed'}])
+
+    def test_diff_is_worked_out_in_slices(self):
+        self.add_packages(self.old, [('bar', '1.0', 'amd64'), ('baz', '1.0', 'amd64'), ('foo', '1.0', 'amd64')])
+        self.add_packages(self.new, [('bar', '1.0', 'amd64'), ('baz', '1.1', 'amd64'), ('foo', '1.1', 'amd64'),
+                                     ('qux', '1.0', 'amd64')])
+
+        diff = self.new.diff(self.old)
+
+        # bar is the same in both
+        self.assertEquals(len(diff), 3)
+        self.assertEquals([change['package'] for change in diff[1:3]], ['foo', 'qux'])
+        self.assertEquals(diff[0]['change'], 'upgraded')
+
+
+class PoolManifestTestCase(TestCase):
+    def setUp(self):
+        super(PoolManifestTestCase, self).setUp()
+        self.basedir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.basedir)
+        settings_override = override_settings(MIRRORSVC_BASE_PATH=self.basedir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        user = auth_models.User.objects.create(username='testuser')
+        self.mirror = Mirror.objects.create(owner=user, url='http://example.com/ubuntu', series='trusty',
+                                            components='main')
+        self.backing = self.mirror.backing_mirror()
+        self.manifest = self.backing.manifest()
+
+    def add_file(self, path, data):
+        fullpath = os.path.join(self.backing.archive_dir, path)
+        ensure_dir(os.path.dirname(fullpath))
+        with open(fullpath, 'wb') as fp:
+            fp.write(data)
+        return {'sha256': hashlib.sha256(data).hexdigest(), 'size': len(data)}
+
+    def package(self, path, name, version):
+        return {'path': path, 'component': 'main', 'package': name, 'version': version, 'architecture': 'amd64'}
+
+    def test_update_suite_is_incremental(self):
+        files = {'pool/foo_1.0.deb': self.add_file('pool/foo_1.0.deb', b'foo 1.0'),
+                 'pool/bar_1.0.deb': self.add_file('pool/bar_1.0.deb', b'bar 1.0')}
+        packages = [self.package('pool/foo_1.0.deb', 'foo', '1.0'), self.package('pool/bar_1.0.deb', 'bar', '1.0')]
+        self.assertEquals(sorted(self.manifest.update_suite('trusty', 'a' * 64, files, packages)),
+                          ['pool/bar_1.0.deb', 'pool/foo_1.0.deb'])
+        self.assertTrue(self.manifest.is_current('trusty', 'a' * 64))
+        bar = PackageEntry.objects.get(package='bar')
+
+        files['pool/foo_2.0.deb'] = self.add_file('pool/foo_2.0.deb', b'foo 2.0')
+        del files['pool/foo_1.0.deb']
+        packages = [self.package('pool/foo_2.0.deb', 'foo', '2.0'), self.package('pool/bar_1.0.deb', 'bar', '1.0')]
+        self.assertEquals(self.manifest.update_suite('trusty', 'b' * 64, files, packages), ['pool/foo_2.0.deb'])
+
+        self.assertFalse(self.manifest.is_current('trusty', 'a' * 64))
+        self.assertEquals(sorted(PackageEntry.objects.values_list('package', 'version')), [('bar', '1.0'), ('foo', '2.0')])
+        # Unchanged entries are left alone
+        self.assertEquals(PackageEntry.objects.get(package='bar').id, bar.id)
+        # The old file is still in the pool until the mirror removes it
+        self.assertEquals(self.manifest.size(), 21)
+
+        os.unlink(os.path.join(self.backing.archive_dir, 'pool/foo_1.0.deb'))
+        self.manifest.prune()
+        self.assertEquals(self.manifest.size(), 14)
+
+    def test_shared_bytes(self):
+        info = self.add_file('pool/foo_1.0.deb', b'foo 1.0')
+        self.manifest.update_suite('trusty', 'a' * 64, {'pool/foo_1.0.deb': info}, [])
+        self.assertEquals(self.manifest.shared_bytes(), 0)
+
+        other = BackingMirror.objects.create(url='http://example.org/ubuntu/', series='trusty', components='main')
+        other.manifest().update_suite('trusty', 'a' * 64, {'pool/f/foo_1.0.deb': info}, [])
+        self.assertEquals(self.manifest.shared_bytes(), 7)
+
+    def test_verify(self):
+        files = {'pool/foo_1.0.deb': self.add_file('pool/foo_1.0.deb', b'foo 1.0'),
+                 'pool/bar_1.0.deb': self.add_file('pool/bar_1.0.deb', b'bar 1.0'),
+                 'pool/baz_1.0.deb': self.add_file('pool/baz_1.0.deb', b'baz 1.0')}
+        self.manifest.update_suite('trusty', 'a' * 64, files, [])
+        self.add_file('pool/bar_1.0.deb', b'BAR 1.0')
+        os.unlink(os.path.join(self.backing.archive_dir, 'pool/baz_1.0.deb'))
+
+        self.assertEquals(sorted(self.manifest.verify()), ['pool/bar_1.0.deb', 'pool/baz_1.0.deb'])
+
+    def test_verify_mirror_command(self):
+        self.manifest.update_suite('trusty', 'a' * 64, {'pool/foo_1.0.deb': self.add_file('pool/foo_1.0.deb', b'foo 1.0')}, [])
+        stdout, stderr = io.StringIO(), io.StringIO()
+        call_command('verify_mirror', str(self.mirror.uuid), stdout=stdout, stderr=stderr)
+        self.assertEquals(stderr.getvalue(), '')
+        self.assertIn('intact', stdout.getvalue())
+
+        os.unlink(os.path.join(self.backing.archive_dir, 'pool/foo_1.0.deb'))
+        self.assertRaises(CommandError, call_command, 'verify_mirror', str(self.mirror.uuid), stdout=stdout, stderr=stderr)
+        self.assertIn('pool/foo_1.0.deb', stderr.getvalue())
+
+    @mock.patch('aasemble.django.apps.mirrorsvc.models.get_mirror_backend')
+    def test_fetch_on_demand_only_fetches_listed_files(self, get_mirror_backend):
+        PoolFile.objects.create(backing=self.backing, path='pool/foo_1.0.deb', size=7, sha256='a' * 64)
+        fetch_file = get_mirror_backend.return_value.fetch_file
+        fetch_file.return_value = ('/path/to/foo_1.0.deb', {'bytes': 7, 'reused_bytes': 0})
+
+        self.assertEquals(self.backing.fetch_on_demand('pool/foo_1.0.deb'), '/path/to/foo_1.0.deb')
+        fetch_file.assert_called_once_with('pool/foo_1.0.deb', {'sha256': 'a' * 64, 'size': 7})
+        self.assertEquals(BackingMirror.objects.get(id=self.backing.id).bytes_downloaded, 7)
+
+        self.assertIsNone(self.backing.fetch_on_demand('pool/bar_1.0.deb'))
+        self.assertEquals(fetch_file.call_count, 1)
+
 
 class SnapshotTestCase(TestCase):
     @mock.patch('aasemble.django.apps.mirrorsvc.tasks.perform_snapshot')
@@ -29,9 +802,10 @@ class SnapshotTestCase(TestCase):
         Tags.objects.create(snapshot=s, tag='test')
         perform_snapshot.apply_async.assert_called_with((s.id,), countdown=5)
 
+    @mock.patch('aasemble.django.apps.mirrorsvc.models.Snapshot.record_packages')
     @mock.patch('aasemble.django.apps.mirrorsvc.models.Snapshot.sync_dists')
-    @mock.patch('aasemble.django.apps.mirrorsvc.models.Snapshot.symlink_pool')
-    def test_perform_snapshot_task_calls_sync_and_symlink(self, sync_dists, symlink_pool):
+    @mock.patch('aasemble.django.apps.mirrorsvc.models.Snapshot.link_pool')
+    def test_perform_snapshot_task_calls_sync_and_link(self, sync_dists, link_pool, record_packages):
         from .tasks import perform_snapshot
         user = auth_models.User.objects.create(username='testuser')
         m = Mirror.objects.create(owner=user, url='http://example.com', series='trusty', components='main')
@@ -41,7 +815,160 @@ class SnapshotTestCase(TestCase):
         Tags.objects.create(snapshot=s, tag='test')
         perform_snapshot(s.id)
         sync_dists.assert_called_with()
-        symlink_pool.assert_called_with()
+        link_pool.assert_called_with()
+        self.assertEquals(Snapshot.objects.get(id=s.id).state, Snapshot.READY)
+
+    @mock.patch('aasemble.django.apps.mirrorsvc.tasks.perform_snapshot')
+    def test_perform_snapshot_links_dists(self, perform_snapshot):
+        basedir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, basedir)
+        with override_settings(MIRRORSVC_BASE_PATH=basedir):
+            user = auth_models.User.objects.create(username='testuser')
+            m = Mirror.objects.create(owner=user, url='http://example.com/ubuntu', series='trusty', components='main')
+            packages = ('Package: foo\nVersion: 1.0\nArchitecture: amd64\nFilename: pool/main/f/foo/foo_1.0_amd64.deb\n'
+                        'Size: 7\nSHA256: %s\n' % (hashlib.sha256(b'foo 1.0').hexdigest(),))
+            files = {'trusty/Release': 'SHA256:\n %s main/binary-amd64/Packages\n' % (checksum_line(packages.encode('utf-8')),),
+                     'trusty/main/binary-amd64/Packages': packages}
+            for path in ('trusty/main/i18n/Translation-en', 'trusty/main/binary-i386/Packages',
+                         'trusty/main/source/Sources', 'trusty/Contents-i386.gz',
+                         'trusty/universe/binary-amd64/Packages', 'xenial/Release'):
+                files[path] = path
+            for path, data in files.items():
+                ensure_dir(os.path.dirname(os.path.join(m.dists, path)))
+                with open(os.path.join(m.dists, path), 'w') as fp:
+                    fp.write(data)
+            ms = MirrorSet.objects.create(name='ms1', owner=user)
+            ms.mirrors.add(m)
+            s = Snapshot.objects.create(mirrorset=ms)
+
+            s.perform_snapshot()
+
+            snapshot_dists = os.path.join(s.basepath, 'example.com/ubuntu/dists')
+            self.assertTrue(os.path.samefile(os.path.join(m.dists, 'trusty/main/binary-amd64/Packages'),
+                                             os.path.join(snapshot_dists, 'trusty/main/binary-amd64/Packages')))
+            self.assertTrue(os.path.exists(os.path.join(snapshot_dists, 'trusty/Release')))
+            self.assertFalse(os.path.exists(os.path.join(snapshot_dists, 'trusty/main/i18n')))
+            # Only what the mirror selected, not everything its backing mirror has
+            for path in ('trusty/main/binary-i386', 'trusty/main/source', 'trusty/Contents-i386.gz',
+                         'trusty/universe', 'xenial'):
+                self.assertFalse(os.path.exists(os.path.join(snapshot_dists, path)), path)
+            s = Snapshot.objects.get(id=s.id)
+            self.assertEquals((s.state, s.progress), (Snapshot.READY, 100))
+            self.assertTrue(s.packages_recorded)
+            self.assertEquals(list(s.packages.values_list('suite', 'component', 'package', 'version', 'architecture')),
+                              [('trusty', 'main', 'foo', '1.0', 'amd64')])
+
+    def publish_foo(self, mirror):
+        """Publish foo 1.0 in trusty of mirror, and put it in the pool"""
+        backing = mirror.backing_mirror()
+        pool_file = os.path.join(backing.archive_dir, 'pool/main/f/foo/foo_1.0_amd64.deb')
+        ensure_dir(os.path.dirname(pool_file))
+        with open(pool_file, 'wb') as fp:
+            fp.write(b'foo 1.0')
+        packages = ('Package: foo\nVersion: 1.0\nArchitecture: amd64\nFilename: pool/main/f/foo/foo_1.0_amd64.deb\n'
+                    'Size: 7\nSHA256: %s\n' % (hashlib.sha256(b'foo 1.0').hexdigest(),))
+        files = {'trusty/Release': 'SHA256:\n %s main/binary-amd64/Packages\n' % (checksum_line(packages.encode('utf-8')),),
+                 'trusty/main/binary-amd64/Packages': packages}
+        for path, data in files.items():
+            ensure_dir(os.path.dirname(os.path.join(mirror.dists, path)))
+            with open(os.path.join(mirror.dists, path), 'w') as fp:
+                fp.write(data)
+        return pool_file
+
+    @mock.patch('aasemble.django.apps.mirrorsvc.tasks.perform_snapshot')
+    def test_record_packages_keeps_highest_versions(self, perform_snapshot):
+        basedir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, basedir)
+        with override_settings(MIRRORSVC_BASE_PATH=basedir):
+            user = auth_models.User.objects.create(username='testuser')
+            m = Mirror.objects.create(owner=user, url='http://example.com/ubuntu', series='trusty', components='main')
+            packages = ''.join('Package: foo\nVersion: %s\nArchitecture: amd64\nFilename: pool/foo_%s.deb\n'
+                               'Size: 1\nSHA256: %s\n\n' % (version, version, 'a' * 64)
+                               for version in ('1.9', '1.10', '1.2'))
+            ms = MirrorSet.objects.create(name='ms1', owner=user)
+            ms.mirrors.add(m)
+            s = Snapshot.objects.create(mirrorset=ms)
+            for path, data in {'trusty/Release': 'SHA256:\n %s main/binary-amd64/Packages\n' % (checksum_line(packages.encode('utf-8')),),
+                               'trusty/main/binary-amd64/Packages': packages}.items():
+                ensure_dir(os.path.dirname(os.path.join(s.basepath, 'example.com/ubuntu/dists', path)))
+                with open(os.path.join(s.basepath, 'example.com/ubuntu/dists', path), 'w') as fp:
+                    fp.write(data)
+
+            s.record_packages()
+
+            self.assertEquals(list(s.packages.values_list('package', 'version')), [('foo', '1.10')])
+
+    @mock.patch('aasemble.django.apps.mirrorsvc.tasks.perform_snapshot')
+    def test_snapshot_keeps_pool_files_the_mirror_drops(self, perform_snapshot):
+        basedir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, basedir)
+        with override_settings(MIRRORSVC_BASE_PATH=basedir):
+            user = auth_models.User.objects.create(username='testuser')
+            m = Mirror.objects.create(owner=user, url='http://example.com/ubuntu', series='trusty', components='main')
+            pool_file = self.publish_foo(m)
+            ms = MirrorSet.objects.create(name='ms1', owner=user)
+            ms.mirrors.add(m)
+            s = Snapshot.objects.create(mirrorset=ms)
+            s.perform_snapshot()
+
+            # A refresh stops listing foo 1.0 and cleans it up
+            os.unlink(pool_file)
+
+            snapshot_pool = os.path.join(s.basepath, 'example.com/ubuntu/pool')
+            self.assertFalse(os.path.islink(snapshot_pool))
+            with open(os.path.join(snapshot_pool, 'main/f/foo/foo_1.0_amd64.deb'), 'rb') as fp:
+                self.assertEquals(fp.read(), b'foo 1.0')
+
+    @mock.patch('aasemble.django.apps.mirrorsvc.tasks.perform_snapshot')
+    def test_deleting_mirror_keeps_pool_of_snapshot(self, perform_snapshot):
+        basedir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, basedir)
+        with override_settings(MIRRORSVC_BASE_PATH=basedir):
+            user = auth_models.User.objects.create(username='testuser')
+            m = Mirror.objects.create(owner=user, url='http://example.com/ubuntu', series='trusty', components='main')
+            backing = m.backing_mirror()
+            self.publish_foo(m)
+            ms = MirrorSet.objects.create(name='ms1', owner=user)
+            ms.mirrors.add(m)
+            s = Snapshot.objects.create(mirrorset=ms)
+            s.perform_snapshot()
+
+            m.delete()
+
+            self.assertTrue(BackingMirror.objects.filter(id=backing.id).exists())
+            with open(os.path.join(s.basepath, 'example.com/ubuntu/pool/main/f/foo/foo_1.0_amd64.deb'), 'rb') as fp:
+                self.assertEquals(fp.read(), b'foo 1.0')
+
+            # Released along with the last snapshot using it
+            s.delete()
+            self.assertFalse(BackingMirror.objects.filter(id=backing.id).exists())
+            self.assertFalse(os.path.exists(os.path.join(basedir, 'backing', str(backing.uuid))))
+
+    @mock.patch('aasemble.django.apps.mirrorsvc.models.Snapshot.sync_dists')
+    @mock.patch('aasemble.django.apps.mirrorsvc.tasks.perform_snapshot')
+    def test_no_snapshots_of_on_demand_mirrors(self, perform_snapshot, sync_dists):
+        user = auth_models.User.objects.create(username='testuser')
+        m = Mirror.objects.create(owner=user, url='http://example.com/ubuntu', series='trusty', components='main',
+                                  on_demand=True)
+        ms = MirrorSet.objects.create(name='ms1', owner=user)
+        ms.mirrors.add(m)
+        s = Snapshot.objects.create(mirrorset=ms)
+
+        s.perform_snapshot()
+
+        self.assertFalse(sync_dists.called)
+        self.assertEquals(Snapshot.objects.get(id=s.id).state, Snapshot.FAILED)
+
+    @mock.patch('aasemble.django.apps.mirrorsvc.models.Snapshot.sync_dists')
+    @mock.patch('aasemble.django.apps.mirrorsvc.tasks.perform_snapshot')
+    def test_failed_snapshot(self, perform_snapshot, sync_dists):
+        user = auth_models.User.objects.create(username='testuser')
+        ms = MirrorSet.objects.create(name='ms1', owner=user)
+        s = Snapshot.objects.create(mirrorset=ms)
+        sync_dists.side_effect = OSError()
+
+        self.assertRaises(OSError, s.perform_snapshot)
+        self.assertEquals(Snapshot.objects.get(id=s.id).state, Snapshot.FAILED)
 
 
 class TaskTestCase(TestCase):
@@ -53,6 +980,15 @@ class TaskTestCase(TestCase):
         MirrorMock.objects.get.assert_called_with(id=1234)
         MirrorMock.objects.get.return_value.update_mirror.assert_called_with()
 
+    @mock.patch('aasemble.django.apps.mirrorsvc.models.Mirror')
+    def test_refresh_mirror_retries_without_free_slot(self, MirrorMock):
+        from . import tasks
+        MirrorMock.objects.get.return_value.update_mirror.return_value = False
+        with mock.patch.object(tasks.refresh_mirror, 'retry', side_effect=Retry()) as retry:
+            self.assertRaises(Retry, tasks.refresh_mirror, 1234)
+
+        retry.assert_called_with(countdown=BackingMirror.slot_retry_delay)
+
     @mock.patch('aasemble.django.apps.mirrorsvc.models.Snapshot')
     def test_perform_snapshot(self, SnapshotMock):
         from . import tasks
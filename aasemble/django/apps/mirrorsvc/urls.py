@@ -15,4 +15,6 @@ urlpatterns = [
     url(r'^mirrorsets/(?P<uuid>[^/]+)/snapshots/$', aasemble.django.apps.mirrorsvc.views.mirrorset_snapshots, name='mirrorset_snapshots'),
     url(r'^mirrorsets/(?P<uuid>[^/]+)/snapshots/new', aasemble.django.apps.mirrorsvc.views.create_new_snapshot, name='new_snapshot'),
     url(r'^mirrorsets/', aasemble.django.apps.mirrorsvc.views.mirrorsets, name='mirrorsets'),
+    url(r'^files/(?P<mirror_uuid>[^/]+)/(?P<path>.+)$', aasemble.django.apps.mirrorsvc.views.mirror_file,
+        name='mirror_file'),
 ]
@@ -1,7 +1,11 @@
+import os.path
+
 from django.contrib.auth.decorators import login_required
 from django.core.urlresolvers import reverse
-from django.http import HttpResponse, HttpResponseRedirect
-from django.shortcuts import render
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseRedirect
+from django.shortcuts import get_object_or_404, render
+
+from aasemble.utils.exceptions import DownloadFailed
 
 from .forms import MirrorDefinitionForm, MirrorSetDefinitionForm, TagDefinitionForm
 from .models import Mirror, MirrorSet, Snapshot, Tags
@@ -32,6 +36,7 @@ def mirror_definition(request, mirror_uuid):
             new_mirror = form.save(commit=False)
             new_mirror.owner = request.user
             new_mirror.save()
+            form.save_m2m()
             return HttpResponseRedirect(reverse('mirrorsvc:mirrors'))
     else:
         form = get_mirror_definition_form(request, instance=mirror)
@@ -153,7 +158,41 @@ def refresh_mirror_with_uuid(request, mirror_uuid):
 @login_required
 def create_new_snapshot(request, uuid):
     ms = MirrorSet.objects.get(uuid=uuid)
-    if ms.user_can_modify(request.user):
-        snap = Snapshot.objects.create(mirrorset=ms)
-        snap.perform_snapshot()
+    if ms.user_can_modify(request.user) and ms.can_be_snapshotted():
+        # Taken in the background
+        Snapshot.objects.create(mirrorset=ms)
     return HttpResponseRedirect(reverse('mirrorsvc:mirrorset_snapshots', kwargs={'uuid': uuid}))
+
+
+def mirror_file(request, mirror_uuid, path):
+    """Serve a file of a mirror, at the same path as under MIRRORSVC_BASE_URL
+
+    Pool files of on demand mirrors are fetched from upstream the first
+    time they are asked for. Public mirrors need no login, so apt can get
+    at them. Only what the mirror selected is served, not everything its
+    backing mirror carries."""
+    mirror = get_object_or_404(Mirror, uuid=mirror_uuid)
+    if not mirror.user_can_view(request.user):
+        raise Http404
+    backing = mirror.backing
+    subpath = os.path.normpath(mirror.archive_subpath)
+    path = os.path.normpath(path)
+    if backing is None or not path.startswith(subpath + '/'):
+        raise Http404
+    path = path[len(subpath) + 1:]
+    # The backing mirror is shared with other users' mirrors
+    if not mirror.selects(path):
+        raise Http404
+
+    fullpath = os.path.join(backing.archive_dir, path)
+    if not os.path.isfile(fullpath):
+        if not backing.on_demand:
+            raise Http404
+        try:
+            fullpath = backing.fetch_on_demand(path)
+        except DownloadFailed:
+            return HttpResponse('Could not fetch %s from upstream' % (path,), status=502,
+                                content_type='text/plain')
+        if fullpath is None:
+            raise Http404
+    return FileResponse(open(fullpath, 'rb'), content_type='application/octet-stream')
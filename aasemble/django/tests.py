@@ -80,3 +80,22 @@ class UtilsTestCase(AasembleTestCase):
                 self.assertEquals('wobble\n', fp.read())
         finally:
             shutil.rmtree(tmpdir)
+
+    @override_settings(TEMPLATES=[{'BACKEND': 'django.template.backends.django.DjangoTemplates',
+                                   'DIRS': [os.path.dirname(__file__)]}])
+    def test_recursive_render_only_writes_changes(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        srcdir = os.path.join(os.path.dirname(__file__), 'test_data', 'recursive_render')
+        baz = os.path.join(tmpdir, 'foo', 'bar', 'baz')
+
+        recursive_render(srcdir, tmpdir, {'var': 'resolvedvar'})
+        os.utime(baz, (0, 0))
+
+        recursive_render(srcdir, tmpdir, {'var': 'resolvedvar'})
+        self.assertEquals(os.stat(baz).st_mtime, 0)
+
+        recursive_render(srcdir, tmpdir, {'var': 'othervar'})
+        self.assertNotEquals(os.stat(baz).st_mtime, 0)
+        with open(baz, 'r') as fp:
+            self.assertEquals('othervar\n', fp.read())
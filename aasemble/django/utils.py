@@ -1,11 +1,40 @@
+import hashlib
 import logging
 import os
 import os.path
 
-from django.template.loader import render_to_string
+from django.template import loader
 
 LOG = logging.getLogger(__name__)
 
+_templates = {}
+_tree_digests = {}
+
+
+def get_template(path):
+    """The compiled template at path. Templates are only compiled once per process"""
+    if path not in _templates:
+        _templates[path] = loader.get_template(path)
+    return _templates[path]
+
+
+def tree_digest(src):
+    """sha256 of the names and contents of the files under src
+
+    Computed once per process, so only suitable for trees that only change
+    on deployment (i.e. templates)."""
+    if src not in _tree_digests:
+        digest = hashlib.sha256()
+        for dirpath, dirnames, filenames in os.walk(src):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                path = os.path.join(dirpath, filename)
+                digest.update(os.path.relpath(path, src).encode('utf-8'))
+                with open(path, 'rb') as fp:
+                    digest.update(fp.read())
+        _tree_digests[src] = digest.hexdigest()
+    return _tree_digests[src]
+
 
 def recursive_render(src, dst, context, logger=LOG):
     logger.debug('Processing %s' % (src,))
@@ -18,7 +47,12 @@ def recursive_render(src, dst, context, logger=LOG):
         if src.endswith('.swp'):
             return
         logger.debug('Rendering %s' % (src,))
-        s = render_to_string(src, context)
+        s = get_template(src).render(context)
         logger.debug('Result: %r' % (s,))
+        if os.path.exists(dst):
+            with open(dst, 'r') as fp_in:
+                if fp_in.read() == s:
+                    logger.debug('%s is up to date' % (dst,))
+                    return
         with open(dst, 'w') as fp_out:
             fp_out.write(s)
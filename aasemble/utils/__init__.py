@@ -1,7 +1,14 @@
+import contextlib
+import errno
+import fcntl
+import hashlib
 import logging
 import os
 import select
+import shutil
+import stat
 import subprocess
+import uuid
 
 from six import BytesIO
 from six.moves import shlex_quote
@@ -124,14 +131,175 @@ def run_cmd(cmd, input=None, cwd=None, override_env=None,
 
 def ensure_dir(d):
     if not os.path.isdir(d):
-        os.makedirs(d)
+        try:
+            os.makedirs(d)
+        except OSError as e:
+            # Made by someone else in the meantime
+            if e.errno != errno.EEXIST or not os.path.isdir(d):
+                raise
     return d
 
+
+@contextlib.contextmanager
+def file_lock(path, blocking=True):
+    """Hold an exclusive flock() on path for the duration of the block
+
+    Yields whether the lock was acquired, which can only be False when
+    blocking is False."""
+    flags = fcntl.LOCK_EX
+    if not blocking:
+        flags |= fcntl.LOCK_NB
+
+    with open(path, 'a') as fp:
+        try:
+            fcntl.flock(fp.fileno(), flags)
+        except IOError as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            yield False
+            return
+
+        try:
+            yield True
+        finally:
+            fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+
+
+def hardlink_tree(src, dst):
+    """Recreate the directory tree at src in dst, hardlinking every file"""
+    for dirpath, dirnames, filenames in os.walk(src):
+        destdir = ensure_dir(os.path.join(dst, os.path.relpath(dirpath, src)))
+        for filename in filenames:
+            os.link(os.path.join(dirpath, filename), os.path.join(destdir, filename))
+
+
+def sha256_file(path, bufsize=1024 * 1024):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        while True:
+            buf = fp.read(bufsize)
+            if not buf:
+                break
+            sha256.update(buf)
+    return sha256.hexdigest()
+
+
+class BlobStore(object):
+    """Content addressed file store
+
+    Blobs are named by their sha256 and put to use by hardlinking them into
+    place, so identical files anywhere on the same file system share their
+    storage. A blob's link count doubles as its reference count: once only
+    the store's own link is left, gc() reclaims it."""
+    def __init__(self, basedir):
+        self.basedir = basedir
+
+    def path(self, sha256):
+        return os.path.join(self.basedir, sha256[:2], sha256)
+
+    def __contains__(self, sha256):
+        return os.path.exists(self.path(sha256))
+
+    def add(self, path, sha256=None):
+        """Add the contents of path to the store and return its sha256"""
+        if sha256 is None:
+            sha256 = sha256_file(path)
+
+        blob = self.path(sha256)
+        if not os.path.exists(blob):
+            tmppath = '%s.%s.tmp' % (blob, uuid.uuid4().hex)
+            ensure_dir(os.path.dirname(blob))
+            try:
+                os.link(path, tmppath)
+            except OSError:
+                # Probably a different file system
+                shutil.copy(path, tmppath)
+            os.rename(tmppath, blob)
+
+        return sha256
+
+    def link(self, sha256, dest, source=None):
+        """Make dest a hardlink to the blob, replacing whatever is there
+
+        A blob nothing links to yet may be removed by gc() at any moment.
+        If that happened, the blob is added again from source, which must
+        have the same contents. Without a source, OSError (ENOENT) is
+        raised."""
+        blob = self.path(sha256)
+        try:
+            if os.path.samefile(blob, dest):
+                return
+        except OSError:
+            # One of them does not exist
+            pass
+
+        tmppath = '%s.%s.tmp' % (dest, uuid.uuid4().hex)
+        ensure_dir(os.path.dirname(dest))
+        try:
+            os.link(blob, tmppath)
+        except OSError as e:
+            if e.errno != errno.ENOENT or source is None:
+                raise
+            self.add(source, sha256)
+            os.link(blob, tmppath)
+        os.rename(tmppath, dest)
+
+    def dedupe(self, path, sha256=None):
+        """Replace path with a link to the blob holding the same content"""
+        self.link(self.add(path, sha256), path, source=path)
+
+    def dedupe_files(self, paths):
+        """dedupe() every file in paths that exists and is not linked
+        anywhere else yet
+
+        Files already in the store are not even read, so going through the
+        same files again is cheap. Returns the number of bytes saved."""
+        saved = 0
+        for path in paths:
+            try:
+                st = os.lstat(path)
+            except OSError:
+                continue
+            if not stat.S_ISREG(st.st_mode) or st.st_nlink > 1:
+                continue
+            sha256 = sha256_file(path)
+            if sha256 in self:
+                saved += st.st_size
+            self.dedupe(path, sha256)
+        return saved
+
+    def dedupe_tree(self, root):
+        """dedupe_files() every file under root"""
+        return self.dedupe_files(os.path.join(dirpath, filename)
+                                 for dirpath, dirnames, filenames in os.walk(root)
+                                 for filename in filenames)
+
+    def gc(self):
+        """Remove blobs that are not linked anywhere
+
+        Returns the number of blobs removed and the number of bytes
+        reclaimed."""
+        removed, reclaimed = 0, 0
+        if not os.path.isdir(self.basedir):
+            return removed, reclaimed
+
+        for dirpath, dirnames, filenames in os.walk(self.basedir):
+            for filename in filenames:
+                if filename.endswith('.tmp'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                st = os.lstat(path)
+                if st.st_nlink == 1:
+                    os.unlink(path)
+                    removed += 1
+                    reclaimed += st.st_size
+
+        return removed, reclaimed
+
 try:
     from tempfile import TemporaryDirectory
 except ImportError:
     import tempfile
-    import shutil
 
     class TemporaryDirectory(object):
         def __init__(self, *args, **kwargs):
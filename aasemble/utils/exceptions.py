@@ -4,3 +4,24 @@ class CommandFailed(Exception):
         self.returncode = returncode
         self.stdout = stdout
         super(CommandFailed, self).__init__(msg)
+
+
+class ChecksumMismatch(Exception):
+    def __init__(self, path, algorithm, expected=None, actual=None):
+        self.path = path
+        self.algorithm = algorithm
+        self.expected = expected
+        self.actual = actual
+        if expected is None:
+            msg = '%s is missing' % (path,)
+        else:
+            msg = '%s: expected %s %s, got %s' % (path, algorithm, expected, actual)
+        super(ChecksumMismatch, self).__init__(msg)
+
+
+class DownloadFailed(Exception):
+    def __init__(self, url, status=None, reason=None):
+        self.url = url
+        self.status = status
+        self.reason = reason
+        super(DownloadFailed, self).__init__('Downloading %s failed: %s' % (url, reason or status))
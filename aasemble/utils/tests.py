@@ -1,3 +1,4 @@
+import errno
 import os
 import os.path
 import shutil
@@ -6,7 +7,7 @@ from unittest import TestCase
 
 import mock
 
-from aasemble.utils import TemporaryDirectory, ensure_dir, escape_cmd_for_ssh, run_cmd, ssh_get, ssh_run_cmd
+from aasemble.utils import BlobStore, TemporaryDirectory, ensure_dir, escape_cmd_for_ssh, file_lock, hardlink_tree, run_cmd, ssh_get, ssh_run_cmd
 from aasemble.utils.exceptions import CommandFailed
 
 stdout_stderr_script = '''#!/bin/sh
@@ -56,9 +57,109 @@ class UtilsTestCase(TestCase):
             self.assertEquals(ensure_dir(testdir), testdir)
             self.assertTrue(os.path.isdir(testdir))
             self.assertEquals(ensure_dir(testdir), testdir)
+
+            # Made by someone else between the check and makedirs()
+            otherdir = os.path.join(tmpdir, 'otherdir')
+            with mock.patch('os.path.isdir', side_effect=[False, True]):
+                with mock.patch('os.makedirs', side_effect=OSError(errno.EEXIST, 'File exists')):
+                    self.assertEquals(ensure_dir(otherdir), otherdir)
         finally:
             shutil.rmtree(tmpdir)
 
+    def test_file_lock(self):
+        with TemporaryDirectory() as tmpdir:
+            lockfile = os.path.join(tmpdir, 'lock')
+            with file_lock(lockfile) as acquired:
+                self.assertTrue(acquired)
+                with file_lock(lockfile, blocking=False) as acquired_again:
+                    self.assertFalse(acquired_again)
+            with file_lock(lockfile, blocking=False) as acquired:
+                self.assertTrue(acquired)
+
+    def test_hardlink_tree(self):
+        with TemporaryDirectory() as tmpdir:
+            src = ensure_dir(os.path.join(tmpdir, 'src', 'sub'))
+            with open(os.path.join(src, 'file'), 'w') as fp:
+                fp.write('content')
+
+            hardlink_tree(os.path.join(tmpdir, 'src'), os.path.join(tmpdir, 'dst'))
+
+            self.assertTrue(os.path.samefile(os.path.join(src, 'file'),
+                                             os.path.join(tmpdir, 'dst', 'sub', 'file')))
+
+    def test_blob_store(self):
+        with TemporaryDirectory() as tmpdir:
+            store = BlobStore(os.path.join(tmpdir, 'blobs'))
+            for name in ('first', 'second'):
+                with open(os.path.join(tmpdir, name), 'w') as fp:
+                    fp.write('same content')
+
+            sha256 = store.add(os.path.join(tmpdir, 'first'))
+            self.assertIn(sha256, store)
+            store.dedupe(os.path.join(tmpdir, 'second'))
+            store.link(sha256, os.path.join(tmpdir, 'pool', 'third'))
+
+            self.assertTrue(os.path.samefile(store.path(sha256), os.path.join(tmpdir, 'second')))
+            self.assertTrue(os.path.samefile(store.path(sha256), os.path.join(tmpdir, 'pool', 'third')))
+            self.assertEquals(store.gc(), (0, 0))
+
+            for name in ('first', 'second', os.path.join('pool', 'third')):
+                os.unlink(os.path.join(tmpdir, name))
+
+            self.assertEquals(store.gc(), (1, len('same content')))
+            self.assertNotIn(sha256, store)
+
+    def test_blob_store_dedupe_survives_gc(self):
+        with TemporaryDirectory() as tmpdir:
+            store = BlobStore(os.path.join(tmpdir, 'blobs'))
+            path = os.path.join(tmpdir, 'file')
+            with open(path, 'w') as fp:
+                fp.write('same content')
+            sha256 = store.add(path)
+            # Nothing links to the blob but the file it was added from
+            os.unlink(path)
+            with open(path, 'w') as fp:
+                fp.write('same content')
+
+            # gc() gets in between add() and link()
+            add = store.add
+
+            def add_then_gc(*args, **kwargs):
+                rv = add(*args, **kwargs)
+                store.gc()
+                return rv
+
+            with mock.patch.object(store, 'add', side_effect=add_then_gc):
+                store.dedupe(path, sha256)
+
+            self.assertTrue(os.path.samefile(store.path(sha256), path))
+            self.assertRaises(OSError, store.link, 'a' * 64, os.path.join(tmpdir, 'other'))
+
+    def test_blob_store_dedupe_tree(self):
+        with TemporaryDirectory() as tmpdir:
+            store = BlobStore(os.path.join(tmpdir, 'blobs'))
+            for name in ('first', 'second'):
+                ensure_dir(os.path.join(tmpdir, name))
+                with open(os.path.join(tmpdir, name, 'file'), 'w') as fp:
+                    fp.write('same content')
+
+            self.assertEquals(store.dedupe_tree(os.path.join(tmpdir, 'first')), 0)
+            self.assertEquals(store.dedupe_tree(os.path.join(tmpdir, 'second')), len('same content'))
+            self.assertEquals(store.dedupe_tree(os.path.join(tmpdir, 'second')), 0)
+            self.assertTrue(os.path.samefile(os.path.join(tmpdir, 'first', 'file'),
+                                             os.path.join(tmpdir, 'second', 'file')))
+
+    def test_blob_store_dedupe_files_skips_missing_files(self):
+        with TemporaryDirectory() as tmpdir:
+            store = BlobStore(os.path.join(tmpdir, 'blobs'))
+            for name in ('first', 'second'):
+                with open(os.path.join(tmpdir, name), 'w') as fp:
+                    fp.write('same content')
+
+            paths = [os.path.join(tmpdir, name) for name in ('first', 'missing', 'second')]
+            self.assertEquals(store.dedupe_files(paths), len('same content'))
+            self.assertTrue(os.path.samefile(paths[0], paths[2]))
+
     def test_run_cmd_dead_simple(self):
         # Should simply return successfully
         stdout = run_cmd(['true'])
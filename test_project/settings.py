@@ -143,6 +143,22 @@ CELERYBEAT_SCHEDULE = {
         'task': 'aasemble.django.apps.buildsvc.tasks.poll_all',
         'schedule': timedelta(seconds=10),
     },
+    'refill-key-pool': {
+        'task': 'aasemble.django.apps.buildsvc.tasks.refill_key_pool',
+        'schedule': timedelta(minutes=10),
+    },
+    'gc-blobs': {
+        'task': 'aasemble.django.apps.buildsvc.tasks.gc_blobs',
+        'schedule': timedelta(hours=6),
+    },
+    'collect-garbage': {
+        'task': 'aasemble.django.apps.buildsvc.tasks.collect_garbage_all',
+        'schedule': timedelta(days=1),
+    },
+    'schedule-mirror-refreshes': {
+        'task': 'aasemble.django.apps.mirrorsvc.tasks.schedule_refreshes',
+        'schedule': timedelta(minutes=1),
+    },
 }
 
 CELERY_TIMEZONE = TIME_ZONE